@@ -9,15 +9,138 @@ class CSVError(Exception):
     def __str__(self):
         return repr(self.value)
 
+# CSV tokenizers. Each takes one stripped, non-blank input line and returns
+# the list of field values it contains. The reference tokenizer is the
+# original character-at-a-time state machine and serves as the definition
+# of our CSV dialect. The fast tokenizer must produce identical results
+# (including errors), but leaves most of the scanning to the C-level
+# string methods, which is where the time goes on large reports.
+
+def split_fields_reference(line):
+    """
+    Our basic CSV scanner state machine. We handle the following conventions:
+    * "quoted strings","as fields",mixed,with,non-quoted
+    * "double ""quote"" escapes"
+    * Leading and trailing whitespace stripping on fields
+    """
+
+    state = None
+    accum = ""
+    values = []
+    for c in line:
+        if state is None:
+            if c == '"':
+                state = "quote"
+            elif c == ',':
+                values.append(accum.strip())
+                accum = ""
+            else:
+                accum += c
+                state = "data"
+        elif state == "quote":
+            if c == '"':
+                state = "end_quote"
+            else:
+                accum += c
+        elif state == "end_quote":
+            if c == '"':
+                state = "quote"
+                accum += c
+            elif c == ',':
+                values.append(accum.strip())
+                accum = ""
+                state = None
+            elif c.isspace():
+                pass
+            else:
+                raise CSVError("Unexpected character '%s' after end-quote" % c)
+        elif state == "data":
+            if c == ',':
+                values.append(accum.strip())
+                accum = ""
+                state = None
+            elif c == '"' and accum.isspace():
+                accum = ""
+                state = "quote"
+            else:
+                accum += c
+        else:
+            raise CSVError("Unknown state '%s'" % state)
+    values.append(accum.strip())
+    return values
+
+def split_fields_fast(line):
+    """
+    The same dialect as split_fields_reference, but working a field at a
+    time with find() and slicing rather than a character at a time.
+    """
+
+    if '"' not in line:
+        return [value.strip() for value in line.split(',')]
+    values = []
+    end = len(line)
+    pos = 0
+    while True:
+        comma = line.find(',', pos)
+        if comma < 0:
+            comma = end
+        quote = line.find('"', pos, comma)
+        # A quote only opens a quoted value if nothing but whitespace
+        # precedes it in the field. Otherwise it is just data.
+        if quote < 0 or line[pos:quote].strip():
+            values.append(line[pos:comma].strip())
+            if comma == end:
+                return values
+            pos = comma + 1
+            continue
+        accum = []
+        pos = quote + 1
+        while True:
+            close = line.find('"', pos)
+            if close < 0:
+                # Unterminated quotes run to the end of the line
+                accum.append(line[pos:])
+                values.append("".join(accum).strip())
+                return values
+            accum.append(line[pos:close])
+            pos = close + 1
+            while pos < end and line[pos].isspace():
+                pos += 1
+            if pos == end:
+                values.append("".join(accum).strip())
+                return values
+            c = line[pos]
+            pos += 1
+            if c == '"':
+                accum.append(c)
+            elif c == ',':
+                values.append("".join(accum).strip())
+                break
+            else:
+                raise CSVError("Unexpected character '%s' after end-quote" % c)
+
+CSV_ENGINES = {
+    'fast': split_fields_fast,
+    'reference': split_fields_reference,
+}
+
 class CSVReader(object):
     """A reader for the CSV input files"""
-    def __init__(self, source):
+    def __init__(self, source, engine='fast'):
         """
         Initialize with the source of CSV input and the destination for output.
         Defaults to sys.stdin and sys.stdout, respectively.
+
+        The engine parameter selects the tokenizer used to split lines into
+        fields, and must be one of the keys of CSV_ENGINES. All engines
+        accept exactly the same input, so this only affects speed.
         """
 
+        if engine not in CSV_ENGINES:
+            raise ValueError("Unknown CSV engine '%s'" % engine)
         self.source = source
+        self.engine = engine
+        self.split_fields = CSV_ENGINES[engine]
         self.lineno = 0
         self.lastline = None
 
@@ -42,11 +165,9 @@ class CSVReader(object):
 
     def parse_line(self):
         """
-        Our basic CSV scanner state machine. We handle the following conventions:
-        * "quoted strings","as fields",mixed,with,non-quoted
-        * "double ""quote"" escapes"
-        * Elimination of blank input lines
-        * Leading and trailing whitespace stripping on fields
+        Read the next non-blank line and split it into a list of field values
+        using the selected engine (see split_fields_reference for the
+        conventions we handle). Returns None at end of input.
         """
 
         while True:
@@ -56,48 +177,4 @@ class CSVReader(object):
             line = line.strip()
             if len(line) == 0:
                 continue
-            state = None
-            accum = ""
-            values = []
-            for c in line:
-                if state is None:
-                    if c == '"':
-                        state = "quote"
-                    elif c == ',':
-                        values.append(accum.strip())
-                        accum = ""
-                    else:
-                        accum += c
-                        state = "data"
-                elif state == "quote":
-                    if c == '"':
-                        state = "end_quote"
-                    else:
-                        accum += c
-                elif state == "end_quote":
-                    if c == '"':
-                        state = "quote"
-                        accum += c
-                    elif c == ',':
-                        values.append(accum.strip())
-                        accum = ""
-                        state = None
-                    elif c.isspace():
-                        pass
-                    else:
-                        raise CSVError("Unexpected character '%s' after end-quote" % c)
-                elif state == "data":
-                    if c == ',':
-                        values.append(accum.strip())
-                        accum = ""
-                        state = None
-                    elif c == '"' and accum.isspace():
-                        accum = ""
-                        state = "quote"
-                    else:
-                        accum += c
-                else:
-                    raise CSVError("Unknown state '%s'" % state)
-            values.append(accum.strip())
-
-            return values
+            return self.split_fields(line)
@@ -0,0 +1,336 @@
+#!/usr/bin/python
+
+# Grouped totals (rollups) of ad report data, computed as it is read.
+#
+# An Aggregator keeps a set of running totals for each group of rows,
+# where a group is the rows with the same values of some of the date, ad
+# group and ad name. The totals are the same dict of impressions, clicks
+# and cost in cents that AdDataReader keeps for checking summary lines
+# (see admetrics.new_totals), and the CTR of a group is worked out from
+# them at the end. Ad groups and names are grouped in lower case, as the
+# CSV output gives them.
+#
+# Rows can be added one at a time, with the group found in a dict of the
+# totals (and with their ad group and name already folded, if the caller
+# has them from an adsymbols.SymbolTable), or a whole AdBatch at once.
+# With NumPy, a large batch is grouped with array operations: each key
+# column is reduced to integer codes, the codes are combined into one per
+# row, and the numbers are summed for each code in integer arithmetic, so
+# that only the distinct groups of the batch are looked at in Python. The
+# totals are the same either way.
+#
+# Aggregators of different parts of the data (files in a batch, say) can
+# be merged once each part is known to be good.
+
+import sys
+import operator
+import itertools
+
+import admetrics
+from admetrics import new_totals, csv_string, numpy
+
+# The fields rows may be grouped by, each with the AdBatch column that
+# holds it and its name in the output
+FIELDS = {
+    'date': ('dates', 'report_date'),
+    'ad_group': ('ad_groups', 'ad_group'),
+    'ad_name': ('ad_names', 'ad_name'),
+}
+
+# Batches smaller than this are added a row at a time
+NUMPY_THRESHOLD = 1000
+
+def parse_fields(text):
+    """
+    Return the tuple of field names in text, such as "date,ad_group", or
+    raise ValueError if any is not one of FIELDS.
+    """
+
+    fields = tuple(field.strip() for field in text.split(","))
+    for field in fields:
+        if field not in FIELDS:
+            raise ValueError("Cannot group by '%s': use %s" % (field,
+                ", ".join(sorted(FIELDS))))
+    if len(set(fields)) != len(fields):
+        raise ValueError("Cannot group by '%s' twice" % text)
+    return fields
+
+def totals_ctr(totals):
+    """The CTR of a set of totals, or 0.0 if there were no impressions"""
+
+    if totals['impressions'] == 0:
+        return 0.0
+    return float(totals['clicks']) / totals['impressions']
+
+class Aggregator(object):
+    """Running totals of the rows given to it, for each group of rows"""
+
+    def __init__(self, by=('ad_group',), use_numpy=True,
+            numpy_threshold=NUMPY_THRESHOLD):
+        """
+        Group rows by the fields in by (see FIELDS). Setting use_numpy to
+        false forces batches to be added a row at a time, as they are
+        anyway when they have fewer than numpy_threshold rows.
+        """
+
+        for field in by:
+            if field not in FIELDS:
+                raise ValueError("Cannot group by '%s'" % field)
+        self.by = tuple(by)
+        self.use_numpy = use_numpy and numpy is not None
+        self.numpy_threshold = numpy_threshold
+        # Set once a batch is found to have nearly as many groups as rows,
+        # when the arrays only add to the work
+        self.sparse = False
+        self.groups = {}
+        self._make_key_functions()
+
+    def __getstate__(self):
+        """Pickle without the key functions, which are made again"""
+
+        state = dict(self.__dict__)
+        del state['_key_of'], state['_key_at'], state['_key_folded']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._make_key_functions()
+
+    def _make_key_functions(self):
+        """Make the functions that give the group keys of AdInfos and of lists"""
+
+        self._lower = tuple(field != 'date' for field in self.by)
+        self._key_of = self._key_function(operator.attrgetter)
+        self._key_at = self._key_function(
+            lambda *names: operator.itemgetter(*range(len(names))))
+        # From a (date, ad group, ad name) tuple already in lower case
+        places = [('date', 'ad_group', 'ad_name').index(field) for field in self.by]
+        if len(places) == 0:
+            self._key_folded = lambda row: ()
+        elif len(places) == 1:
+            place = places[0]
+            self._key_folded = lambda row: (row[place],)
+        else:
+            self._key_folded = operator.itemgetter(*places)
+
+    def _key_function(self, getter):
+        """
+        Return a function that gives the group key of a row, given a function
+        like operator.attrgetter that makes a getter for the values of the
+        fields in by. The usual cases are made as quick as they can be.
+        """
+
+        lower = self._lower
+        if len(self.by) == 0:
+            return lambda row: ()
+        get = getter(*self.by)
+        if len(self.by) == 1:
+            if lower[0]:
+                return lambda row: (get(row).lower(),)
+            return lambda row: (get(row),)
+        if len(self.by) == 2:
+            fold_a, fold_b = lower
+            def key(row):
+                a, b = get(row)
+                return (a.lower() if fold_a else a, b.lower() if fold_b else b)
+            return key
+        fold_a, fold_b, fold_c = lower
+        def key(row):
+            a, b, c = get(row)
+            return (a.lower() if fold_a else a, b.lower() if fold_b else b,
+                c.lower() if fold_c else c)
+        return key
+
+    def add(self, ad_info, first=False, args=None):
+        """
+        Add an AdInfo to its group's totals. The arguments are those of a
+        produce callback, so this can be given to an AdDataReader directly.
+        """
+
+        key = self._key_of(ad_info)
+        totals = self.groups.get(key)
+        if totals is None:
+            totals = self.groups[key] = new_totals()
+        totals['impressions'] += ad_info.impressions
+        totals['clicks'] += ad_info.clicks
+        totals['total cost in cents'] += ad_info.total_cost_in_cents
+
+    def add_folded(self, ad_info, ad_group, ad_name):
+        """
+        Add an AdInfo, given its ad group and name already in lower case (as
+        an adsymbols.SymbolTable has them), so they need not be folded again.
+        """
+
+        key = self._key_folded((ad_info.date, ad_group, ad_name))
+        totals = self.groups.get(key)
+        if totals is None:
+            totals = self.groups[key] = new_totals()
+        totals['impressions'] += ad_info.impressions
+        totals['clicks'] += ad_info.clicks
+        totals['total cost in cents'] += ad_info.total_cost_in_cents
+
+    def add_batch(self, batch, first=False, args=None):
+        """
+        Add the rows of an AdBatch to their groups' totals. The arguments are
+        those of a produce_batch callback.
+        """
+
+        if len(batch) == 0:
+            return
+        if self.use_numpy and not self.sparse and \
+                len(batch) >= self.numpy_threshold:
+            self._add_arrays(batch)
+            return
+        columns = [getattr(batch, FIELDS[field][0]) for field in self.by]
+        groups = self.groups
+        for i, (impressions, clicks, cents) in enumerate(itertools.izip(
+                batch.impressions, batch.clicks, batch.total_cost_in_cents)):
+            key = self._key_at([column[i] for column in columns])
+            totals = groups.get(key)
+            if totals is None:
+                totals = groups[key] = new_totals()
+            totals['impressions'] += impressions
+            totals['clicks'] += clicks
+            totals['total cost in cents'] += cents
+
+    def _add_arrays(self, batch):
+        """add_batch with NumPy"""
+
+        count = len(batch)
+        # The group of each row, as a number from 0 up, and the first row
+        # of each group
+        codes = numpy.zeros(count, numpy.int64)
+        first = numpy.zeros(1, numpy.int64)
+        for field, lower in zip(self.by, self._lower):
+            # Number the distinct values in a dict, which is much quicker
+            # than having NumPy sort the strings
+            numbers = {}
+            inverse = numpy.fromiter([numbers.setdefault(value, len(numbers))
+                for value in getattr(batch, FIELDS[field][0])], numpy.int64, count)
+            distinct = len(numbers)
+            if lower:
+                # Only the distinct values need folding to lower case
+                folded = {}
+                refold = numpy.zeros(distinct, numpy.int64)
+                for value, number in numbers.iteritems():
+                    refold[number] = folded.setdefault(value.lower(), len(folded))
+                inverse = refold[inverse]
+                distinct = len(folded)
+            combined = codes * distinct + inverse
+            first, codes = numpy.unique(combined, return_index=True,
+                return_inverse=True)[1:]
+        if len(first) > count // 2:
+            self.sparse = True
+        # Sum each column over the rows of each group, in integers
+        order = numpy.argsort(codes, kind='mergesort')
+        starts = numpy.zeros(len(first), numpy.int64)
+        numpy.cumsum(numpy.bincount(codes)[:-1], out=starts[1:])
+        sums = []
+        for name in ('impressions', 'clicks', 'total_cost_in_cents'):
+            column = getattr(batch, name)
+            values = numpy.frombuffer(column, dtype=numpy.dtype('i%d' % column.itemsize))
+            sums.append(numpy.add.reduceat(values.astype(numpy.int64)[order],
+                starts).tolist())
+        columns = [getattr(batch, FIELDS[field][0]) for field in self.by]
+        groups = self.groups
+        for row, impressions, clicks, cents in itertools.izip(first.tolist(), *sums):
+            key = self._key_at([column[row] for column in columns])
+            totals = groups.get(key)
+            if totals is None:
+                totals = groups[key] = new_totals()
+            totals['impressions'] += impressions
+            totals['clicks'] += clicks
+            totals['total cost in cents'] += cents
+
+    def merge(self, other):
+        """Add the totals of another Aggregator with the same fields to ours"""
+
+        if other.by != self.by:
+            raise ValueError("Cannot merge totals grouped by different fields")
+        groups = self.groups
+        for key, other_totals in other.groups.iteritems():
+            totals = groups.get(key)
+            if totals is None:
+                groups[key] = dict(other_totals)
+            else:
+                for name in totals:
+                    totals[name] += other_totals[name]
+
+    def totals(self):
+        """The totals of all of the groups together"""
+
+        totals = new_totals()
+        for group in self.groups.itervalues():
+            for name in totals:
+                totals[name] += group[name]
+        return totals
+
+    def rows(self):
+        """
+        Iterate over the groups in order, as tuples of the key values
+        followed by impressions, clicks, CTR and total cost in cents.
+        """
+
+        for key in sorted(self.groups):
+            totals = self.groups[key]
+            yield key + (totals['impressions'], totals['clicks'],
+                totals_ctr(totals), totals['total cost in cents'])
+
+    def columns(self):
+        """The names of the columns of the rows, for a header line"""
+
+        return [FIELDS[field][1] for field in self.by] + \
+            ['impressions', 'clicks', 'ctr', 'total_cost_in_cents']
+
+    def write(self, writer, first=True):
+        """
+        Write the rows as CSV lines to an admetrics.OutputWriter, after a
+        header line (with a BOM, if the writer has one, if first is set).
+        """
+
+        header = u", ".join(self.columns())
+        if first:
+            writer.write_header(header)
+        else:
+            writer.write_row(header)
+        line = u",".join([u"%s"] * len(self.by) + [u"%d,%d,%.4f,%d"])
+        for row in self.rows():
+            writer.write_row(line % tuple([csv_string(value) for value in row[:-4]]
+                + list(row[-4:])))
+
+def make_aggregators(specs):
+    """Return an Aggregator for each of specs, strings as for parse_fields"""
+
+    return [Aggregator(parse_fields(spec)) for spec in specs]
+
+def merge_aggregators(into, aggregators):
+    """Merge each of aggregators into the matching one of into"""
+
+    for target, source in zip(into, aggregators):
+        target.merge(source)
+
+def write_aggregates(aggregators, stream, encoding='utf-8', bom=True):
+    """
+    Write the rows of each of aggregators to stream, in turn, with a blank
+    line between one and the next.
+    """
+
+    writer = admetrics.OutputWriter(stream, encoding, bom)
+    for i, aggregator in enumerate(aggregators):
+        if i > 0:
+            writer.write_row(u"")
+        aggregator.write(writer, i == 0)
+    writer.flush()
+
+def write_requested(aggregators, args):
+    """
+    Write aggregators where the command-line options in args ask for them:
+    to the --aggregate-output file, or else standard error.
+    """
+
+    encoding, bom = admetrics.output_settings(args)
+    if args.aggregate_output is None:
+        write_aggregates(aggregators, sys.stderr, encoding, False)
+    else:
+        with open(args.aggregate_output, "wb") as stream:
+            write_aggregates(aggregators, stream, encoding, bom)
@@ -0,0 +1,443 @@
+#!/usr/bin/python
+
+# A cache of parsed reports, in a binary columnar format.
+#
+# Parsing and checking a report takes far longer than producing its rows
+# does, so once a report has been read all the way through without error,
+# its rows can be kept in a cache file and produced from there the next
+# time, for as long as the report is unchanged. What was logged while it
+# was parsed is kept too, and logged again, so the output and diagnostics
+# are the same either way. (The CTR of each row is not kept, as it can be
+# worked out again from the clicks and impressions.)
+#
+# A cache file is laid out so that it can be memory-mapped and its columns
+# used where they lie:
+#
+# * A fixed-size prefix: the magic string, the format version, the size
+#   and byte order of the integers, and the sizes of what follows.
+# * A JSON header with the report date and the logged messages.
+# * A dictionary of the distinct ad group and ad name strings: the offset
+#   of each in the decoded text, then the text itself, in UTF-8.
+# * A column of dictionary numbers for the ad groups, and one for the ad
+#   names, each 4 bytes a row.
+# * Columns of impressions, clicks and total cost in cents, each a native
+#   integer a row.
+#
+# Each section starts on an 8-byte boundary. Files written by a machine
+# with different integers are simply not used.
+#
+# A ReportCache keeps the cache files in a directory, named after a SHA-1
+# digest of the report's contents and of the options that affect what is
+# produced or logged. So that a large report need not be read through to
+# be recognized, the digest is kept in a stamp with the report's size and
+# modification time, and only worked out again when either has changed.
+# Both kinds of file are written to a temporary name and renamed into
+# place, so a cache directory can be shared by several processes.
+
+import os
+import sys
+import json
+import mmap
+import array
+import struct
+import hashlib
+import logging
+import tempfile
+
+import admetrics
+from admetrics import AdInfo, AdBatch, numpy
+from adparallel import CapturingHandler
+
+MAGIC = "ADCACHE\n"
+VERSION = 1
+
+# magic, version, integer size, byte order (0 little, 1 big), rows,
+# strings, header bytes, dictionary text bytes
+PREFIX = struct.Struct("<8sIIIQQQQ")
+
+# The array types of the dictionary numbers and of the other columns
+CODE_TYPE = 'I'
+INT_TYPE = 'l'
+INT_SIZE = array.array(INT_TYPE).itemsize
+BYTE_ORDER = 0 if sys.byteorder == 'little' else 1
+
+# The columns after the dictionary, in order, and their array types
+COLUMNS = (
+    ('ad_groups', CODE_TYPE),
+    ('ad_names', CODE_TYPE),
+    ('impressions', INT_TYPE),
+    ('clicks', INT_TYPE),
+    ('total_cost_in_cents', INT_TYPE),
+)
+
+# The options (command-line destinations) whose values change what is
+# produced or logged for a report. Whether it is memory-mapped matters too,
+# as warnings then give byte offsets.
+KEY_OPTIONS = ('input_encoding', 'multiline', 'no_total_warning',
+    'warning_limit', 'warning_sample')
+
+# Bytes of a report to read at a time to work out its digest
+HASH_BLOCK = 1024 * 1024
+
+def padding(size):
+    """The bytes needed to take size up to a multiple of 8"""
+
+    return -size % 8
+
+def make_ad_info(date, ad_group, ad_name, impressions, clicks, cents):
+    """Build an AdInfo from values that have already been checked"""
+
+    info = AdInfo.__new__(AdInfo)
+    info.date = date
+    info.ad_group = ad_group
+    info.ad_name = ad_name
+    info.impressions = impressions
+    info.clicks = clicks
+    info.ctr = float(clicks) / impressions if impressions else 0.0
+    info.total_cost_in_cents = cents
+    return info
+
+class CacheWriter(object):
+    """Collects the rows of a report, by column, and writes a cache file"""
+
+    def __init__(self):
+        self.date = None
+        self.numbers = {}
+        self.strings = []
+        self.columns = dict((name, array.array(kind)) for name, kind in COLUMNS)
+
+    def __len__(self):
+        return len(self.columns['impressions'])
+
+    def _number(self, string):
+        """The dictionary number of string, adding it if need be"""
+
+        number = self.numbers.get(string)
+        if number is None:
+            number = self.numbers[string] = len(self.strings)
+            self.strings.append(string)
+        return number
+
+    def add(self, ad_info):
+        """Add an AdInfo"""
+
+        self.date = ad_info.date
+        columns = self.columns
+        columns['ad_groups'].append(self._number(ad_info.ad_group))
+        columns['ad_names'].append(self._number(ad_info.ad_name))
+        columns['impressions'].append(ad_info.impressions)
+        columns['clicks'].append(ad_info.clicks)
+        columns['total_cost_in_cents'].append(ad_info.total_cost_in_cents)
+
+    def add_batch(self, batch):
+        """Add the rows of an AdBatch"""
+
+        if len(batch) == 0:
+            return
+        self.date = batch.dates[-1]
+        columns = self.columns
+        number = self._number
+        columns['ad_groups'].extend([number(value) for value in batch.ad_groups])
+        columns['ad_names'].extend([number(value) for value in batch.ad_names])
+        for name in ('impressions', 'clicks', 'total_cost_in_cents'):
+            columns[name].extend(getattr(batch, name))
+
+    def write(self, path, messages=()):
+        """
+        Write the rows to a cache file at path, with the (level, message)
+        pairs that were logged while they were read.
+        """
+
+        header = json.dumps({'date': self.date, 'messages': list(messages)})
+        offsets = array.array(INT_TYPE, [0])
+        for string in self.strings:
+            offsets.append(offsets[-1] + len(string))
+        text = u"".join(self.strings).encode('utf-8')
+        directory = os.path.dirname(path) or "."
+        fd, temp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                prefix = PREFIX.pack(MAGIC, VERSION, INT_SIZE, BYTE_ORDER,
+                    len(self), len(self.strings), len(header), len(text))
+                sections = [prefix, header, offsets.tostring(), text]
+                for name, kind in COLUMNS:
+                    sections.append(self.columns[name].tostring())
+                for data in sections:
+                    f.write(data)
+                    f.write("\0" * padding(len(data)))
+            os.rename(temp, path)
+        except:
+            os.unlink(temp)
+            raise
+
+class CachedReport(object):
+    """A cache file, memory-mapped, giving back the rows it was written with"""
+
+    def __init__(self, path):
+        """
+        Map the cache file at path. Raises ValueError if it is not a cache
+        file that this machine can use.
+        """
+
+        self.path = path
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < PREFIX.size:
+                raise ValueError("%s: not a cache file" % path)
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._read_layout(size)
+        except:
+            self.map.close()
+            raise
+        self._strings = None
+
+    def _read_layout(self, size):
+        """Check the prefix and header, and find where each section starts"""
+
+        path = self.path
+        (magic, version, int_size, byte_order, self.rows, strings,
+            header_size, text_size) = PREFIX.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s: not a cache file of version %d" % (path, VERSION))
+        if int_size != INT_SIZE or byte_order != BYTE_ORDER:
+            raise ValueError("%s: written with different integers" % path)
+        # Where each section starts
+        sizes = [header_size, (strings + 1) * INT_SIZE, text_size]
+        for name, kind in COLUMNS:
+            sizes.append(self.rows * array.array(kind).itemsize)
+        self.sections = []
+        offset = PREFIX.size + padding(PREFIX.size)
+        for section_size in sizes:
+            self.sections.append((offset, section_size))
+            offset += section_size + padding(section_size)
+        if offset > size:
+            raise ValueError("%s: cache file is cut short" % path)
+        header = json.loads(self._bytes(0))
+        self.date = header['date']
+        self.messages = [(level, message) for level, message in header['messages']]
+        self.string_count = strings
+
+    def _bytes(self, section):
+        """The contents of a section, as a string"""
+
+        offset, size = self.sections[section]
+        return self.map[offset:offset + size]
+
+    def __len__(self):
+        return self.rows
+
+    def strings(self):
+        """The dictionary of ad group and ad name strings, decoded once"""
+
+        if self._strings is None:
+            offsets = array.array(INT_TYPE)
+            offsets.fromstring(self._bytes(1))
+            text = self._bytes(2).decode('utf-8')
+            self._strings = [text[offsets[i]:offsets[i + 1]]
+                for i in xrange(self.string_count)]
+        return self._strings
+
+    def column(self, name):
+        """
+        One of the columns, by its AdBatch name. With NumPy this is an array
+        over the mapped file itself; otherwise it is an array.array copy.
+        """
+
+        for index, (column, kind) in enumerate(COLUMNS):
+            if column == name:
+                break
+        else:
+            raise KeyError(name)
+        offset, size = self.sections[3 + index]
+        if numpy is not None:
+            return numpy.frombuffer(self.map, numpy.dtype(kind), self.rows, offset)
+        values = array.array(kind)
+        values.fromstring(self.map[offset:offset + size])
+        return values
+
+    def _lists(self):
+        """The columns, as lists, with the strings looked up"""
+
+        strings = self.strings()
+        columns = []
+        for name, kind in COLUMNS:
+            values = self.column(name).tolist()
+            if kind == CODE_TYPE:
+                values = [strings[number] for number in values]
+            columns.append(values)
+        return columns
+
+    def ad_infos(self):
+        """Iterate over the rows as AdInfo objects"""
+
+        date = self.date
+        for ad_group, ad_name, impressions, clicks, cents in zip(*self._lists()):
+            yield make_ad_info(date, ad_group, ad_name, impressions, clicks, cents)
+
+    def batches(self, size=10000):
+        """Iterate over the rows as AdBatch objects of up to size rows"""
+
+        columns = self._lists()
+        for start in xrange(0, self.rows, size):
+            batch = AdBatch()
+            end = min(start + size, self.rows)
+            batch.dates = [self.date] * (end - start)
+            batch.ad_groups = columns[0][start:end]
+            batch.ad_names = columns[1][start:end]
+            for name, values in zip(('impressions', 'clicks', 'total_cost_in_cents'),
+                    columns[2:]):
+                getattr(batch, name).extend(values[start:end])
+            yield batch
+
+    def close(self):
+        """Release the map"""
+
+        self.map.close()
+
+def file_digest(path):
+    """The SHA-1 hex digest of the contents of the file at path"""
+
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(HASH_BLOCK)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+def write_atomically(path, data):
+    """Write data to a file at path, by way of a temporary file"""
+
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(temp, path)
+    except:
+        os.unlink(temp)
+        raise
+
+class ReportCache(object):
+    """A directory of cache files for reports"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.hits = 0
+        self.misses = 0
+
+    def content_digest(self, path):
+        """
+        The digest of the report at path, from its stamp if its size and
+        modification time are those stamped, and otherwise worked out and
+        stamped.
+        """
+
+        stat = os.stat(path)
+        stamp_path = os.path.join(self.directory, "%s.stamp" % hashlib.sha1(
+            os.path.abspath(path)).hexdigest())
+        try:
+            with open(stamp_path, "rb") as f:
+                stamp = json.load(f)
+            if stamp['size'] == stat.st_size and stamp['mtime'] == stat.st_mtime:
+                return stamp['sha1']
+        except (IOError, ValueError, KeyError):
+            pass
+        digest = file_digest(path)
+        write_atomically(stamp_path, json.dumps({'size': stat.st_size,
+            'mtime': stat.st_mtime, 'sha1': digest}))
+        return digest
+
+    def entry_path(self, path, args, mapped=False):
+        """
+        The path of the cache file for the report at path, read with the
+        options in args, and memory-mapped if mapped is set.
+        """
+
+        options = [path, bool(mapped)] + [getattr(args, name, None)
+            for name in KEY_OPTIONS]
+        return os.path.join(self.directory, "%s-%s.adc" % (self.content_digest(path),
+            hashlib.sha1(json.dumps(options)).hexdigest()[:16]))
+
+    def lookup(self, path, args, mapped=False):
+        """The CachedReport for the report at path, or None if there is none"""
+
+        entry = self.entry_path(path, args, mapped)
+        if not os.path.exists(entry):
+            self.misses += 1
+            return None
+        try:
+            report = CachedReport(entry)
+        except (ValueError, KeyError, TypeError, EnvironmentError, struct.error):
+            # From another version, or damaged: it will be written again
+            self.misses += 1
+            return None
+        self.hits += 1
+        return report
+
+def replay(report, produce=None, produce_batch=None, args=(), batch_size=10000):
+    """
+    Log the messages of a CachedReport, and pass its rows to produce (or
+    produce_batch) as an AdDataReader would.
+    """
+
+    for level, message in report.messages:
+        logging.log(level, message)
+    if produce_batch is not None:
+        first = True
+        for batch in report.batches(batch_size):
+            produce_batch(batch, first=first, args=args)
+            first = False
+    else:
+        first = True
+        for ad_info in report.ad_infos():
+            produce(ad_info, first=first, args=args)
+            first = False
+
+def process_cached(path, args, parse, produce=None, produce_batch=None,
+        batch_size=10000, mapped=False, context=None):
+    """
+    Produce the rows of the report at path from the cache in args.cache_dir
+    if they are there. Otherwise call parse with produce (or produce_batch),
+    wrapped so that the rows are recorded, and cache them if it returns.
+    Rows from the cache are produced with the producer args (context,), or
+    none if context is None. Set mapped as it is passed to make_reader by
+    parse, as a memory-mapped report is logged with byte offsets. Returns
+    True if the cache was used.
+    """
+
+    cache = ReportCache(args.cache_dir)
+    mapped = admetrics.reads_mapped(path, args, mapped)
+    report = cache.lookup(path, args, mapped)
+    if report is not None:
+        try:
+            replay(report, produce, produce_batch,
+                (context,) if context is not None else (), batch_size)
+        finally:
+            report.close()
+        return True
+    writer = CacheWriter()
+    if produce_batch is not None:
+        def recording(batch, first=False, args=None):
+            writer.add_batch(batch)
+            produce_batch(batch, first=first, args=args)
+    else:
+        def recording(ad_info, first=False, args=None):
+            writer.add(ad_info)
+            produce(ad_info, first=first, args=args)
+    recorder = CapturingHandler()
+    root = logging.getLogger()
+    if not root.handlers:
+        # As the first message logged would, so that the recorder is not
+        # taken for the only handler
+        logging.basicConfig()
+    root.addHandler(recorder)
+    try:
+        parse(recording)
+    finally:
+        root.removeHandler(recorder)
+    writer.write(cache.entry_path(path, args, mapped), recorder.messages)
+    return False
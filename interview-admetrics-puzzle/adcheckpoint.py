@@ -0,0 +1,195 @@
+#!/usr/bin/python
+
+# Checkpoints for resuming an AdDataReader part way through a file.
+#
+# Every so many rows, the reader's progress is saved: the byte offset of
+# the next line, the line number, the running totals, the number of rows
+# produced so far, the state of the duplicate record checks, the warning
+# counts and the length of the quarantine file, if there is one. If the
+# run then stops on a bad row, a second run with the same checkpoint
+# picks up from the last save instead of reading the whole file again.
+#
+# The progress is written as JSON to a temporary file that is renamed over
+# the checkpoint, so a checkpoint is always complete. The duplicate checks
+# can hold a great many keys, so only the digests of the keys added since
+# the previous save are written each time, appended to a second file
+# (path + ".keys") whose length at the time of the save is recorded in the
+# checkpoint. A checkpoint is removed once its file has been read to the
+# end.
+#
+# A checksum of the file up to the saved offset is kept too, built up a
+# piece at a time as the saves are made, so that resuming from a file that
+# has been changed before that point is refused.
+#
+# Before each save, rows held back in a batch are passed on and the flush
+# callback is called, so that everything up to the saved offset has been
+# dealt with. Rows produced after the last save by a run that fails will
+# be produced again when it is resumed; rows quarantined after it are cut
+# from the quarantine file (which must be opened for appending, as
+# admetrics does when there is a checkpoint to resume from) and rejected
+# again.
+
+import os
+import zlib
+import json
+
+# Size of the pieces that the mapped file is checksummed in
+CRC_CHUNK = 8 * 1024 * 1024
+
+def crc_range(data, start, end, crc=0):
+    """Continue a CRC-32 of data over data[start:end]"""
+
+    while start < end:
+        stop = min(start + CRC_CHUNK, end)
+        crc = zlib.crc32(data[start:stop], crc)
+        start = stop
+    return crc
+
+class Checkpoint(object):
+    """Periodic saving and resuming of a reader's progress through a file"""
+
+    # Version 2 keeps the total cost in cents, version 3 the warning counts
+    # and quarantine file length
+    VERSION = 3
+
+    def __init__(self, path, every=100000, deduper=None, flush=None):
+        """
+        Keep the checkpoint at path, saving it every so many data rows. The
+        keys of deduper, if given, are saved along with it, and flush is
+        called, if given, before each save.
+        """
+
+        self.path = path
+        self.keys_path = path + ".keys"
+        self.every = every
+        self.deduper = deduper
+        self.flush = flush
+        self.next_save = every
+        # The checksum of the file up to crc_offset
+        self.crc = 0
+        self.crc_offset = 0
+        if deduper is not None:
+            deduper.start_journal()
+
+    def resume(self, reader):
+        """
+        Move reader, which has just read its header, on to where the saved
+        checkpoint left off, if there is one. Returns True if it resumed.
+        """
+
+        if not os.path.exists(self.path):
+            # Any keys are left from a run that stopped before its first save
+            if os.path.exists(self.keys_path):
+                os.remove(self.keys_path)
+            return False
+        with open(self.path, "r") as f:
+            state = json.load(f)
+        source = reader.source
+        problem = self._check(reader, state)
+        if problem is not None:
+            reader._fatal("While resuming from checkpoint %s" % self.path, problem)
+        source.pos = state['offset']
+        reader.lineno = state['lineno']
+        reader.accumulator = state['accumulator']
+        reader.produced = state['produced']
+        reader.first_batch = reader.produced == 0
+        diagnostics = reader.diagnostics
+        diagnostics.counts = state['warnings']['counts']
+        diagnostics.shown = state['warnings']['shown']
+        if reader.quarantine is not None:
+            reader.quarantine.restore(state['quarantine'], state['quarantined'])
+        if self.deduper is not None:
+            self._restore_keys(reader.date, state['keys_length'])
+        self.crc = state['crc']
+        self.crc_offset = state['offset']
+        self.next_save = reader.produced + self.every
+        return True
+
+    def _check(self, reader, state):
+        """Return why the saved state does not fit reader, or None if it does"""
+
+        source = reader.source
+        if state.get('version') != self.VERSION:
+            return "unknown checkpoint version, %r" % state.get('version')
+        # Checked by attribute, since admetrics may be running as __main__
+        if getattr(source, 'map', None) is None:
+            return "resuming needs a memory-mapped input file"
+        if state['date'] != reader.date or state['colnames'] != reader.colnames:
+            return "the report header has changed"
+        offset = state['offset']
+        if offset > source.end or crc_range(source.map, 0, offset) != state['crc']:
+            return "the report has changed before byte %d" % offset
+        dedup = state.get('dedup')
+        mode = getattr(self.deduper, 'mode', None)
+        if dedup != mode:
+            return "duplicate checks were '%s' but are now '%s'" % (dedup, mode)
+        return None
+
+    def _restore_keys(self, date, length):
+        """Put back the deduper's keys, dropping any saved after the checkpoint"""
+
+        with open(self.keys_path, "r+b") as f:
+            f.truncate(length)
+            digests = []
+            while True:
+                digest = f.read(16)
+                if len(digest) < 16:
+                    break
+                digests.append(digest)
+        self.deduper.restore(date, digests)
+
+    def maybe_save(self, reader):
+        """Save the checkpoint if enough rows have been produced since the last"""
+
+        if reader.produced >= self.next_save:
+            self.save(reader)
+
+    def save(self, reader):
+        """Save reader's progress, which must be at the end of a data row"""
+
+        reader._flush_batch()
+        if self.flush is not None:
+            self.flush()
+        keys_length = None
+        if self.deduper is not None:
+            with open(self.keys_path, "ab") as f:
+                f.write("".join(self.deduper.take_journal()))
+                f.flush()
+                os.fsync(f.fileno())
+                keys_length = f.tell()
+        quarantine = reader.quarantine
+        source = reader.source
+        offset = source.pos
+        self.crc = crc_range(source.map, self.crc_offset, offset, self.crc)
+        self.crc_offset = offset
+        state = {
+            'version': self.VERSION,
+            'source': source.name,
+            'offset': offset,
+            'crc': self.crc,
+            'lineno': reader.lineno,
+            'date': reader.date,
+            'colnames': reader.colnames,
+            'accumulator': reader.accumulator,
+            'produced': reader.produced,
+            'dedup': getattr(self.deduper, 'mode', None),
+            'keys_length': keys_length,
+            'warnings': {'counts': reader.diagnostics.counts,
+                'shown': reader.diagnostics.shown},
+            'quarantine': None if quarantine is None else quarantine.tell(),
+            'quarantined': 0 if quarantine is None else quarantine.count,
+        }
+        temp = self.path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp, self.path)
+        self.next_save = reader.produced + self.every
+
+    def finish(self):
+        """Remove the checkpoint once the whole file has been read"""
+
+        for path in (self.path, self.keys_path):
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,381 @@
+#!/usr/bin/python
+
+# Reading compressed report files without decompressing them to disk.
+#
+# Files compressed with gzip, bzip2 or xz are recognized by their first
+# few bytes, whatever they are called, and decompressed as they are read,
+# a large block at a time. Files made of several compressed streams one
+# after another (as pigz, pbzip2 and cat produce) are read in full, and
+# input that ends part way through a stream is an error rather than a
+# short report. xz needs the lzma module, which is not in the standard
+# library for this version of Python (backports.lzma provides it).
+#
+# Damaged compressed data, and xz input without the lzma module, raise a
+# CompressedInputError as the input is read, so that a reader can report
+# them as it reports any other bad input.
+#
+# Compressed input is decoded to text a block at a time too (see
+# open_text), rather than by a codecs reader, which would drop the text it
+# had decoded when the input turned out to be cut short. Instead,
+# everything before the problem is read before the error is raised, so
+# that it is reported after the last line that could be read.
+#
+# The decompression can also be done in a background thread, a few blocks
+# ahead of the parsing. zlib and bz2 let go of the interpreter lock while
+# they work, so on a machine with more than one CPU the two overlap.
+
+import zlib
+import bz2
+import Queue
+import codecs
+import threading
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# Compressed bytes to read at a time
+BLOCK_SIZE = 1024 * 1024
+
+# The first bytes of each kind of compressed file
+MAGIC = (
+    ('gzip', "\x1f\x8b"),
+    ('bz2', "BZh"),
+    ('xz', "\xfd7zXZ\x00"),
+)
+# A bzip2 file's magic is followed by its block size, as a digit from 1
+# to 9, without which "BZh" could be the start of a line of text
+BZ2_BLOCK_SIZES = "123456789"
+MAGIC_SIZE = max(len(magic) for kind, magic in MAGIC)
+
+# The errors that decompressors raise for damaged data
+if lzma is not None:
+    DATA_ERRORS = (zlib.error, IOError, lzma.LZMAError)
+else:
+    DATA_ERRORS = (zlib.error, IOError)
+
+class CompressedInputError(IOError):
+    """Compressed input that cannot be read: damaged, cut short, or unsupported"""
+
+def detect(head):
+    """Return the kind of compression that head starts with, or None"""
+
+    for kind, magic in MAGIC:
+        if head.startswith(magic):
+            if kind == 'bz2' and (len(head) <= len(magic) or
+                    head[len(magic)] not in BZ2_BLOCK_SIZES):
+                continue
+            return kind
+    return None
+
+def compression_of(path):
+    """Return the kind of compression of the file at path, or None"""
+
+    with open(path, "rb") as f:
+        return detect(f.read(MAGIC_SIZE))
+
+def make_decompressor(kind):
+    """Return a new decompressor for one stream of the given kind"""
+
+    if kind == 'gzip':
+        # The gzip header and trailer are handled (and checked) by zlib
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if kind == 'bz2':
+        return bz2.BZ2Decompressor()
+    if kind == 'xz':
+        if lzma is None:
+            raise ValueError("Reading xz input needs the lzma module")
+        return lzma.LZMADecompressor()
+    raise ValueError("Unknown compression: '%s'" % kind)
+
+def stream_ended(decompressor):
+    """True if decompressor has seen the whole of its stream"""
+
+    eof = getattr(decompressor, 'eof', None)
+    if eof is not None:
+        return eof
+    # zlib and bz2 do not say here, but once the stream has ended, zlib
+    # sets any more data aside as unused and bz2 refuses it
+    try:
+        decompressor.decompress("\0")
+    except EOFError:
+        return True
+    except (zlib.error, IOError):
+        return False
+    return len(decompressor.unused_data) > 0
+
+class BlockFile(object):
+    """
+    A read-only file object over data that comes in blocks, from
+    next_block, a function that returns an empty string at the end.
+    """
+
+    def __init__(self, name, next_block, head=""):
+        self.name = name
+        self.next_block = next_block
+        # The data not yet read is self.buffer[self.pos:]
+        self.buffer = head
+        self.pos = 0
+        self.ended = False
+        # A CompressedInputError held back until the data before it is read
+        self.error = None
+
+    def _fill(self):
+        """Add the next block to the buffer, returning False at the end"""
+
+        if self.ended:
+            if self.pos >= len(self.buffer):
+                self._raise_error()
+            return False
+        try:
+            block = self.next_block()
+        except CompressedInputError as e:
+            # The data before the problem is read first, so that it is
+            # reported where it comes in the input
+            self.error = e
+            self.ended = True
+            if self.pos >= len(self.buffer):
+                self._raise_error()
+            return False
+        if not block:
+            self.ended = True
+            return False
+        self.buffer = self.buffer[self.pos:] + block
+        self.pos = 0
+        return True
+
+    def _raise_error(self):
+        """Raise the error held back by _fill, if there is one"""
+
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    def read(self, size=-1):
+        """Return up to size bytes, or the rest of the data"""
+
+        if size is None or size < 0:
+            while self._fill():
+                pass
+            # The rest of the data cannot all be read
+            self._raise_error()
+            data = self.buffer[self.pos:]
+            self.buffer = ""
+            self.pos = 0
+            return data
+        while len(self.buffer) - self.pos < size and self._fill():
+            pass
+        data = self.buffer[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def readline(self, size=-1):
+        """Return the next line, including its newline"""
+
+        start = self.pos
+        while True:
+            newline = self.buffer.find("\n", start)
+            if newline >= 0:
+                end = newline + 1
+                break
+            start = len(self.buffer) - self.pos
+            if not self._fill():
+                # A line cut short by an error is not returned
+                self._raise_error()
+                end = len(self.buffer)
+                break
+            # The buffer now starts where this line does
+        if size is not None and 0 <= size < end - self.pos:
+            end = self.pos + size
+        line = self.buffer[self.pos:end]
+        self.pos = end
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, "")
+
+    def close(self):
+        pass
+
+class PlainFile(BlockFile):
+    """A file object for uncompressed data, some of which has been read"""
+
+    def __init__(self, raw, head="", block_size=BLOCK_SIZE):
+        BlockFile.__init__(self, getattr(raw, 'name', '<input>'),
+            lambda: raw.read(block_size), head)
+        self.raw = raw
+
+    def close(self):
+        self.raw.close()
+
+class DecompressedFile(BlockFile):
+    """A file object giving the decompressed contents of a compressed file"""
+
+    def __init__(self, raw, kind, head="", block_size=BLOCK_SIZE):
+        """
+        Decompress what is read from raw, a file object, block_size bytes at
+        a time. Any bytes of it that have already been read are given in
+        head.
+        """
+
+        BlockFile.__init__(self, getattr(raw, 'name', '<input>'),
+            self._decompress_block)
+        self.raw = raw
+        self.kind = kind
+        self.block_size = block_size
+        # Made at the first read, so that a missing module is reported as
+        # bad input is
+        self.decompressor = None
+        self.pending = head
+
+    def _new_decompressor(self):
+        """Start on the next stream of the input"""
+
+        try:
+            self.decompressor = make_decompressor(self.kind)
+        except ValueError as e:
+            raise CompressedInputError("%s: %s" % (self.name, e))
+
+    def _decompress_block(self):
+        """Return the next block of decompressed data"""
+
+        if self.decompressor is None:
+            self._new_decompressor()
+        while True:
+            data = self.pending or self.raw.read(self.block_size)
+            self.pending = ""
+            if not data:
+                if not stream_ended(self.decompressor):
+                    raise CompressedInputError("%s: %s input ends part way through" %
+                        (self.name, self.kind))
+                return ""
+            try:
+                out = self.decompressor.decompress(data)
+            except EOFError:
+                # The stream ended with the last block and another follows
+                out = ""
+                self._new_decompressor()
+                self.pending = data
+                continue
+            except DATA_ERRORS as e:
+                raise CompressedInputError("%s: damaged %s input: %s" % (
+                    self.name, self.kind, e))
+            if self.decompressor.unused_data:
+                self.pending = self.decompressor.unused_data
+                self._new_decompressor()
+            if out:
+                return out
+
+    def close(self):
+        self.raw.close()
+
+class BackgroundFile(BlockFile):
+    """
+    A file object that reads the blocks of another BlockFile in a
+    background thread, up to depth blocks ahead.
+    """
+
+    def __init__(self, inner, depth=4):
+        BlockFile.__init__(self, inner.name, self._take_block)
+        self.inner = inner
+        self.blocks = Queue.Queue(depth)
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        """Read blocks into the queue until the end, or an error"""
+
+        try:
+            while not self.stopping:
+                block = self.inner.next_block()
+                self.blocks.put((block, None))
+                if not block:
+                    return
+        except Exception as e:
+            self.blocks.put(("", e))
+
+    def _take_block(self):
+        """Return the next block read by the thread"""
+
+        block, error = self.blocks.get()
+        if error is not None:
+            raise error
+        return block
+
+    def close(self):
+        self.stopping = True
+        # Make room for the thread to notice
+        while self.thread.is_alive():
+            try:
+                self.blocks.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        self.inner.close()
+
+class TextFile(BlockFile):
+    """
+    A file object giving the text of another BlockFile, decoded from the
+    given encoding a block at a time.
+    """
+
+    def __init__(self, inner, encoding, block_size=BLOCK_SIZE):
+        BlockFile.__init__(self, inner.name, self._decode_block, u"")
+        self.inner = inner
+        self.block_size = block_size
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+
+    def _decode_block(self):
+        """Return the next block of decoded text"""
+
+        while True:
+            data = self.inner.read(self.block_size)
+            text = self.decoder.decode(data, not data)
+            if text or not data:
+                return text
+
+    def close(self):
+        self.inner.close()
+
+def open_input(path, threaded=False, block_size=BLOCK_SIZE):
+    """
+    Open a report for reading, given its path or an open binary file object
+    (such as sys.stdin). Compressed input is decompressed as it is read,
+    in a background thread if threaded is set. Plain files that are opened
+    by path are returned as they are.
+    """
+
+    if isinstance(path, basestring):
+        raw = open(path, "rb")
+        kind = detect(raw.read(MAGIC_SIZE))
+        raw.seek(0)
+        if kind is None:
+            return raw
+        head = ""
+    else:
+        raw = path
+        head = raw.read(MAGIC_SIZE)
+        kind = detect(head)
+    if kind is None:
+        return PlainFile(raw, head, block_size)
+    result = DecompressedFile(raw, kind, head, block_size)
+    if threaded:
+        result = BackgroundFile(result)
+    return result
+
+def open_text(path, encoding, threaded=False, block_size=BLOCK_SIZE):
+    """
+    Open a report for reading as text in the given encoding, as open_input
+    opens it. Plain files opened by path are read with a codecs reader.
+    """
+
+    inputfile = open_input(path, threaded, block_size)
+    if isinstance(inputfile, BlockFile):
+        return TextFile(inputfile, encoding, block_size)
+    return codecs.getreader(encoding)(inputfile)
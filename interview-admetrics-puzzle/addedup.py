@@ -0,0 +1,341 @@
+#!/usr/bin/python
+
+# Duplicate record detection for the admetrics module.
+#
+# Each output record has a key made of its report date, ad group and ad
+# name, and a key may only be seen once. Two ways of checking are given:
+#
+# * ExactDeduper keeps the MD5 digest of every key, in a set for each
+#   report date, rather than the key text itself.
+# * BloomDeduper keeps a Bloom filter sized for an expected number of keys
+#   and false positive rate, so its memory use is fixed up front. The keys
+#   themselves go to a temporary SQLite database on disk, which is only
+#   consulted when the filter says a key may have been seen before.
+#
+# Both give the same answers; they differ only in how much memory and time
+# they take, which their stats() report. Within a run, ExactDeduper can be
+# given an integer for each key from an adsymbols.SymbolTable, and keeps
+# that instead of the digest, which is smaller and needs no hashing.
+#
+# A deduper can also keep a journal of the digests of the keys added since
+# it was last asked for them, so that its state can be saved as it goes
+# (see adcheckpoint) and put back with restore().
+#
+# The keys of a whole input can also be added at once with add_all, which
+# adds none of them if any has been seen before, so that an input that is
+# turned away for a duplicate (see adparallel) leaves nothing behind. A
+# KeyRecorder, put in front of the deduper that checks an input on its
+# own, collects the keys to be added.
+#
+# The keys of a report date are kept until forget() is called for it, once
+# all the inputs with that date are done, so that a long run over many
+# dates only holds the keys of those still to come. BloomDeduper cannot
+# take bits out of its filter, but drops the date's keys from its store,
+# and clears the filter once no date is left in it.
+
+import sys
+import math
+import struct
+import hashlib
+import sqlite3
+
+def key_digest(key):
+    """Return the 16-byte MD5 digest of a Unicode key"""
+
+    return hashlib.md5(key.encode('utf-8')).digest()
+
+class Deduper(object):
+    """The journal handling common to the dedupers"""
+
+    journal = None
+
+    def start_journal(self):
+        """Journal the digests of the keys added from now on"""
+
+        self.journal = []
+
+    def take_journal(self):
+        """Return the digests journalled since the last call, and clear them"""
+
+        digests = self.journal
+        self.journal = []
+        return digests
+
+class ExactDeduper(Deduper):
+    """Duplicate detection holding a digest of every key, by report date"""
+
+    mode = 'exact'
+
+    def __init__(self):
+        self.dates = {}
+        self.keys = 0
+        self.duplicates = 0
+
+    def add(self, date, key, symbol=None):
+        """
+        Record key for date. Returns False if it has been seen before. A
+        symbol is an integer that stands for key within this run (see
+        adsymbols), which is kept instead of its digest, unless a journal
+        is being kept, as journals outlive the run.
+        """
+
+        digests = self.dates.get(date)
+        if digests is None:
+            digests = self.dates[date] = set()
+        if symbol is not None and self.journal is None:
+            digest = symbol
+        else:
+            digest = key_digest(key)
+        if digest in digests:
+            self.duplicates += 1
+            return False
+        digests.add(digest)
+        self.keys += 1
+        if self.journal is not None:
+            self.journal.append(digest)
+        return True
+
+    def add_all(self, date, keys):
+        """
+        Record the distinct keys for date, unless one of them has been seen
+        before. Returns that key, or None if they were all recorded.
+        """
+
+        seen = self.dates.setdefault(date, set())
+        digests = [key_digest(key) for key in keys]
+        for key, digest in zip(keys, digests):
+            if digest in seen:
+                self.duplicates += 1
+                return key
+        seen.update(digests)
+        self.keys += len(digests)
+        if self.journal is not None:
+            self.journal.extend(digests)
+        return None
+
+    def restore(self, date, digests):
+        """Put back the journalled digests of keys added for date"""
+
+        seen = self.dates.setdefault(date, set())
+        before = len(seen)
+        seen.update(digests)
+        self.keys += len(seen) - before
+
+    def forget(self, date):
+        """Drop the keys for a report date that will not be seen again"""
+
+        digests = self.dates.pop(date, ())
+        self.keys -= len(digests)
+
+    def stats(self):
+        """Return a dict of counts and approximate memory use in bytes"""
+
+        memory = sys.getsizeof(self.dates)
+        for digests in self.dates.values():
+            memory += sys.getsizeof(digests)
+            for digest in digests:
+                memory += sys.getsizeof(digest)
+        return {'mode': 'exact', 'keys': self.keys, 'duplicates': self.duplicates,
+            'memory': memory}
+
+class BloomDeduper(Deduper):
+    """
+    Duplicate detection in bounded memory, with a Bloom filter in front of
+    an on-disk store of the keys.
+    """
+
+    mode = 'bloom'
+
+    # Keys waiting to be written to the store are sent in batches this big
+    SPILL_BATCH = 10000
+
+    def __init__(self, capacity=1000000, fp_rate=0.001, path=""):
+        """
+        Size the filter for capacity keys at a false positive rate of
+        fp_rate. More keys than that can be added, but the filter will pass
+        more of them on to the store. The store is a SQLite database at path,
+        by default a temporary file that goes away when it is closed.
+        """
+
+        if capacity < 1:
+            raise ValueError("Bloom filter capacity must be at least 1")
+        if not 0 < fp_rate < 1:
+            raise ValueError("False positive rate must be between 0 and 1")
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.bits = int(math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(float(self.bits) / capacity * math.log(2))))
+        self.filter = bytearray((self.bits + 7) // 8)
+        self.store = sqlite3.connect(path)
+        self.store.execute(
+            "CREATE TABLE IF NOT EXISTS seen (digest BLOB PRIMARY KEY, date TEXT)"
+            " WITHOUT ROWID")
+        # The digests of keys not yet in the store, with their dates
+        self.pending = {}
+        self.keys = 0
+        self.duplicates = 0
+        self.maybe = 0
+        self.false_positives = 0
+
+    def add(self, date, key, symbol=None):
+        """
+        Record key for date. Returns False if it has been seen before. Any
+        symbol for key is not used, as the filter needs its digest anyway.
+        """
+
+        digest = key_digest(date + u"," + key)
+        if self._set_bits(digest):
+            self.maybe += 1
+            if self._stored(digest):
+                self.duplicates += 1
+                return False
+            self.false_positives += 1
+        self._store(digest, date)
+        self.keys += 1
+        if self.journal is not None:
+            self.journal.append(digest)
+        return True
+
+    def add_all(self, date, keys):
+        """
+        Record the distinct keys for date, unless one of them has been seen
+        before. Returns that key, or None if they were all recorded.
+        """
+
+        digests = [key_digest(date + u"," + key) for key in keys]
+        for key, digest in zip(keys, digests):
+            if self._set_bits(digest, False):
+                self.maybe += 1
+                if self._stored(digest):
+                    self.duplicates += 1
+                    return key
+                self.false_positives += 1
+        for digest in digests:
+            self._set_bits(digest)
+            self._store(digest, date)
+        self.keys += len(digests)
+        if self.journal is not None:
+            self.journal.extend(digests)
+        return None
+
+    def restore(self, date, digests):
+        """Put back the journalled digests of keys added for date"""
+
+        for digest in digests:
+            if self._set_bits(digest) and self._stored(digest):
+                continue
+            self._store(digest, date)
+            self.keys += 1
+
+    def forget(self, date):
+        """Drop the keys for a report date that will not be seen again"""
+
+        for digest, day in self.pending.items():
+            if day == date:
+                del self.pending[digest]
+                self.keys -= 1
+        self.keys -= self.store.execute("DELETE FROM seen WHERE date = ?",
+            (date,)).rowcount
+        self.store.commit()
+        if self.keys == 0:
+            self.filter = bytearray(len(self.filter))
+
+    def _set_bits(self, digest, update=True):
+        """
+        Set the filter bits for digest (only check them, unless update is
+        set), returning True if all were set.
+        """
+
+        # The bit positions come from the digest by double hashing
+        position, step = struct.unpack("<QQ", digest)
+        size = self.bits
+        bits = self.filter
+        maybe = True
+        for i in xrange(self.hashes):
+            position = (position + step) % size
+            byte = position >> 3
+            mask = 1 << (position & 7)
+            if not bits[byte] & mask:
+                maybe = False
+                if not update:
+                    break
+                bits[byte] |= mask
+        return maybe
+
+    def _store(self, digest, date):
+        """Add digest to the keys, to be written to the store in due course"""
+
+        self.pending[digest] = date
+        if len(self.pending) >= self.SPILL_BATCH:
+            self._spill()
+
+    def _stored(self, digest):
+        """True if digest has been added, checking the store if need be"""
+
+        if digest in self.pending:
+            return True
+        return self.store.execute("SELECT 1 FROM seen WHERE digest = ?",
+            (buffer(digest),)).fetchone() is not None
+
+    def _spill(self):
+        """Write the pending keys to the store"""
+
+        self.store.executemany("INSERT INTO seen VALUES (?, ?)",
+            ((buffer(digest), date) for digest, date in self.pending.iteritems()))
+        self.store.commit()
+        self.pending = {}
+
+    def close(self):
+        """Release the store"""
+
+        self.store.close()
+
+    def stats(self):
+        """Return a dict of counts and approximate memory use in bytes"""
+
+        memory = sys.getsizeof(self.filter) + sys.getsizeof(self.pending)
+        for digest in self.pending:
+            memory += sys.getsizeof(digest)
+        return {'mode': 'bloom', 'keys': self.keys, 'duplicates': self.duplicates,
+            'memory': memory, 'filter_bits': self.bits, 'hashes': self.hashes,
+            'maybe_seen': self.maybe, 'false_positives': self.false_positives,
+            'spilled': self.keys - len(self.pending)}
+
+class KeyRecorder(object):
+    """
+    A stand-in for a deduper that passes keys on to it, and keeps the ones
+    it accepts, and their report date.
+    """
+
+    def __init__(self, deduper):
+        self.deduper = deduper
+        self.date = None
+        self.keys = []
+
+    def add(self, date, key, symbol=None):
+        """Record key for date, as the deduper does"""
+
+        if not self.deduper.add(date, key, symbol):
+            return False
+        self.date = date
+        self.keys.append(key)
+        return True
+
+DEDUPERS = {
+    'exact': ExactDeduper,
+    'bloom': BloomDeduper,
+}
+
+def make_deduper(mode='exact', capacity=1000000, fp_rate=0.001):
+    """Return a new deduper of the given mode ('exact' or 'bloom')"""
+
+    if mode == 'bloom':
+        return BloomDeduper(capacity, fp_rate)
+    if mode == 'exact':
+        return ExactDeduper()
+    raise ValueError("Unknown dedup mode: '%s'" % mode)
+
+def format_stats(stats):
+    """Return deduper stats as a one-line summary"""
+
+    return ", ".join("%s=%s" % (name, stats[name]) for name in sorted(stats))
@@ -0,0 +1,341 @@
+#!/usr/bin/python
+
+# A persistent index of the rows of many days' reports, for lookups by date
+# and by ad group or ad name.
+#
+# The index is a SQLite database that is filled in as reports are read
+# (see the --index option of admetrics). Its rows are kept in the
+# ad_report_data table that adsqlite loads, through the same
+# SQLiteLoader, so an index is also a database of the reports' rows. On
+# top of that, it keeps the path, report date, size and modification time
+# of each input file, and, for each row, its location: the file it came
+# from, its place among that file's data rows, and the byte offset where
+# it starts, when the file was read through a MappedSource (compressed
+# input, and rows replayed from an adcache cache, have none). The rows
+# are indexed by date (the table's primary key), and by ad group and by
+# ad name within date, so a query such as "all rows for ad group X in
+# March" is answered from the pages of the index that cover it, without
+# reading any reports again.
+#
+# The rows of an input file are collected by a FileEntries, a producer
+# like an adaggregate.Aggregator. One made by ReportIndex.entries stores
+# them as they come, in a transaction for each BATCH_SIZE rows, and is
+# finished once the whole file has been read without error, or discarded,
+# taking what was stored with it, if it fails. One made on its own (in a
+# worker process, say) holds its rows until ReportIndex.store is given it.
+# Indexing a file again replaces what was stored for it before. As in
+# adsqlite, a row has one place in the index whichever file gave it, so a
+# row that a later file gives again moves to that file.
+#
+# Run as a program, this queries an index, for example:
+#
+#   ./adindex.py ads.idx --ad-group honda --from 2011-03-01 --to 2011-03-31
+#
+# The rows are written as admetrics writes its output, optionally with the
+# location of each one.
+
+import os
+import sys
+import argparse
+import itertools
+
+import adsqlite
+import admetrics
+from admetrics import AdBatch, csv_string
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    report_date DATE,
+    rows INT NOT NULL,
+    size INT NOT NULL,
+    mtime REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS locations (
+    report_date DATE NOT NULL,
+    ad_group VARCHAR(255) NOT NULL,
+    ad_name VARCHAR(255) NOT NULL,
+    file_id INT NOT NULL REFERENCES files(id),
+    row INT NOT NULL,
+    offset INT,
+    PRIMARY KEY(report_date, ad_group, ad_name)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ad_report_data_by_group
+    ON ad_report_data (ad_group, report_date);
+CREATE INDEX IF NOT EXISTS ad_report_data_by_name
+    ON ad_report_data (ad_name, report_date);
+CREATE INDEX IF NOT EXISTS locations_by_file ON locations (file_id);
+"""
+
+LOCATE = """
+INSERT OR REPLACE INTO locations (report_date, ad_group, ad_name, file_id,
+    row, offset) VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+# The columns of a query's rows, before the location
+COLUMNS = ('report_date', 'ad_group', 'ad_name', 'impressions', 'clicks',
+    'total_cost_in_cents')
+
+class FileEntries(object):
+    """The rows of one input file, to be stored in an index"""
+
+    # Rows are stored in a transaction for each this many
+    BATCH_SIZE = 10000
+
+    def __init__(self, path, index=None):
+        """
+        Collect the rows of the file at path, storing them in index as they
+        come, if it is given.
+        """
+
+        self.path = path
+        self.index = index
+        self.date = None
+        self.rows = 0
+        # The rows not yet stored, as AdBatch objects, each with the byte
+        # offsets of its rows (None where they are not known)
+        self.chunks = []
+        # The reader of the file, if there is one, which knows the byte
+        # offset of each row (see admetrics.make_reader)
+        self.reader = None
+        # Set by the index once the file is in it
+        self.file_id = None
+        self.stored = 0
+
+    def __len__(self):
+        return self.rows
+
+    def __getstate__(self):
+        # Only the rows are passed between processes
+        state = dict(self.__dict__)
+        state['index'] = state['reader'] = None
+        return state
+
+    def add(self, ad_info, first=False, args=None):
+        """
+        Add an AdInfo. The arguments are those of a produce callback, so this
+        can be given to an AdDataReader directly.
+        """
+
+        if not self.chunks or len(self.chunks[-1][0]) >= self.BATCH_SIZE:
+            self.chunks.append((AdBatch(), []))
+        batch, offsets = self.chunks[-1]
+        batch.append(ad_info)
+        offsets.append(self.reader.row_offset if self.reader is not None else None)
+        self.date = ad_info.date
+        self.rows += 1
+        if self.index is not None and len(batch) >= self.BATCH_SIZE:
+            self.index.write(self)
+
+    def add_batch(self, batch, first=False, args=None):
+        """
+        Add the rows of an AdBatch. The arguments are those of a
+        produce_batch callback.
+        """
+
+        if len(batch) == 0:
+            return
+        offsets = batch.offsets
+        if len(offsets) != len(batch):
+            offsets = [None] * len(batch)
+        # Kept as it is, so rows added one at a time go in a chunk of their own
+        self.chunks.extend([(batch, offsets), (AdBatch(), [])])
+        self.date = batch.dates[-1]
+        self.rows += len(batch)
+        if self.index is not None:
+            self.index.write(self)
+
+class ReportIndex(object):
+    """An index database, opened for storing rows or for queries"""
+
+    def __init__(self, path):
+        """Open (or create) the index at path"""
+
+        self.path = path
+        self.loader = adsqlite.SQLiteLoader(path)
+        self.connection = self.loader.connection
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+
+    def entries(self, path):
+        """Return a FileEntries that stores the rows of the file at path here"""
+
+        return FileEntries(path, self)
+
+    def write(self, entries):
+        """
+        Store the rows that a FileEntries holds, a chunk to a transaction,
+        first replacing what was stored for its file before, if need be.
+        """
+
+        if entries.file_id is None:
+            with self.connection:
+                self._start(entries)
+        for batch, offsets in entries.chunks:
+            if len(batch) == 0:
+                continue
+            with self.connection:
+                self.loader.load(batch)
+                file_id = entries.file_id
+                self.connection.executemany(LOCATE, ((date, ad_group.lower(),
+                        ad_name.lower(), file_id, number, offset)
+                    for number, (date, ad_group, ad_name, offset) in enumerate(
+                        itertools.izip(batch.dates, batch.ad_groups, batch.ad_names,
+                            offsets), entries.stored + 1)))
+            entries.stored += len(batch)
+        entries.chunks = []
+
+    def finish(self, entries):
+        """Store the rest of the rows of a FileEntries whose file was read whole"""
+
+        self.write(entries)
+        with self.connection:
+            self.connection.execute("UPDATE files SET report_date = ?, rows = ? "
+                "WHERE id = ?", (entries.date, entries.stored, entries.file_id))
+
+    def store(self, entries):
+        """Store the rows of a FileEntries, replacing any stored for its file"""
+
+        self.finish(entries)
+
+    def discard(self, entries):
+        """Drop what was stored of a FileEntries whose file failed"""
+
+        if entries.file_id is not None:
+            with self.connection:
+                self._drop(entries.file_id)
+            entries.file_id = None
+        entries.chunks = []
+
+    def _start(self, entries):
+        """Add the file of a FileEntries, dropping what was stored for it"""
+
+        path = os.path.abspath(entries.path)
+        if isinstance(path, str):
+            path = path.decode(sys.getfilesystemencoding() or 'utf-8')
+        stat = os.stat(entries.path)
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT id FROM files WHERE path = ?", (path,))
+        found = cursor.fetchone()
+        if found is not None:
+            self._drop(found[0])
+        cursor.execute("INSERT INTO files (path, report_date, rows, size, mtime) "
+            "VALUES (?, ?, ?, ?, ?)", (path, entries.date, 0, stat.st_size,
+            stat.st_mtime))
+        entries.file_id = cursor.lastrowid
+        entries.stored = 0
+
+    def _drop(self, file_id):
+        """Delete a file and the rows that are still where it put them"""
+
+        self.connection.execute("DELETE FROM ad_report_data WHERE rowid IN ("
+            "SELECT d.rowid FROM ad_report_data d JOIN locations l ON "
+            "d.report_date = l.report_date AND d.ad_group = l.ad_group AND "
+            "d.ad_name = l.ad_name WHERE l.file_id = ?)", (file_id,))
+        self.connection.execute("DELETE FROM locations WHERE file_id = ?", (file_id,))
+        self.connection.execute("DELETE FROM files WHERE id = ?", (file_id,))
+
+    def query(self, start=None, end=None, ad_group=None, ad_name=None):
+        """
+        Iterate over the rows with report dates from start to end (ISO date
+        strings; either may be None for no limit), and with the given ad
+        group and ad name if they are given, in any case. Each row is a
+        tuple of the values in COLUMNS, then the path of its file, its place
+        among the file's data rows, counting from 1, and its byte offset in
+        the file, or None if that is not known. Rows come in order of date,
+        ad group and ad name.
+        """
+
+        conditions = []
+        values = []
+        for condition, value in (("d.report_date >= ?", start),
+                ("d.report_date <= ?", end),
+                ("d.ad_group = ?", ad_group and ad_group.lower()),
+                ("d.ad_name = ?", ad_name and ad_name.lower())):
+            if value is not None:
+                conditions.append(condition)
+                values.append(value)
+        sql = "SELECT %s, f.path, l.row, l.offset FROM ad_report_data d " \
+            "JOIN locations l ON d.report_date = l.report_date AND " \
+            "d.ad_group = l.ad_group AND d.ad_name = l.ad_name " \
+            "JOIN files f ON l.file_id = f.id" % ", ".join(
+                "d." + column for column in COLUMNS)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY d.report_date, d.ad_group, d.ad_name"
+        return self.connection.execute(sql, values)
+
+    def files(self):
+        """
+        Iterate over the indexed files as (path, report date, rows, size,
+        mtime) tuples, by path.
+        """
+
+        return self.connection.execute("SELECT path, report_date, rows, size, "
+            "mtime FROM files ORDER BY path")
+
+    def close(self):
+        """Close the database"""
+
+        self.loader.close()
+
+def write_rows(rows, writer, locations=False):
+    """
+    Write rows from ReportIndex.query to an admetrics.OutputWriter, as the
+    admetrics output is written, with the file, row and byte offset (empty
+    if it is not known) of each at the end if locations is set.
+    """
+
+    if locations:
+        writer.write_header(u"report_date, ad_group, ad_name, impressions, "
+            "clicks, total_cost_in_cents, file, row, offset")
+    else:
+        writer.write_header()
+    for (date, ad_group, ad_name, impressions, clicks, cents, path, number,
+            offset) in rows:
+        row = u"%s,%s,%s,%d,%d,%d" % (date, csv_string(ad_group),
+            csv_string(ad_name), impressions, clicks, cents)
+        if locations:
+            row += u",%s,%d,%s" % (csv_string(path), number,
+                u"" if offset is None else offset)
+        writer.write_row(row)
+    writer.flush()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="ad metrics index queries")
+    parser.add_argument('index', type=str,
+        help="index file, as written by admetrics with --index")
+    parser.add_argument('--from', dest='start', action='store', default=None,
+        help="first report date to include, as YYYY-MM-DD (default: no limit)")
+    parser.add_argument('--to', dest='end', action='store', default=None,
+        help="last report date to include, as YYYY-MM-DD (default: no limit)")
+    parser.add_argument('--ad-group', dest='ad_group', action='store', default=None,
+        help="only rows for this ad group, in any case")
+    parser.add_argument('--ad-name', dest='ad_name', action='store', default=None,
+        help="only rows for this ad name, in any case")
+    parser.add_argument('--locations', dest='locations', action='store_true',
+        default=False,
+        help="add the file, data row number and byte offset of each row")
+    parser.add_argument('--files', dest='files', action='store_true', default=False,
+        help="list the indexed files instead of querying rows")
+    parser.add_argument('--output-encoding', dest='output_encoding', action='store',
+        default='utf-8', help="character encoding for output (default='utf-8')")
+    parser.add_argument('--no-output-bom', dest='no_output_bom', action='store_true',
+        default=False, help="do not output a Unicode BOM at start of output")
+    args = parser.parse_args(argv[1:])
+    if not os.path.exists(args.index):
+        parser.error("no index file '%s'" % args.index)
+    index = ReportIndex(args.index)
+    try:
+        if args.files:
+            for path, date, rows, size, mtime in index.files():
+                sys.stdout.write("%s: %s, %d rows\n" % (path, date, rows))
+            return
+        writer = admetrics.OutputWriter(sys.stdout, args.output_encoding.lower(),
+            not args.no_output_bom)
+        write_rows(index.query(args.start, args.end, args.ad_group, args.ad_name),
+            writer, args.locations)
+    finally:
+        index.close()
+
+if __name__ == "__main__":
+    main(sys.argv)
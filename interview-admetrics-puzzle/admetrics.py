@@ -9,6 +9,10 @@
 # takes two parameters to instantiate: an input source and a producer
 # function that will be called-back with the resulting AdInfo objects as
 # the input is read.
+#
+# Alternatively, the rows() and batches() generators of an AdDataReader
+# yield the AdInfo objects (or AdBatch objects of them) as they are asked
+# for, so the reader can be used as one stage of a larger pipeline.
 
 # The second interface is the AdInfo object. It is instantiated with a
 # warning callback, a field-ordering sequence, a data sequence and an
@@ -45,62 +49,50 @@
 #   this work in any environment where a reasonably modern (2.6+) Python
 #   is installed
 
+import os
 import re
 import sys
+import mmap
+import array
 import codecs
+import fnmatch
 import logging
 import argparse
+import itertools
 
-# Uncomment to suppress warnings
-# logging.basicConfig(level=logging.ERROR)
+import addedup
+import adnumbers
+import adcompress
 
-#Utility functions:
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-CURRENCY_VALUE_RE = re.compile("-?\d+(\.\d\d)$")
+# Uncomment to suppress warnings. Warnings that will not be logged are
+# counted but never formatted, so this also saves the time they take.
+# logging.basicConfig(level=logging.ERROR)
+
+#Utility functions, kept for callers from before adnumbers, which now
+#does the parsing:
 
 def string_to_integer(s):
     """Convert a string to an integer, with error checking"""
-    s = str(s).strip()
-    if len(s) == 0:
-        raise ValueError("Empty string as number")
-    try:
-        i = int(s)
-    except ValueError:
-        i = int(float(s))
-    return i
+    return adnumbers.parse_int(s)
 
 def string_to_float(s):
     """Convert a string to a floating point value, with error checking"""
-    s = str(s).strip()
-    if len(s) == 0:
-        raise ValueError("Empty string as number")
-    f = float(s)
-    return f
+    return adnumbers.parse_float(s)
 
 def money_string_to_float(s):
     """Convert a dollar value into a float"""
-    s = str(s).strip()
-    if len(s) == 0:
-        raise ValueError("Empty string a money value")
-    currency = s[0]
-    if currency.isdigit():
-        # AdWords seems to assume the currency of the account, and not
-        # output it. Ick. We'll default to USD.
-        currency = '$'
-        s = '$' + s
-    elif currency != "$":
-        raise ValueError("TBD: No currency conversions available, yet")
-    if len(s) == 1:
-        raise ValueError("$ must be followed by numeric amount")
-    value = s[1:]
-    if re.match(CURRENCY_VALUE_RE, value):
-        return string_to_float(value)
-    else:
-        raise ValueError("Currency value must be $d or $d.cc")
+    return adnumbers.parse_cents(s) / 100.0
 
 #############################
 ### The core library classes:
 
+CTR_MISMATCH = "Given CTR (%f) does not match clicks/impressions (%f) to within %f"
+
 class AdInfo(object):
     """
     Definition as given by Cogo:
@@ -123,8 +115,14 @@ class AdInfo(object):
 
     Note that the "ad_group_ad_name" above was in the original description, and
     appears to be a typo. I've sent off a request to confirm this...
+
+    Producers may hold on to a great many of these, so each one keeps only
+    its parsed values, in slots, and not the raw input or the warning callback.
     """
 
+    __slots__ = ('date', 'ad_group', 'ad_name', 'impressions', 'clicks', 'ctr',
+        'total_cost_in_cents')
+
     def __init__(self, warner, ordering, csv, ctr_tolerance=4):
         """
         Represent an incoming datum of ad performance data. The parameters are:
@@ -139,24 +137,46 @@ class AdInfo(object):
                         before error checking is applied.
         """
 
-        self.warner = warner
-        self.data = dict(zip(ordering, csv))
-        self.date = self.data['date']
-        self.ad_group = self.data['ad group']
-        self.ad_name = self.data['ad name']
-        self.impressions = string_to_integer(self.data['impressions'])
-        self.clicks = string_to_integer(self.data['clicks'])
-        self.ctr = self.data['ctr']
-        # Google's AdWords report uses percent, not a raw ratio
-        if self.ctr.endswith('%'):
-            self.ctr = self.ctr[0:len(self.ctr)-1]
-            self.ctr = string_to_float(self.ctr)/100.0
-        else:
-            self.ctr = string_to_float(self.data['ctr'])
-        self.total_cost = money_string_to_float(self.data['total cost'])
-        self._sanity_check(ctr_tolerance)
+        data = dict(zip(ordering, csv))
+        self._parse(warner, data['date'], data['ad group'], data['ad name'],
+            data['impressions'], data['clicks'], data['ctr'], data['total cost'],
+            ctr_tolerance)
+
+    def _parse(self, warner, date, ad_group, ad_name, impressions, clicks, ctr,
+            total_cost, ctr_tolerance, check=True):
+        """
+        Set our values from the input strings for each field, and check them
+        unless check is false (in which case that is up to the caller).
+        """
+
+        self.date = date
+        self.ad_group = ad_group
+        self.ad_name = ad_name
+        self.impressions = adnumbers.parse_int(impressions)
+        self.clicks = adnumbers.parse_int(clicks)
+        self.ctr = adnumbers.parse_ctr(ctr)
+        self.total_cost_in_cents = adnumbers.parse_cents(total_cost)
+        if check:
+            self._sanity_check(warner, ctr_tolerance)
+
+    @property
+    def total_cost(self):
+        """The total cost in dollars, as a float, for display"""
+
+        return self.total_cost_in_cents / 100.0
+
+    def __getstate__(self):
+        """Pickle as a plain tuple of the values"""
+
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        """Restore from the tuple made by __getstate__"""
+
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
 
-    def _sanity_check(self, ctr_tolerance):
+    def _sanity_check(self, warner, ctr_tolerance):
         """
         Perform some sanity checks on the data, producing warnings or
         raising exceptions as required.
@@ -173,12 +193,16 @@ class AdInfo(object):
             calc_ctr = float(self.clicks)/self.impressions
             delta = abs(round(self.ctr, ctr_tolerance)-round(calc_ctr, ctr_tolerance))
             if delta > jitter:
-                self.warner(
-                    "Given CTR (%f) does not match clicks/impressions (%f) to within %f" %
-                        (self.ctr, calc_ctr, jitter))
-        if self.total_cost == 0.0 and self.impressions > 0:
+                # Warners that can put off formatting the message are given
+                # the pieces; any other callable gets the formatted message
+                report = getattr(warner, 'report', None)
+                if report is not None:
+                    report(CTR_MISMATCH, (self.ctr, calc_ctr, jitter))
+                else:
+                    warner(CTR_MISMATCH % (self.ctr, calc_ctr, jitter))
+        if self.total_cost_in_cents == 0 and self.impressions > 0:
             raise CSVError("Sanity check failed: cost is non-zero for zero impressions")
-        if self.total_cost < 0.0:
+        if self.total_cost_in_cents < 0:
             raise CSVError("Sanity check failed: negative cost")
         if self.impressions < 0:
             raise CSVError("Sanity check failed: negative impressions")
@@ -187,6 +211,223 @@ class AdInfo(object):
         if self.ad_group == "":
             raise CSVError("Sanity check failed: empty ad group")
 
+class RowBuilder(object):
+    """
+    Builds AdInfo objects from the field lists of a single input file. The
+    position of each field is looked up once, from the column names, and the
+    report date is a constant, so each row is just a matter of indexing.
+    """
+
+    FIELDS = ('ad group', 'ad name', 'impressions', 'clicks', 'ctr', 'total cost')
+
+    def __init__(self, colnames, date, ctr_tolerance=4):
+        """
+        Prepare for rows laid out as given by the sequence of normalized
+        column names, colnames, from a report for the given date.
+        """
+
+        positions = dict((name, i) for i, name in enumerate(colnames))
+        self.indexes = tuple(positions[name] for name in self.FIELDS)
+        self.min_fields = max(self.indexes) + 1
+        self.date = date
+        self.ctr_tolerance = ctr_tolerance
+
+    def build(self, warner, values, check=True):
+        """
+        Return the AdInfo for a list of field values. If check is false, the
+        sanity checks are skipped, to be done by a ColumnarValidator.
+        """
+
+        if len(values) < self.min_fields:
+            raise CSVError("Expected at least %d fields but found %d" % (
+                self.min_fields, len(values)))
+        group, name, impressions, clicks, ctr, cost = self.indexes
+        info = AdInfo.__new__(AdInfo)
+        info._parse(warner, self.date, values[group], values[name],
+            values[impressions], values[clicks], values[ctr], values[cost],
+            self.ctr_tolerance, check)
+        return info
+
+class ColumnarValidator(object):
+    """
+    Performs the AdInfo sanity checks on a batch of rows at once. With NumPy
+    available, the rows' numbers are gathered into arrays and each check is
+    run over the whole batch. Rows are only examined one at a time if they
+    are close enough to the CTR tolerance that rounding details matter.
+    Without NumPy, each row is checked in turn just as AdInfo would.
+    Either way, the problems found and their messages are exactly those of
+    AdInfo._sanity_check.
+    """
+
+    # The checks that raise errors, in the order AdInfo applies them
+    ERRORS = (
+        "Non-zero CTR for zero impressions",
+        "Sanity check failed: cost is non-zero for zero impressions",
+        "Sanity check failed: negative cost",
+        "Sanity check failed: negative impressions",
+        "Sanity check failed: negative clicks",
+        "Sanity check failed: empty ad group",
+    )
+
+    def __init__(self, ctr_tolerance=4, use_numpy=True):
+        """
+        Check CTRs to the given tolerance, as for AdInfo. Setting use_numpy
+        to false forces the row-at-a-time checks.
+        """
+
+        self.ctr_tolerance = ctr_tolerance
+        self.use_numpy = use_numpy and numpy is not None
+
+    def check(self, rows):
+        """
+        Check a sequence of AdInfo objects. Returns a dict that maps the index
+        of each row with a problem to a (warning, error) pair of messages,
+        either of which may be None.
+        """
+
+        if not self.use_numpy:
+            return self._check_rows(rows)
+        try:
+            return self._check_arrays(rows)
+        except OverflowError:
+            # Numbers too big for the arrays; rare enough not to matter
+            return self._check_rows(rows)
+
+    def _check_rows(self, rows):
+        """Apply the AdInfo checks to each row in turn"""
+
+        problems = {}
+        for i, row in enumerate(rows):
+            warnings = []
+            error = None
+            try:
+                row._sanity_check(warnings.append, self.ctr_tolerance)
+            except CSVError as e:
+                error = e.value
+            if warnings or error is not None:
+                problems[i] = (warnings[0] if warnings else None, error)
+        return problems
+
+    def _check_arrays(self, rows):
+        """Apply the AdInfo checks to whole columns of the batch"""
+
+        count = len(rows)
+        impressions = numpy.fromiter((row.impressions for row in rows), numpy.int64, count)
+        clicks = numpy.fromiter((row.clicks for row in rows), numpy.int64, count)
+        ctr = numpy.fromiter((row.ctr for row in rows), numpy.float64, count)
+        cost = numpy.fromiter((row.total_cost_in_cents for row in rows), numpy.int64, count)
+        no_group = numpy.fromiter((row.ad_group == "" for row in rows), numpy.bool_, count)
+
+        zero = impressions == 0
+        masks = (
+            zero & (ctr != 0),
+            (cost == 0) & (impressions > 0),
+            cost < 0,
+            impressions < 0,
+            clicks < 0,
+            no_group,
+        )
+        # Number each row's first failing check from 1, or leave it at 0
+        codes = numpy.zeros(count, numpy.int8)
+        for code in range(len(masks), 0, -1):
+            codes[masks[code - 1]] = code
+
+        # Rounding each CTR to the tolerance moves it by at most half a unit
+        # in the last place, so rows within a unit of the allowed jitter may
+        # go either way and get the exact check. The rest cannot warn.
+        tolerance = self.ctr_tolerance
+        jitter = 10 ** -(tolerance-1)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            calc_ctr = clicks / impressions.astype(numpy.float64)
+            close_call = ~zero & ~(numpy.abs(ctr - calc_ctr) <=
+                jitter - 1.5 * 10 ** -tolerance)
+        # Rows that fail the zero-impression check never get as far as the CTR
+        close_call &= codes != 1
+
+        problems = {}
+        for i in numpy.flatnonzero(close_call | (codes != 0)):
+            i = int(i)
+            warning = error = None
+            if close_call[i]:
+                row = rows[i]
+                calc = float(row.clicks)/row.impressions
+                delta = abs(round(row.ctr, tolerance)-round(calc, tolerance))
+                if delta > jitter:
+                    warning = CTR_MISMATCH % (row.ctr, calc, jitter)
+            if codes[i]:
+                error = self.ERRORS[codes[i] - 1]
+            if warning is not None or error is not None:
+                problems[i] = (warning, error)
+        return problems
+
+def new_totals():
+    """
+    Return a dict of running totals of impressions, clicks and cost in
+    cents, all zero, as kept by AdDataReader.
+    """
+
+    return {'clicks': 0, 'impressions': 0, 'total cost in cents': 0}
+
+class AdBatch(object):
+    """
+    A chunk of rows held by column, for consumers that load data in bulk. Each
+    column is a sequence with one entry per row: dates, ad_groups and ad_names
+    are lists of strings, while impressions, clicks and total_cost_in_cents
+    are arrays of integers. If the reader knows where each row starts in its
+    file (see CSVReader.row_offset), the byte offsets are kept in offsets;
+    otherwise that is empty.
+    """
+
+    COLUMNS = ('dates', 'ad_groups', 'ad_names', 'impressions', 'clicks',
+        'total_cost_in_cents')
+
+    def __init__(self):
+        self.dates = []
+        self.ad_groups = []
+        self.ad_names = []
+        self.impressions = array.array('l')
+        self.clicks = array.array('l')
+        self.total_cost_in_cents = array.array('l')
+        self.offsets = []
+
+    def __len__(self):
+        return len(self.dates)
+
+    def append(self, ad_info, offset=None):
+        """Add an AdInfo, read from the given byte offset, to the end of the batch"""
+
+        self.dates.append(ad_info.date)
+        self.ad_groups.append(ad_info.ad_group)
+        self.ad_names.append(ad_info.ad_name)
+        self.impressions.append(ad_info.impressions)
+        self.clicks.append(ad_info.clicks)
+        self.total_cost_in_cents.append(ad_info.total_cost_in_cents)
+        if offset is not None:
+            self.offsets.append(offset)
+
+    def rows(self):
+        """Iterate over the rows as tuples of values, in COLUMNS order"""
+
+        return itertools.izip(*[getattr(self, name) for name in self.COLUMNS])
+
+    def as_numpy(self):
+        """
+        Return a dict of the columns as NumPy arrays, with the strings as
+        object arrays. Requires NumPy.
+        """
+
+        if numpy is None:
+            raise RuntimeError("NumPy is not available")
+        columns = {}
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            if isinstance(column, list):
+                columns[name] = numpy.array(column, dtype=object)
+            else:
+                columns[name] = numpy.frombuffer(column, dtype=numpy.dtype(
+                    'i%d' % column.itemsize)).copy()
+        return columns
+
 class CSVError(Exception):
     """A simple exception class for use in our CSV handling"""
 
@@ -196,17 +437,198 @@ class CSVError(Exception):
     def __str__(self):
         return repr(self.value)
 
+# CSV tokenizers. Each takes one stripped, non-blank input line and returns
+# the list of field values it contains. The reference tokenizer is the
+# original character-at-a-time state machine and serves as the definition
+# of our CSV dialect. The fast tokenizer must produce identical results
+# (including errors), but leaves most of the scanning to the C-level
+# string methods, which is where the time goes on large reports.
+#
+# Each tokenizer also comes as a split_record function, which returns the
+# values and whether the line ends inside a quoted value whose closing
+# quote has not been seen, that is, whether the record goes on over the
+# next line (see the multiline option of CSVReader).
+
+def split_record_reference(line):
+    """
+    Our basic CSV scanner state machine. We handle the following conventions:
+    * "quoted strings","as fields",mixed,with,non-quoted
+    * "double ""quote"" escapes"
+    * Leading and trailing whitespace stripping on fields
+    Returns the values, and True if a quoted value is left open.
+    """
+
+    state = None
+    accum = ""
+    values = []
+    for c in line:
+        if state is None:
+            if c == '"':
+                state = "quote"
+            elif c == ',':
+                values.append(accum.strip())
+                accum = ""
+            else:
+                accum += c
+                state = "data"
+        elif state == "quote":
+            if c == '"':
+                state = "end_quote"
+            else:
+                accum += c
+        elif state == "end_quote":
+            if c == '"':
+                state = "quote"
+                accum += c
+            elif c == ',':
+                values.append(accum.strip())
+                accum = ""
+                state = None
+            elif c.isspace():
+                pass
+            else:
+                raise CSVError("Unexpected character '%s' after end-quote" % c)
+        elif state == "data":
+            if c == ',':
+                values.append(accum.strip())
+                accum = ""
+                state = None
+            elif c == '"' and accum.isspace():
+                accum = ""
+                state = "quote"
+            else:
+                accum += c
+        else:
+            raise CSVError("Unknown state '%s'" % state)
+    values.append(accum.strip())
+    return values, state == "quote"
+
+def split_fields_reference(line):
+    """The field values of a line, as split by split_record_reference"""
+
+    return split_record_reference(line)[0]
+
+def split_record_fast(line):
+    """
+    The same dialect as split_record_reference, but working a field at a
+    time with find() and slicing rather than a character at a time.
+    """
+
+    if '"' not in line:
+        return [value.strip() for value in line.split(',')], False
+    values = []
+    end = len(line)
+    pos = 0
+    while True:
+        comma = line.find(',', pos)
+        if comma < 0:
+            comma = end
+        quote = line.find('"', pos, comma)
+        # A quote only opens a quoted value if nothing but whitespace
+        # precedes it in the field. Otherwise it is just data.
+        if quote < 0 or line[pos:quote].strip():
+            values.append(line[pos:comma].strip())
+            if comma == end:
+                return values, False
+            pos = comma + 1
+            continue
+        accum = []
+        pos = quote + 1
+        while True:
+            close = line.find('"', pos)
+            if close < 0:
+                # Unterminated quotes run to the end of the line
+                accum.append(line[pos:])
+                values.append("".join(accum).strip())
+                return values, True
+            accum.append(line[pos:close])
+            pos = close + 1
+            while pos < end and line[pos].isspace():
+                pos += 1
+            if pos == end:
+                values.append("".join(accum).strip())
+                return values, False
+            c = line[pos]
+            pos += 1
+            if c == '"':
+                accum.append(c)
+            elif c == ',':
+                values.append("".join(accum).strip())
+                break
+            else:
+                raise CSVError("Unexpected character '%s' after end-quote" % c)
+
+def split_fields_fast(line):
+    """The field values of a line, as split by split_record_fast"""
+
+    if '"' not in line:
+        return [value.strip() for value in line.split(',')]
+    return split_record_fast(line)[0]
+
+def quote_is_open(line, continued=False):
+    """
+    Return True if the line ends inside a quoted value whose closing quote
+    has not been seen, following the same rules as the tokenizers. Malformed
+    lines return False and are left for the tokenizer to report.
+
+    With continued set, the line is taken to go on with a quoted value left
+    open by the lines before it, so that a record over many lines can be
+    checked a line at a time, rather than all of it again at each line.
+    """
+
+    if continued:
+        line = '"' + line
+    try:
+        return split_record_fast(line)[1]
+    except CSVError:
+        return False
+
+# The split_fields and split_record functions of each tokenizer
+CSV_ENGINES = {
+    'fast': (split_fields_fast, split_record_fast),
+    'reference': (split_fields_reference, split_record_reference),
+}
+
 class CSVReader(object):
     """A reader for the CSV input files"""
-    def __init__(self, source):
+    def __init__(self, source, engine='fast', block_size=None, multiline=False):
         """
         Initialize with the source of CSV input and the destination for output.
         Defaults to sys.stdin and sys.stdout, respectively.
+
+        The engine parameter selects the tokenizer used to split lines into
+        fields, and must be one of the keys of CSV_ENGINES. All engines
+        accept exactly the same input, so this only affects speed.
+
+        If block_size is given, the source is read (and, for codecs readers,
+        decoded) that many bytes at a time with .read() and split into lines
+        in bulk, rather than calling .readline() for every line. Line numbers
+        and the last line read are tracked exactly as in line mode.
+
+        If multiline is true, a quoted value that is still open at the end of
+        a line continues onto the next line, newline included. Otherwise an
+        unterminated quote simply runs to the end of its line.
+
+        Sources that record a line_offset attribute for each line they return
+        (such as MappedSource) have the byte offset of the current row
+        tracked in row_offset and reported in diagnostics.
         """
 
+        if engine not in CSV_ENGINES:
+            raise ValueError("Unknown CSV engine '%s'" % engine)
         self.source = source
+        self.engine = engine
+        self.split_fields, self.split_record = CSV_ENGINES[engine]
+        self.block_size = block_size
+        self.multiline = multiline
         self.lineno = 0
         self.lastline = None
+        self.row_offset = None
+        self._track_offsets = hasattr(source, 'line_offset')
+        # Block mode state: the complete lines of the current block and the
+        # trailing partial line that will be prefixed to the next one.
+        self._lines = iter(())
+        self._partial = None
 
     def readline(self):
         """
@@ -214,81 +636,289 @@ class CSVReader(object):
         line read for diagnostic use.
         """
 
-        self.lastline = self.source.readline()
+        if self.block_size:
+            # The last line is kept until the next is read, so that input
+            # that fails to read is reported after it
+            line = next(self._lines, None)
+            if line is None:
+                line = self._read_block()
+            self.lastline = line
+        else:
+            self.lastline = self.source.readline()
         if len(self.lastline) != 0:
             self.lineno += 1
         return self.lastline
 
+    def _read_block(self):
+        """
+        Refill the line buffer from the source in block mode and return the
+        first line from it, or an empty string at end of input.
+        """
+
+        while True:
+            block = self.source.read(self.block_size)
+            if len(block) == 0:
+                # End of input: whatever is left over is the last line
+                line = self._partial or block
+                self._partial = None
+                return line
+            if self._partial:
+                block = self._partial + block
+            lines = block.splitlines(True)
+            # The last line may be incomplete (or be a "\r" whose "\n" is in
+            # the next block), so hold it back until more input arrives.
+            self._partial = lines.pop()
+            if lines:
+                self._lines = iter(lines)
+                return next(self._lines)
+
     def get_reader_state(self):
         """
         Get the diagnostic info for the current file and read state and format
         it as a string for warnings and such.
         """
 
-        return "%s:%s: %s" % (self.source.name, self.lineno, str(self.lastline).strip())
+        # Nothing has been read if the input fails at the start
+        lastline = str(self.lastline or "").strip()
+        if self.row_offset is not None:
+            return "%s:%s (byte %d): %s" % (self.source.name, self.lineno,
+                self.row_offset, lastline)
+        return "%s:%s: %s" % (self.source.name, self.lineno, lastline)
+
+    def _save_state(self):
+        """Return the diagnostic read state, for _restore_state"""
+
+        return (self.lineno, self.lastline, self.row_offset)
+
+    def _restore_state(self, state):
+        """Put back the diagnostic read state saved by _save_state"""
+
+        self.lineno, self.lastline, self.row_offset = state
 
     def parse_line(self):
         """
-        Our basic CSV scanner state machine. We handle the following conventions:
-        * "quoted strings","as fields",mixed,with,non-quoted
-        * "double ""quote"" escapes"
-        * Elimination of blank input lines
-        * Leading and trailing whitespace stripping on fields
+        Read the next non-blank line and split it into a list of field values
+        using the selected engine (see split_fields_reference for the
+        conventions we handle). Returns None at end of input.
         """
 
         while True:
-            line = self.readline()
-            if len(line) == 0:
+            row = self.readline()
+            if len(row) == 0:
                 return None
-            line = line.strip()
+            line = row.strip()
             if len(line) == 0:
                 continue
-            state = None
-            accum = ""
-            values = []
-            for c in line:
-                if state is None:
-                    if c == '"':
-                        state = "quote"
-                    elif c == ',':
-                        values.append(accum.strip())
-                        accum = ""
-                    else:
-                        accum += c
-                        state = "data"
-                elif state == "quote":
-                    if c == '"':
-                        state = "end_quote"
-                    else:
-                        accum += c
-                elif state == "end_quote":
-                    if c == '"':
-                        state = "quote"
-                        accum += c
-                    elif c == ',':
-                        values.append(accum.strip())
-                        accum = ""
-                        state = None
-                    elif c.isspace():
-                        pass
-                    else:
-                        raise CSVError("Unexpected character '%s' after end-quote" % c)
-                elif state == "data":
-                    if c == ',':
-                        values.append(accum.strip())
-                        accum = ""
-                        state = None
-                    elif c == '"' and accum.isspace():
-                        accum = ""
-                        state = "quote"
-                    else:
-                        accum += c
-                else:
-                    raise CSVError("Unknown state '%s'" % state)
-            values.append(accum.strip())
-
+            if self._track_offsets:
+                self.row_offset = self.source.line_offset
+            if not self.multiline:
+                return self.split_fields(line)
+            values, still_open = self.split_record(line)
+            if still_open:
+                # Each line added is checked on its own, and the record is
+                # split once it is whole
+                while still_open:
+                    more = self.readline()
+                    if len(more) == 0:
+                        break
+                    row += more
+                    still_open = quote_is_open(more.rstrip(), True)
+                values = self.split_fields(row.strip())
+            # Report the whole row, not just its last line
+            self.lastline = row
             return values
 
+class MappedSource(object):
+    """
+    An input source that memory-maps a file and hands out its lines straight
+    from the mapped buffer, for use in place of a file object with CSVReader
+    and AdDataReader. Each line is decoded directly from the map without an
+    intermediate copy, and the byte offset of the most recent line is kept in
+    line_offset so that diagnostics can point at it in the file.
+    """
+
+    def __init__(self, path, encoding='utf-8', start=0, end=None):
+        """
+        Map the file at path, whose contents are in the given encoding. The
+        encoding must keep newlines, commas and quotes as single ASCII bytes
+        (as UTF-8 and the ISO-8859 family do). A leading UTF-8 BOM is skipped.
+
+        Reading may be limited to the byte range from start up to end, which
+        should both fall on line boundaries.
+        """
+
+        if u"\n,\"".encode(encoding) != "\n,\"":
+            raise ValueError(
+                "Memory-mapped input needs an ASCII-compatible encoding, not '%s'" %
+                    encoding)
+        self.name = path
+        self.encoding = encoding
+        self.decode = codecs.getdecoder(encoding)
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        if size == 0:
+            # mmap cannot map an empty file
+            self.map = None
+        else:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.pos = start
+        if end is None or end > size:
+            end = size
+        self.end = end
+        self.line_offset = None
+        if start == 0 and size and \
+                self.map[:len(codecs.BOM_UTF8)] == codecs.BOM_UTF8 and \
+                codecs.lookup(encoding).name.startswith('utf-8'):
+            self.pos = len(codecs.BOM_UTF8)
+
+    def readline(self):
+        """Return the next line, including its newline, or '' at the end"""
+
+        start = self.pos
+        if start >= self.end:
+            return u""
+        newline = self.map.find("\n", start, self.end)
+        if newline < 0:
+            self.pos = self.end
+        else:
+            self.pos = newline + 1
+        self.line_offset = start
+        return self.decode(buffer(self.map, start, self.pos - start))[0]
+
+    def close(self):
+        """Release the map and the underlying file"""
+
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+def csv_quoted(value):
+    """Quote a value for CSV output, whatever it holds"""
+
+    return u'"' + value.replace(u'"', u'""') + u'"'
+
+class Quarantine(object):
+    """
+    A side file for the rows that a reader in quarantine mode rejects. Each
+    one is written as a CSV line giving the input name, line number, the
+    reason it was rejected and the line itself.
+    """
+
+    HEADER = u"source,line,reason,data\n"
+
+    def __init__(self, stream, encoding='utf-8', header=True):
+        """Write rejected rows to stream in the given encoding"""
+
+        self.stream = stream
+        self.encoding = encoding
+        self.count = 0
+        if header:
+            self.stream.write(self.HEADER.encode(encoding))
+
+    def reject(self, name, lineno, reason, line):
+        """Record a rejected input line"""
+
+        self.count += 1
+        self.stream.write((u"%s,%d,%s,%s\n" % (csv_quoted(unicode(name)), lineno,
+            csv_quoted(reason), csv_quoted(line.strip()))).encode(self.encoding))
+
+    def flush(self):
+        """Make sure the rejected rows so far are written out"""
+
+        self.stream.flush()
+
+    def tell(self):
+        """The length of the file, with the rejected rows so far written out"""
+
+        self.stream.flush()
+        self.stream.seek(0, os.SEEK_END)
+        return self.stream.tell()
+
+    def restore(self, length, count):
+        """
+        Cut the file, opened for appending, back to length, dropping the rows
+        rejected since, with count rows rejected before that. If the file is
+        shorter than that (or length is None), it is started again instead.
+        """
+
+        if length is None or self.tell() < length:
+            length = 0
+            count = 0
+        self.stream.truncate(length)
+        self.stream.seek(length)
+        if length == 0:
+            self.stream.write(self.HEADER.encode(self.encoding))
+        self.count = count
+
+class Diagnostics(object):
+    """
+    Decides which of a reader's warnings are logged, so that only those are
+    formatted, and keeps count of them all by category. A warning is logged
+    if the logger will emit it and it is one of the first limit of its
+    category (if a limit is set). Beyond that, with sample set, every
+    sample'th one is logged too.
+    """
+
+    def __init__(self, limit=None, sample=None, logger=None):
+        """Set the limit and sampling rate, and the logger that is checked"""
+
+        self.limit = limit
+        self.sample = sample
+        self.logger = logging.getLogger() if logger is None else logger
+        self.counts = {}
+        self.shown = {}
+
+    def wanted(self, level, category):
+        """Count a diagnostic and return True if it should be logged"""
+
+        count = self.counts.get(category, 0) + 1
+        self.counts[category] = count
+        if not self.logger.isEnabledFor(level):
+            return False
+        if self.limit is not None and count <= self.limit:
+            pass
+        elif self.sample is not None:
+            past = count - (self.limit or 0)
+            if (past - 1) % self.sample != 0:
+                return False
+        elif self.limit is not None:
+            return False
+        self.shown[category] = self.shown.get(category, 0) + 1
+        return True
+
+    def summary(self):
+        """
+        Return a (category, count, shown) triple for each category that had
+        warnings that were not logged.
+        """
+
+        return [(category, count, self.shown.get(category, 0))
+            for category, count in sorted(self.counts.items())
+            if count > self.shown.get(category, 0)]
+
+class RowWarner(object):
+    """
+    The warning callback a reader gives to AdInfo's checks. It can be called
+    with a message, like any warner, or given a format and its arguments
+    with report, to be formatted only if the warning is to be logged.
+    """
+
+    __slots__ = ('reader', 'category')
+
+    def __init__(self, reader, category):
+        self.reader = reader
+        self.category = category
+
+    def __call__(self, message):
+        """Warn with a ready-made message"""
+
+        self.reader._warning(message, self.category)
+
+    def report(self, message, args):
+        """Warn with message % args, if the warning is to be logged"""
+
+        self.reader._warning(message, self.category, args)
+
 class AdDataReader(CSVReader):
     """The specifics of our ad data parsing"""
 
@@ -318,7 +948,7 @@ class AdDataReader(CSVReader):
         "jul":"07", "aug":"08", "sep":"09", "oct":"10", "nov":"11", "dec":"12",
     }
 
-    def __init__(self, source, produce, no_total_warning, *args):
+    def __init__(self, source, produce, no_total_warning, *args, **options):
         """
         Initialize the reader with an input source, a callback that will be
         invoked with the resulting AdInfo object from a line read from the data file,
@@ -337,6 +967,36 @@ class AdDataReader(CSVReader):
 
         The input source must be a file object or compatible stream that supports
         .readline() and .name
+
+        The validation option chooses how rows are sanity checked: 'row' (the
+        default) checks each one as it is read, while 'columnar' reads rows in
+        batches of validation_batch and checks each batch with a
+        ColumnarValidator before producing its rows. The results are the same.
+
+        Instead of a produce callback, a batch consumer may be given as the
+        produce_batch option. It is called with AdBatch objects of up to
+        batch_size rows (default 10000), as
+
+            produce_batch(batch, first=isfirsttime, args=args)
+
+        and once more at the end of input (or before exiting on an error) with
+        whatever rows remain.
+
+        With a quarantine option (a Quarantine), lines that cannot be used are
+        written to it and skipped, rather than ending the input with an error.
+
+        Warnings are counted by category, and with the warning_limit option
+        only that many of each category are logged, plus every
+        warning_sample'th one after that if that option is given. The rest
+        are summed up at the end of input. Alternatively, a Diagnostics may
+        be given as the diagnostics option.
+
+        A checkpoint option (see adcheckpoint.Checkpoint) has the reader's
+        progress saved as it goes, and picked up from where it was saved if
+        the input is read again. The source must then be a MappedSource.
+
+        Any other keyword options are passed on to CSVReader (e.g.
+        engine='reference').
         """
 
         self.produce = produce
@@ -344,59 +1004,264 @@ class AdDataReader(CSVReader):
         self.no_total_warning = no_total_warning
         self.date = None
         self.colnames = None
-        self.accumulator = { 'clicks':0, 'impressions':0, 'total cost':0 }
-
-        super(AdDataReader, self).__init__(source)
+        self.row_builder = None
+        self.accumulator = new_totals()
+        self.validation = options.pop('validation', 'row')
+        if self.validation not in ('row', 'columnar'):
+            raise ValueError("Unknown validation mode '%s'" % self.validation)
+        self.validation_batch = options.pop('validation_batch', 10000)
+        self.produce_batch = options.pop('produce_batch', None)
+        self.batch_size = options.pop('batch_size', 10000)
+        self.batch = AdBatch()
+        self.first_batch = True
+        self.checkpoint = options.pop('checkpoint', None)
+        self.produced = 0
+        self.quarantine = options.pop('quarantine', None)
+        self.diagnostics = options.pop('diagnostics', None)
+        limit = options.pop('warning_limit', None)
+        sample = options.pop('warning_sample', None)
+        if self.diagnostics is None:
+            self.diagnostics = Diagnostics(limit, sample)
+        self.ctr_warner = RowWarner(self, "CTR mismatch")
+
+        super(AdDataReader, self).__init__(source, **options)
 
     def process_input(self):
         """Read in the CSV and call produce for each data line"""
 
+        for row_data in self.rows():
+            self._produce(row_data, self.produced == 0)
+
+    def rows(self):
+        """
+        Read in the CSV and yield an AdInfo for each data line, as
+        process_input would pass them to produce. Rows are read as they are
+        asked for, so this can feed filters and aggregators directly:
+
+            cost = sum(row.total_cost_in_cents for row in reader.rows()
+                       if row.clicks > 0)
+
+        Summary lines are checked and warnings logged along the way, and the
+        totals are reported once the last row has been taken. A checkpoint is
+        saved only between rows, once the row before has been dealt with.
+        """
+
+        try:
+            self._start_input()
+            for row_data in self._records(True):
+                yield row_data
+        except adcompress.CompressedInputError as e:
+            self._fatal("While reading input", str(e))
+        self._end_input()
+
+    def batches(self, size=None):
+        """
+        Read in the CSV and yield AdBatch objects of up to size rows (default
+        batch_size), the same rows that rows() would yield. A checkpoint is
+        saved only between batches.
+        """
+
+        if size is None:
+            size = self.batch_size
+        try:
+            self._start_input()
+            batch = AdBatch()
+            for row_data in self._records(False):
+                batch.append(row_data, self.row_offset)
+                if len(batch) >= size:
+                    yield batch
+                    batch = AdBatch()
+                    if self.checkpoint is not None:
+                        self.checkpoint.maybe_save(self)
+        except adcompress.CompressedInputError as e:
+            self._fatal("While reading input", str(e))
+        if len(batch) > 0:
+            yield batch
+        self._end_input()
+
+    def _start_input(self):
+        """Read the header, and pick up from the checkpoint if there is one"""
+
         self._read_header()
-        first = True
+        if self.checkpoint is not None:
+            self.checkpoint.resume(self)
+
+    def _end_input(self):
+        """Pass on the last batch and sum up, once every row has been used"""
+
+        self._flush_batch()
+        self._report_totals()
+        if self.checkpoint is not None:
+            self.checkpoint.finish()
+
+    def _records(self, save):
+        """
+        Yield each data line to be used, up to the end of input, checking
+        summary lines along the way. Each row is counted as produced once
+        the caller asks for the next, and with save set, the checkpoint is
+        saved when it is due.
+        """
+
+        if self.validation == 'columnar':
+            for row_data in self._columnar_records(save):
+                yield row_data
+            return
         while True:
-            try:
-                line = self.parse_line()
-            except CSVError as e:
-                self._failure("While reading data line", e.value)
-                exit(1)
-            if line is None:
+            row_data = self._next_record()
+            if row_data is None:
                 return
-            line.append(self.date)
-            try:
-                # The tolerance value should be passed here, and recieved
-                # from the caller that instantiated this class. Ideally, this
-                # should be a command-line parameter, since it may vary by file
-                row_data = AdInfo(self._warning, self.colnames, line)
-            except CSVError as e:
-                self._failure("While processing individual fields", e.value)
-                exit(1)
-            # The original sample input file used "Total" as an ad group to denote
-            # the summary line. Google's Ad Sense reports use "--", so I handle both.
-            if row_data.ad_group.lower() == 'total' or row_data.ad_group == "--":
-                if not self.no_total_warning:
-                    self._warning("Not saving input with ad group, '%s'" % row_data.ad_group)
-                if row_data.impressions != self.accumulator['impressions']:
-                    self._failure("Total impressions in summary (%d) != our tally (%d)" % (
-                        row_data.impressions, self.accumulator['impressions']))
-                if row_data.clicks != self.accumulator['clicks']:
-                    self._failure("Total clicks in summary (%d) != our tally (%d)" % (
-                        row_data.clicks, self.accumulator['clicks']))
-                if abs(row_data.clicks - self.accumulator['clicks']) >= 0.01:
-                    self._failure("Total cost in summary (%.2f) != our tally (%.2f)" % (
-                        row_data.total_cost, self.accumulator['total cost']))
-                continue
-            else:
-                if len(row_data.ad_name) == 0:
-                    self._failure("Empty ad name not allowed")
-                    exit(1)
-                self.accumulator['impressions'] += row_data.impressions
-                self.accumulator['clicks'] += row_data.clicks
-                self.accumulator['total cost'] += row_data.total_cost
-            if first:
-                self.produce(row_data, first=True, args=self.produce_args)
-                first = False
-            else:
-                self.produce(row_data, first=False, args=self.produce_args)
+            if self._use_row(row_data):
+                yield row_data
+                self.produced += 1
+                if save and self.checkpoint is not None:
+                    self.checkpoint.maybe_save(self)
+
+    def _use_row(self, row_data):
+        """
+        Check a summary line, or count a data line. Returns True if the row
+        is to be produced.
+        """
+
+        if self._is_summary(row_data):
+            self._check_summary(row_data)
+            return False
+        return self._accept_row(row_data)
+
+    def _produce(self, row_data, first):
+        """Pass a row on to the producer, or add it to the current batch"""
+
+        if self.produce_batch is None:
+            self.produce(row_data, first=first, args=self.produce_args)
+            return
+        self.batch.append(row_data, self.row_offset)
+        if len(self.batch) >= self.batch_size:
+            self._flush_batch()
+
+    def _flush_batch(self):
+        """Pass any rows in the current batch to the batch consumer"""
+
+        if len(self.batch) == 0:
+            return
+        batch = self.batch
+        self.batch = AdBatch()
+        self.produce_batch(batch, first=self.first_batch, args=self.produce_args)
+        self.first_batch = False
+
+    def _columnar_records(self, save):
+        """
+        The columnar validation version of _records. Each batch of
+        rows is read and checked before any of them are used, and then the
+        results are dealt with in order, as if each row had been checked as
+        it was read.
+        """
+
+        validator = ColumnarValidator(self.row_builder.ctr_tolerance)
+        while True:
+            # Each item is (row, failure, state). In quarantine mode, lines
+            # that cannot be parsed are kept in order as failures.
+            items = []
+            failure = None
+            while len(items) < self.validation_batch:
+                row_data, failure = self._parse_record(check=False)
+                if row_data is None and (failure is None or self.quarantine is None):
+                    break
+                items.append((row_data, failure, self._save_state()))
+                failure = None
+            rows = [row_data for row_data, _, _ in items if row_data is not None]
+            problems = validator.check(rows)
+            end_state = self._save_state()
+            i = -1
+            for row_data, row_failure, state in items:
+                self._restore_state(state)
+                if row_data is None:
+                    self._reject(*row_failure)
+                    continue
+                i += 1
+                if i in problems:
+                    warning, error = problems[i]
+                    if warning is not None:
+                        self.ctr_warner(warning)
+                    if error is not None:
+                        self._reject("While processing individual fields", error)
+                        continue
+                if self._use_row(row_data):
+                    yield row_data
+                    self.produced += 1
+            self._restore_state(end_state)
+            if failure is not None:
+                self._fatal(*failure)
+            if save and self.checkpoint is not None:
+                self.checkpoint.maybe_save(self)
+            if len(items) < self.validation_batch:
+                return
+
+    def _next_record(self):
+        """Parse the next data line into an AdInfo, or return None at the end"""
+
+        while True:
+            row_data, failure = self._parse_record()
+            if failure is None:
+                return row_data
+            self._reject(*failure)
+
+    def _parse_record(self, check=True):
+        """
+        Parse the next data line, returning (row, failure). The row is an
+        AdInfo, or None at the end of input or if the line cannot be used, in
+        which case failure is the (message, detail) pair to report.
+        """
+
+        try:
+            line = self.parse_line()
+        except CSVError as e:
+            return None, ("While reading data line", e.value)
+        if line is None:
+            return None, None
+        try:
+            return self.row_builder.build(self.ctr_warner, line, check), None
+        except CSVError as e:
+            return None, ("While processing individual fields", e.value)
+        except ValueError as e:
+            # From the number conversions
+            return None, ("While processing individual fields", str(e))
+
+    def _is_summary(self, row_data):
+        """True if the row is a summary line rather than ad data"""
+
+        # The original sample input file used "Total" as an ad group to denote
+        # the summary line. Google's Ad Sense reports use "--", so I handle both.
+        return row_data.ad_group.lower() == 'total' or row_data.ad_group == "--"
+
+    def _check_summary(self, row_data):
+        """Compare a summary line against the totals of the rows so far"""
+
+        if not self.no_total_warning:
+            self._warning("Not saving input with ad group, '%s'" % row_data.ad_group,
+                "summary line")
+        if row_data.impressions != self.accumulator['impressions']:
+            self._failure("Total impressions in summary (%d) != our tally (%d)" % (
+                row_data.impressions, self.accumulator['impressions']))
+        if row_data.clicks != self.accumulator['clicks']:
+            self._failure("Total clicks in summary (%d) != our tally (%d)" % (
+                row_data.clicks, self.accumulator['clicks']))
+        if row_data.total_cost_in_cents != self.accumulator['total cost in cents']:
+            self._failure("Total cost in summary (%s) != our tally (%s)" % (
+                adnumbers.format_cents(row_data.total_cost_in_cents),
+                adnumbers.format_cents(self.accumulator['total cost in cents'])))
+
+    def _accept_row(self, row_data):
+        """
+        Check a data row that is to be produced and add it to the totals.
+        Returns False if it was rejected.
+        """
+
+        if len(row_data.ad_name) == 0:
+            self._reject("Empty ad name not allowed")
+            return False
+        self.accumulator['impressions'] += row_data.impressions
+        self.accumulator['clicks'] += row_data.clicks
+        self.accumulator['total cost in cents'] += row_data.total_cost_in_cents
+        return True
 
     def _read_header(self):
         """Read the header data including the report date and column names"""
@@ -404,13 +1269,21 @@ class AdDataReader(CSVReader):
         try:
             self.date = self._read_date_header()
         except CSVError as e:
-            self._failure("While parsing date header", e.value)
-            exit(1)
+            self._fatal("While parsing date header", e.value)
         try:
             self.colnames = self._read_column_names_header()
         except CSVError as e:
-            self._failure("While parsing column names header", e.value)
-            exit(1)
+            self._fatal("While parsing column names header", e.value)
+        self._start_rows()
+
+    def _start_rows(self):
+        """Get ready to read data lines, once the date and column names are known"""
+
+        if self.colnames is not None:
+            # The tolerance value should be passed here, and recieved
+            # from the caller that instantiated this class. Ideally, this
+            # should be a command-line parameter, since it may vary by file
+            self.row_builder = RowBuilder(self.colnames, self.date)
 
     def _read_date_header(self):
         """Read the date from the first line"""
@@ -419,23 +1292,11 @@ class AdDataReader(CSVReader):
         if line is None:
             return None
         if len(line) > 1:
-            self._warning("More than one column in date header")
-        m = self.DATE_MMDDYYYY_RE.search(line[0])
-        if m:
-            return "%s-%s-%s" % m.group(3, 1, 2)
-        m = self.DATE_ISO_RE.search(line[0])
-        if m:
-            return "%s-%s-%s" % m.group(1, 2, 3)
-        m = self.DATE_SIMPLE_RE.search(line[0])
-        if m:
-            month = self.MONTH_MAP[m.group(1).lower()]
-            day = m.group(2)
-            if len(day) == 1:
-                day = "0" + day
-            year = m.group(3)
-            return "%s-%s-%s" % (year, month, day)
-        self._failure("Cannot find date in header", None)
-        exit(1)
+            self._warning("More than one column in date header", "date header")
+        date = parse_report_date(line[0])
+        if date is None:
+            self._fatal("Cannot find date in header", None)
+        return date
 
     def _read_column_names_header(self):
         """Read the header that keys our column names"""
@@ -461,24 +1322,75 @@ class AdDataReader(CSVReader):
     def _failure(self, message, exception=None):
         """Produce an error message"""
 
+        if not logging.getLogger().isEnabledFor(logging.ERROR):
+            return
         if exception is not None:
             ex_msg = ":\n  " + exception
         else:
             ex_msg = "."
-        logging.error(message + ":\n" + self.get_reader_state() + ex_msg)
+        self._emit(logging.ERROR, message + ":\n" + self.get_reader_state() + ex_msg)
+
+    def _fatal(self, message, exception=None):
+        """Produce an error message and give up on the input"""
+
+        self._failure(message, exception)
+        # Rows read before the error are still produced
+        self._flush_batch()
+        self._report_totals()
+        exit(1)
+
+    def _reject(self, message, exception=None):
+        """
+        Deal with a line that cannot be used: quarantine it, if we are doing
+        that, or give up on the input.
+        """
+
+        if self.quarantine is None:
+            self._fatal(message, exception)
+        if exception is not None:
+            message += ": " + exception
+        self.quarantine.reject(self.source.name, self.lineno, message, self.lastline)
+
+    def _warning(self, message, category=None, args=None):
+        """
+        Produce a warning messsage. Warnings are counted by category (by
+        default, the message), and are only formatted, with args if given, if
+        they will be logged.
+        """
 
-    def _warning(self, message):
-        """Produce a warning messsage"""
+        if self.diagnostics.wanted(logging.WARNING, category or message):
+            if args is not None:
+                message = message % args
+            self._emit(logging.WARNING, self._format_warning(message))
 
-        logging.warning(self.get_reader_state() + "\n" + "Warning: " + message)
+    def _format_warning(self, message):
+        """Add the reader state to a warning message"""
+
+        return self.get_reader_state() + "\n" + "Warning: " + message
+
+    def _report_totals(self):
+        """Sum up the warnings that were not shown and the rows quarantined"""
+
+        for category, count, shown in self.diagnostics.summary():
+            if self.diagnostics.logger.isEnabledFor(logging.WARNING):
+                self._emit(logging.WARNING,
+                    "%s: %d more '%s' warnings not shown (%d in all)" % (
+                        self.source.name, count - shown, category, count))
+        if self.quarantine is not None:
+            self.quarantine.flush()
+            if self.quarantine.count:
+                self._emit(logging.WARNING, "%s: %d rows quarantined so far" % (
+                    self.source.name, self.quarantine.count))
+
+    def _emit(self, level, text):
+        """Send a formatted diagnostic on to the log"""
+
+        logging.log(level, text)
 
 
 ##########################################################
 ### What follows is a sample program that uses this module
 
-# Tracker for our primary key
-UNIQUE_RECORDS_SEEN = {}
-
 def csv_string(in_string):
     """Format a string for CSV output"""
 
@@ -487,10 +1399,187 @@ def csv_string(in_string):
     else:
         return in_string
 
-def output_encoded_string(s, codec):
-    """Print a Unicode string as a given encoding on output."""
+class OutputWriter(object):
+    """
+    Buffered, encoded output of the CSV rows. The codec is looked up once,
+    and rows are collected and encoded together, so the stream sees a few
+    large writes rather than one per row. Call flush at the end of output.
+    """
+
+    BOMS = {
+        'utf-8': codecs.BOM_UTF8,
+        'utf-16': codecs.BOM_UTF16,
+        'utf-16-be': codecs.BOM_UTF16_BE,
+        'utf-16-le': codecs.BOM_UTF16_LE,
+        'utf-32': codecs.BOM_UTF32,
+        'utf-32-be': codecs.BOM_UTF32_BE,
+        'utf-32-le': codecs.BOM_UTF32_LE,
+    }
+
+    def __init__(self, stream=None, encoding='utf-8', bom=True, buffer_size=256*1024):
+        """
+        Write to stream (default sys.stdout) in the given encoding, starting
+        with a Unicode BOM if bom is set, holding back about buffer_size
+        characters of output between writes.
+        """
+
+        self.stream = sys.stdout if stream is None else stream
+        self.encoding = encoding
+        self.bom = bom
+        self.buffer_size = buffer_size
+        # The plain utf-16 and utf-32 codecs start every string they encode
+        # with a BOM, so encode in the byte order that their BOM gives instead
+        codec = encoding
+        if encoding in ('utf-16', 'utf-32'):
+            codec += '-le' if sys.byteorder == 'little' else '-be'
+        self.encode = codecs.getencoder(codec)
+        self.pending = []
+        self.pending_size = 0
+
+    def write_header(self, columns=None):
+        """
+        Write the Unicode BOM, if requested, and the column names line, or
+        columns instead if it is given.
+        """
+
+        if self.bom:
+            if self.encoding in self.BOMS:
+                self.flush()
+                self.stream.write(self.BOMS[self.encoding])
+            else:
+                logging.warning("Unicode BOM requested for unknown codec, '%s'" %
+                    self.encoding)
+        if columns is None:
+            columns = u"report_date, ad_group, ad_name, impressions, " + \
+                "clicks, total_cost_in_cents"
+        self.write_row(columns)
+
+    def write_row(self, row):
+        """Add a Unicode line (without its line ending) to the output"""
+
+        self.pending.append(row)
+        self.pending_size += len(row)
+        if self.pending_size >= self.buffer_size:
+            self.flush()
+
+    def write(self, data):
+        """Write already encoded output, after anything still held back"""
+
+        self.flush()
+        self.stream.write(data)
+
+    def flush(self):
+        """Encode and write out everything held back"""
+
+        if self.pending:
+            self.pending.append(u"")
+            self.stream.write(self.encode(u"\n".join(self.pending))[0])
+            self.pending = []
+            self.pending_size = 0
+        self.stream.flush()
+
+def output_settings(options=None):
+    """
+    Return the (encoding, bom) output settings from the command-line
+    options, if given.
+    """
+
+    if options is not None:
+        return options.output_encoding, not options.no_output_bom
+    return 'utf-8', True
+
+class RunContext(object):
+    """
+    The state that producing output keeps over a run: the OutputWriter,
+    the duplicate record tracker, the adsymbols.SymbolTable of ad groups
+    and names, the rollups, the adindex.FileEntries of the current input
+    and the Quarantine. Each is made from the command-line options (if
+    given) on first use, unless it was given or set beforehand.
+
+    A context is passed to the producer as its args (see AdDataReader and
+    make_reader), so that each run, or each file of a batch processed apart
+    from the rest, keeps its own state, and none is kept in the options.
+    """
+
+    def __init__(self, options=None, writer=None, deduper=None, rejects=None):
+        self.options = options
+        self.writer = writer
+        self.deduper = deduper
+        self.rejects = rejects
+        self.symbols = None
+        self.aggregators = None
+        # Set by whoever starts an input that is to be indexed
+        self.index_entries = None
+
+    def output_writer(self):
+        """The OutputWriter, writing to standard output unless one was given"""
+
+        if self.writer is None:
+            encoding, bom = output_settings(self.options)
+            self.writer = OutputWriter(sys.stdout, encoding, bom,
+                getattr(self.options, 'output_buffer', 256*1024))
+        return self.writer
+
+    def record_deduper(self):
+        """The duplicate record tracker"""
+
+        if self.deduper is None:
+            options = self.options
+            self.deduper = addedup.make_deduper(
+                getattr(options, 'dedup', 'exact'),
+                getattr(options, 'dedup_capacity', 1000000),
+                getattr(options, 'dedup_fp_rate', 0.001))
+        return self.deduper
+
+    def row_symbols(self):
+        """The adsymbols.SymbolTable of ad groups and names"""
+
+        if self.symbols is None:
+            import adsymbols
+            self.symbols = adsymbols.SymbolTable()
+        return self.symbols
+
+    def row_aggregators(self):
+        """
+        The list of adaggregate.Aggregators, which is empty unless the
+        options ask for rollups.
+        """
+
+        if self.aggregators is None:
+            import adaggregate
+            self.aggregators = adaggregate.make_aggregators(
+                getattr(self.options, 'aggregate', None) or [])
+        return self.aggregators
+
+    def row_quarantine(self):
+        """The Quarantine, or None if quarantine mode is not on"""
+
+        path = getattr(self.options, 'quarantine', None)
+        if self.rejects is None and path:
+            checkpoint = getattr(self.options, 'checkpoint', None)
+            if checkpoint and os.path.exists(checkpoint):
+                # Resuming: the checkpoint cuts the file back to the rows
+                # rejected before its save
+                self.rejects = Quarantine(open(path, "ab"), header=False)
+            else:
+                self.rejects = Quarantine(open(path, "wb"))
+        return self.rejects
+
+# The context of producers that are given no args
+DEFAULT_CONTEXT = None
 
-    sys.stdout.write((s + u"\n").encode(codec))
+def run_context(args):
+    """
+    Return the RunContext in the producer args, or, if there are none, one
+    shared by all such producers.
+    """
+
+    global DEFAULT_CONTEXT
+    if len(args) > 0:
+        return args[0]
+    if DEFAULT_CONTEXT is None:
+        DEFAULT_CONTEXT = RunContext()
+    return DEFAULT_CONTEXT
 
 def default_producer(ad_info, first, args):
     """
@@ -499,66 +1588,155 @@ def default_producer(ad_info, first, args):
     of what we know is from the sample data file.
     """
 
-    if len(args) > 0:
-        args = args[0]
-        encoding = args.output_encoding
-        bom = not args.no_output_bom
-    else:
-        encoding = 'utf-8'
-        bom = True
-
+    context = run_context(args)
+    writer = context.output_writer()
     if first:
-        if bom:
-            if encoding == 'utf-8':
-                sys.stdout.write(codecs.BOM_UTF8)
-            elif encoding == 'utf-16':
-                sys.stdout.write(codecs.BOM_UTF16)
-            elif encoding == 'utf-16-be':
-                sys.stdout.write(codecs.BOM_UTF16_BE)
-            elif encoding == 'utf-16-le':
-                sys.stdout.write(codecs.BOM_UTF16_LE)
-            elif encoding == 'utf-32':
-                sys.stdout.write(codecs.BOM_UTF32)
-            elif encoding == 'utf-32-be':
-                sys.stdout.write(codecs.BOM_UTF32_BE)
-            elif encoding == 'utf-32-le':
-                sys.stdout.write(codecs.BOM_UTF32_LE)
-            else:
-                logging.warning("Unicode BOM requested for unknown codec, '%s'" % encoding)
-
-        output_encoded_string(u"report_date, ad_group, ad_name, impressions, " +
-            "clicks, total_cost_in_cents", encoding)
-
-    # Dollars to cents
-    # Note that there is a great deal wrong with this, but a full treatment of correct
-    # fractional currency handling is outside of the scope of this project right now.
-    total_cost = int(round(ad_info.total_cost * 100))
+        writer.write_header()
+
+    # The ad group and name are folded and escaped once per run, not per row
+    symbols = context.row_symbols()
+    ids = symbols.ids
+    group = ids.get(ad_info.ad_group)
+    if group is None:
+        group = symbols.add(ad_info.ad_group)
+    name = ids.get(ad_info.ad_name)
+    if name is None:
+        name = symbols.add(ad_info.ad_name)
     key = u"%s,%s,%s" % (
         ad_info.date,
-        csv_string(ad_info.ad_group.lower()),
-        csv_string(ad_info.ad_name.lower()),
+        symbols.csv[group],
+        symbols.csv[name],
     )
 
-    global UNIQUE_RECORDS_SEEN
-    if key in UNIQUE_RECORDS_SEEN:
+    if not context.record_deduper().add(ad_info.date, key, symbols.pair(group, name)):
         logging.error("Duplicate record for key: %s" % key)
         exit(1)
-    UNIQUE_RECORDS_SEEN[key] = 1
 
-    row = u"%s,%s,%s,%d,%d,%d" % (
-        ad_info.date,
-        csv_string(ad_info.ad_group.lower()),
-        csv_string(ad_info.ad_name.lower()),
+    row = u"%s,%d,%d,%d" % (
+        key,
         ad_info.impressions,
         ad_info.clicks,
-        total_cost,
+        ad_info.total_cost_in_cents,
     )
-    output_encoded_string(row, encoding)
+    writer.write_row(row)
+
+    aggregators = context.row_aggregators()
+    if aggregators:
+        ad_group = symbols.names[group]
+        ad_name = symbols.names[name]
+        for aggregator in aggregators:
+            aggregator.add_folded(ad_info, ad_group, ad_name)
+    entries = context.index_entries
+    if entries is not None:
+        entries.add(ad_info)
+
+def parse_report_date(text):
+    """Return the report date in the text of a date header, or None"""
+
+    m = AdDataReader.DATE_MMDDYYYY_RE.search(text)
+    if m:
+        return "%s-%s-%s" % m.group(3, 1, 2)
+    m = AdDataReader.DATE_ISO_RE.search(text)
+    if m:
+        return "%s-%s-%s" % m.group(1, 2, 3)
+    m = AdDataReader.DATE_SIMPLE_RE.search(text)
+    if m:
+        month = AdDataReader.MONTH_MAP[m.group(1).lower()]
+        day = m.group(2)
+        if len(day) == 1:
+            day = "0" + day
+        year = m.group(3)
+        return "%s-%s-%s" % (year, month, day)
+    return None
+
+def read_report_date(path, args):
+    """
+    Return the report date of the file at path, read from its date header
+    alone, or None if it cannot be read.
+    """
+
+    try:
+        inputfile = adcompress.open_text(path, args.input_encoding)
+        try:
+            line = inputfile.readline()
+        finally:
+            inputfile.close()
+        return parse_report_date(split_fields_reference(line.strip())[0])
+    except (EnvironmentError, UnicodeError, CSVError):
+        return None
+
+def find_inputs(names, pattern):
+    """
+    Expand the input names given on the command line into a list of files,
+    replacing each directory with the files in it that match pattern.
+    """
+
+    paths = []
+    for name in names:
+        if os.path.isdir(name):
+            for filename in sorted(fnmatch.filter(os.listdir(name), pattern)):
+                path = os.path.join(name, filename)
+                if os.path.isfile(path):
+                    paths.append(path)
+        else:
+            paths.append(name)
+    return paths
+
+def reads_mapped(path, args, mapped=False):
+    """
+    True if make_reader reads path through a MappedSource: if mapped is true,
+    or args.mmap is, or an --index file is asked for (which stores the byte
+    offset of each row), unless path is standard input or compressed.
+    """
+
+    return bool((mapped or args.mmap or getattr(args, 'index', None)) and
+        path != '-' and adcompress.compression_of(path) is None)
+
+def make_reader(path, args, produce=default_producer, mapped=False, context=None,
+        **options):
+    """
+    Build an AdDataReader for one input, path, configured by the command-line
+    options in args. The producer is given context, a RunContext (by
+    default, a new one for args), as its args. Files are read through a
+    MappedSource when reads_mapped says so, given mapped. Compressed input
+    is decompressed as it is read. Any other keyword options are passed on
+    to the reader.
+    """
+
+    if context is None:
+        context = RunContext(args)
+    block_size = args.block_size
+    if reads_mapped(path, args, mapped):
+        source = MappedSource(path, args.input_encoding)
+        block_size = None
+    else:
+        source = adcompress.open_text(sys.stdin if path == '-' else path,
+            args.input_encoding, args.decompress_thread)
+    reader = AdDataReader(
+        source,
+        produce,
+        args.no_total_warning,
+        context,
+        engine=args.csv_engine,
+        block_size=block_size,
+        multiline=args.multiline,
+        validation=args.validation,
+        validation_batch=args.validation_batch,
+        quarantine=context.row_quarantine(),
+        warning_limit=args.warning_limit,
+        warning_sample=args.warning_sample,
+        **options)
+    if context.index_entries is not None:
+        # The entries take the byte offset of each row from the reader
+        context.index_entries.reader = reader
+    return reader
+
+def parse_command_line(argv):
+    """Parse and normalize the command-line arguments (without the program name)"""
 
-def main(argv):
     parser = argparse.ArgumentParser(description="ad metrics CSV processor")
-    parser.add_argument('input', type=str, default='-', nargs='?',
-        help="input file or '-' for stdin (default='utf-8')")
+    parser.add_argument('input', type=str, default=['-'], nargs='*',
+        help="input files or directories, or '-' for stdin (default='-')")
     parser.add_argument('--input-encoding', dest='input_encoding', action='store',
         default='utf-8', help="character encoding for input (default='utf-8')")
     parser.add_argument('--output-encoding', dest='output_encoding', action='store',
@@ -570,22 +1748,222 @@ def main(argv):
     parser.add_argument('--no-total-warning', dest='no_total_warning',
         action='store_true', default=False,
         help="do not print a warning on summary lines")
-    args = parser.parse_args()
+    parser.add_argument('--block-size', dest='block_size', action='store',
+        type=int, default=1024*1024,
+        help="read input in blocks of this many bytes, or 0 to read " + \
+            "line by line (default=1048576)")
+    parser.add_argument('--mmap', dest='mmap', action='store_true', default=False,
+        help="memory-map the input file instead of streaming it")
+    parser.add_argument('--decompress-thread', dest='decompress_thread',
+        action='store_true', default=False,
+        help="decompress compressed input in a background thread, " + \
+            "alongside the parsing")
+    parser.add_argument('--multiline-quotes', dest='multiline', action='store_true',
+        default=False,
+        help="allow quoted values to continue across line breaks")
+    parser.add_argument('--jobs', dest='jobs', action='store', type=int, default=1,
+        help="parse an input file, or a batch of them, in this many worker " + \
+            "processes (default=1)")
+    parser.add_argument('--pattern', dest='pattern', action='store', default='*.csv*',
+        help="files to take from input directories (default='*.csv*')")
+    parser.add_argument('--pipeline', dest='pipeline', action='store_true',
+        default=False,
+        help="read, parse and write an input file in separate stages that " + \
+            "run at the same time, parsing in --jobs worker processes if " + \
+            "that is more than 1; this only helps when reading the input or " + \
+            "writing the output is slow (a network filesystem or a pipe), " + \
+            "and is otherwise slower than reading serially")
+    parser.add_argument('--pipeline-depth', dest='pipeline_depth', action='store',
+        type=int, default=4,
+        help="chunks of input that may wait between pipeline stages (default=4)")
+    parser.add_argument('--pipeline-stats', dest='pipeline_stats',
+        action='store_true', default=False,
+        help="report where the time went in each pipeline stage at the end")
+    parser.add_argument('--timings', dest='timings', action='store_true', default=False,
+        help="report the time taken for each input file in batch mode")
+    parser.add_argument('--validation', dest='validation', action='store',
+        default='row', choices=('row', 'columnar'),
+        help="check rows one at a time, or in batches with NumPy if it " + \
+            "is available (default='row')")
+    parser.add_argument('--validation-batch', dest='validation_batch', action='store',
+        type=int, default=10000,
+        help="rows per batch for columnar validation (default=10000)")
+    parser.add_argument('--csv-engine', dest='csv_engine', action='store',
+        default='fast', choices=sorted(CSV_ENGINES.keys()),
+        help="CSV tokenizer to use (default='fast')")
+    parser.add_argument('--sqlite', dest='sqlite', action='store', default=None,
+        help="load the data into the ad_report_data table of this SQLite " + \
+            "database instead of writing CSV output")
+    parser.add_argument('--sqlite-batch', dest='sqlite_batch', action='store',
+        type=int, default=10000,
+        help="rows per insert when loading into SQLite (default=10000)")
+    parser.add_argument('--output-buffer', dest='output_buffer', action='store',
+        type=int, default=256*1024,
+        help="characters of output to collect between writes (default=262144)")
+    parser.add_argument('--dedup', dest='dedup', action='store', default='exact',
+        choices=sorted(addedup.DEDUPERS.keys()),
+        help="how to check for duplicate records: a digest of every key, " + \
+            "or a Bloom filter backed by a file on disk (default='exact')")
+    parser.add_argument('--dedup-capacity', dest='dedup_capacity', action='store',
+        type=int, default=1000000,
+        help="records the Bloom filter is sized for (default=1000000)")
+    parser.add_argument('--dedup-fp-rate', dest='dedup_fp_rate', action='store',
+        type=float, default=0.001,
+        help="Bloom filter false positive rate at capacity (default=0.001)")
+    parser.add_argument('--checkpoint', dest='checkpoint', action='store',
+        default=None,
+        help="save progress through the input to this file, and resume " + \
+            "from it if it exists; output from a resumed run carries on " + \
+            "from the last save, with no header")
+    parser.add_argument('--checkpoint-every', dest='checkpoint_every',
+        action='store', type=int, default=100000,
+        help="data rows between checkpoints (default=100000)")
+    parser.add_argument('--quarantine', dest='quarantine', action='store',
+        default=None,
+        help="write rows that cannot be used to this file, with the " + \
+            "reasons, and carry on instead of stopping")
+    parser.add_argument('--warning-limit', dest='warning_limit', action='store',
+        type=int, default=None,
+        help="log at most this many warnings of each kind per input, and " + \
+            "a count of the rest (default: no limit)")
+    parser.add_argument('--warning-sample', dest='warning_sample', action='store',
+        type=int, default=None,
+        help="after --warning-limit, log one in this many warnings of " + \
+            "each kind (default: none)")
+    parser.add_argument('--dedup-stats', dest='dedup_stats', action='store_true',
+        default=False, help="report duplicate checking statistics at the end")
+    parser.add_argument('--aggregate', dest='aggregate', action='append',
+        default=None, metavar='FIELDS',
+        help="also total the impressions, clicks and cost of the rows for " + \
+            "each group of FIELDS, some of date, ad_group and ad_name, " + \
+            "given with commas between them; may be given more than once")
+    parser.add_argument('--aggregate-output', dest='aggregate_output',
+        action='store', default=None,
+        help="write the --aggregate totals to this file, in the output " + \
+            "encoding (default: standard error)")
+    parser.add_argument('--index', dest='index', action='store', default=None,
+        help="add the rows of each input file that is read without error " + \
+            "to this index file, for queries by date and ad group or name " + \
+            "with adindex.py")
+    parser.add_argument('--cache-dir', dest='cache_dir', action='store',
+        default=None,
+        help="keep the parsed rows of each input file in this directory, " + \
+            "and use them instead of parsing the file again while it is " + \
+            "unchanged")
+    args = parser.parse_args(argv)
     # Normalize encoding name per rules in codecs module
     args.output_encoding = args.output_encoding.lower()
     args.output_encoding.replace('_','-')
-    if args.input == '-':
-        inputfile = sys.stdin
-    else:
-        inputfile = open(args.input, "r")
     if args.output_encoding == "ascii":
         args.no_output_bom = True
-    reader = AdDataReader(
-        codecs.getreader(args.input_encoding)(inputfile),
-        default_producer,
-        args.no_total_warning,
-        args)
-    reader.process_input()
+    if '-' in args.input and len(args.input) > 1:
+        parser.error("'-' cannot be used with other inputs")
+    if args.aggregate:
+        import adaggregate
+        for spec in args.aggregate:
+            try:
+                adaggregate.parse_fields(spec)
+            except ValueError as e:
+                parser.error("--aggregate: %s" % e)
+        if args.checkpoint:
+            parser.error("--checkpoint cannot be used with --aggregate")
+    if args.index and args.checkpoint:
+        parser.error("--checkpoint cannot be used with --index")
+    if args.index and args.input == ['-']:
+        parser.error("--index needs input files")
+    if args.checkpoint:
+        if len(args.input) != 1 or args.input == ['-'] or os.path.isdir(args.input[0]):
+            parser.error("--checkpoint needs a single input file")
+        if args.jobs > 1:
+            parser.error("--checkpoint cannot be used with --jobs")
+        if args.pipeline:
+            parser.error("--checkpoint cannot be used with --pipeline")
+        if os.path.isfile(args.input[0]) and \
+                adcompress.compression_of(args.input[0]) is not None:
+            parser.error("--checkpoint cannot be used with compressed input")
+    if args.cache_dir:
+        if args.checkpoint:
+            parser.error("--cache-dir cannot be used with --checkpoint")
+        if args.quarantine:
+            parser.error("--cache-dir cannot be used with --quarantine")
+    return args
+
+def main(argv):
+    args = parse_command_line(argv[1:])
+    paths = find_inputs(args.input, args.pattern)
+    if not paths:
+        logging.error("No input files found in %s" % ", ".join(args.input))
+        exit(1)
+    if args.sqlite:
+        import adsqlite
+        if not adsqlite.load_files(paths, args):
+            exit(1)
+        return
+    if len(paths) != 1 or paths != args.input:
+        # Several files, or a directory: each file is processed on its own
+        # and a failure in one does not stop the rest.
+        import adparallel
+        if not adparallel.process_files(paths, args, args.jobs):
+            exit(1)
+        return
+    context = RunContext(args)
+    options = {}
+    if args.checkpoint:
+        import adcheckpoint
+        options['checkpoint'] = adcheckpoint.Checkpoint(args.checkpoint,
+            args.checkpoint_every, context.record_deduper(),
+            context.output_writer().flush)
+    index = None
+    if args.index:
+        # The rows are stored as they come, and dropped again if the input fails
+        import adindex
+        index = adindex.ReportIndex(args.index)
+        context.index_entries = index.entries(paths[0])
+    mapped = args.jobs > 1 or args.checkpoint
+    pipelines = []
+    def parse(produce):
+        reader = make_reader(paths[0], args, produce, mapped=mapped,
+            context=context, **options)
+        try:
+            if args.pipeline:
+                import adpipeline
+                pipelines.append(adpipeline.Pipeline(reader, args.jobs,
+                    args.pipeline_depth))
+                pipelines[0].run()
+            elif args.jobs > 1 and isinstance(reader.source, MappedSource):
+                import adparallel
+                adparallel.process_sharded(reader, args.jobs)
+            else:
+                reader.process_input()
+        finally:
+            if paths[0] != '-':
+                reader.source.close()
+    try:
+        if args.cache_dir and paths[0] != '-':
+            import adcache
+            adcache.process_cached(paths[0], args, parse, default_producer,
+                mapped=mapped, context=context)
+        else:
+            parse(default_producer)
+        if args.aggregate:
+            import adaggregate
+            adaggregate.write_requested(context.row_aggregators(), args)
+        if index is not None:
+            index.finish(context.index_entries)
+    except SystemExit:
+        if index is not None:
+            index.discard(context.index_entries)
+        raise
+    finally:
+        # Rows produced before any error are still written out
+        context.output_writer().flush()
+        if pipelines and args.pipeline_stats:
+            sys.stderr.write("pipeline:\n%s\n" % pipelines[0].stats.report())
+        if args.dedup_stats:
+            sys.stderr.write("dedup: %s\n" % addedup.format_stats(
+                context.record_deduper().stats()))
+        if index is not None:
+            index.close()
 
 if __name__ == "__main__":
     main(sys.argv)
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+
+# Fast parsing of the numeric fields of ad report rows.
+#
+# These accept exactly what the string_to_integer, string_to_float and
+# money_string_to_float helpers that admetrics used before accept (the
+# originals are kept in test_adnumbers, and admetrics keeps the names as
+# wrappers over these), and raise ValueError with
+# the same messages for anything else, but take the quickest route for
+# well-formed values: int() and float() are tried on the value before
+# anything else (they allow surrounding whitespace themselves), and costs
+# are checked by hand and turned straight into integer cents, without
+# going through a float. Values are made str first in every case, as the
+# helpers do, so that only ASCII digits are accepted.
+#
+# Money is kept as integer cents throughout, so that totals are exact. A
+# cost in another currency can be converted to cents as it is parsed, by
+# registering its symbol with register_currency; costs with a symbol that
+# has not been registered are refused, as they always have been.
+
+import re
+
+# A cost once its currency symbol is removed: dollars and exactly two
+# digits of cents
+CENTS_RE = re.compile(r"(-?\d+)\.(\d\d)$")
+
+# Currency symbols other than "$", each mapped to a function that converts
+# an amount in its hundredths into US cents
+CURRENCIES = {}
+
+def parse_int(s):
+    """Convert a string to an integer, with error checking"""
+
+    s = str(s)
+    try:
+        return int(s)
+    except ValueError:
+        pass
+    s = s.strip()
+    if len(s) == 0:
+        raise ValueError("Empty string as number")
+    return int(float(s))
+
+def parse_float(s):
+    """Convert a string to a floating point value, with error checking"""
+
+    s = str(s)
+    try:
+        return float(s)
+    except ValueError:
+        pass
+    s = s.strip()
+    if len(s) == 0:
+        raise ValueError("Empty string as number")
+    return float(s)
+
+def parse_ctr(s):
+    """Convert a CTR to a ratio. Google's AdWords report uses percent."""
+
+    if s.endswith('%'):
+        return parse_float(s[0:len(s)-1])/100.0
+    return parse_float(s)
+
+def parse_cents(s):
+    """Convert a dollar value, such as "$12.34", into integer cents"""
+
+    try:
+        s = str(s).strip()
+    except UnicodeError:
+        # Only a registered currency symbol can make this a cost
+        s = s.strip()
+        if s[:1] not in CURRENCIES:
+            raise ValueError("TBD: No currency conversions available, yet")
+        return CURRENCIES[s[0]](parse_cents("$" + s[1:]))
+    if s[:1] == "$":
+        value = s[1:]
+        signed = True
+    else:
+        value = s
+        signed = False
+    # The usual case is checked by hand, which is quicker than the pattern.
+    # The dollars and cents are put back together so that the sign of a
+    # negative amount covers both: "-1" and "50" make -150.
+    if value[-3:-2] == '.':
+        dollars = value[:-3]
+        cents = value[-2:]
+        if cents.isdigit():
+            if dollars.isdigit():
+                return int(dollars + cents)
+            if signed and dollars[:1] == '-' and dollars[1:].isdigit():
+                return int(dollars + cents)
+    return _parse_cents_slowly(s)
+
+def _parse_cents_slowly(s):
+    """parse_cents for anything out of the ordinary, and errors"""
+
+    if len(s) == 0:
+        raise ValueError("Empty string a money value")
+    currency = s[0]
+    if currency == "$":
+        value = s[1:]
+    elif currency in "0123456789":
+        # AdWords seems to assume the currency of the account, and not
+        # output it. Ick. We'll default to USD.
+        value = s
+    elif currency in CURRENCIES:
+        return CURRENCIES[currency](parse_cents("$" + s[1:]))
+    else:
+        raise ValueError("TBD: No currency conversions available, yet")
+    if len(value) == 0:
+        raise ValueError("$ must be followed by numeric amount")
+    m = CENTS_RE.match(value)
+    if m is None:
+        raise ValueError("Currency value must be $d or $d.cc")
+    dollars, cents = m.groups()
+    return int(dollars + cents)
+
+def format_cents(cents):
+    """Format integer cents as dollars and cents, such as 12.34 or -0.05"""
+
+    sign = "-" if cents < 0 else ""
+    dollars, cents = divmod(abs(cents), 100)
+    return "%s%d.%02d" % (sign, dollars, cents)
+
+def exchange_rate(rate):
+    """
+    Return a conversion function for register_currency that multiplies by
+    rate, given as a decimal string such as "1.0825" US dollars to one unit
+    of the currency, and rounds to the nearest cent (halves away from zero).
+    The arithmetic is done in integers, so the results are exact.
+    """
+
+    whole, _, fraction = str(rate).strip().partition(".")
+    if not (whole + fraction).isdigit():
+        raise ValueError("Exchange rate must be a positive decimal: %s" % rate)
+    numerator = int(whole + fraction)
+    denominator = 10 ** len(fraction)
+    def convert(amount):
+        cents = (abs(amount) * numerator * 2 + denominator) // (denominator * 2)
+        return -cents if amount < 0 else cents
+    return convert
+
+def register_currency(symbol, convert):
+    """
+    Accept costs starting with the currency symbol, such as u"\\u20ac" for
+    the euro, converting their amounts with convert, a function from
+    hundredths of the currency to US cents (see exchange_rate). A convert
+    of None withdraws the symbol again.
+    """
+
+    if symbol == "$" or symbol in "0123456789-" or len(symbol) != 1:
+        raise ValueError("Not usable as a currency symbol: %r" % symbol)
+    if convert is None:
+        CURRENCIES.pop(symbol, None)
+    else:
+        CURRENCIES[symbol] = convert
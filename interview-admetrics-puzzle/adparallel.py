@@ -0,0 +1,483 @@
+#!/usr/bin/python
+
+# Parallel processing for the admetrics module.
+#
+# A single large report is processed by splitting the data lines that
+# follow its header into byte-range shards, parsing and validating each
+# shard in a worker process, and then replaying the results in the parent
+# in file order. The parent does everything that depends on the rows that
+# came before: it calls the producer, logs the workers' diagnostics,
+# merges the running totals and checks any summary line against them. The
+# result is the same output, warnings and errors as
+# AdDataReader.process_input would give.
+#
+# Shards always start at the beginning of a line. When quoted values may
+# span lines, the cut points are chosen so that an even number of quotes
+# precedes them, which is right for any sane input. Each worker also
+# reports whether its shard ended inside an open quote, which is the
+# only way a bad cut shows up. If that happens, the parent goes back to
+# parsing serially from the start of that shard.
+#
+# A batch of report files is processed by handing whole files to the
+# workers, each with its own AdDataReader. Their output and diagnostics
+# are collected and passed back to the parent, which writes them out in
+# the order the files were given. A file that fails has its output
+# discarded and does not stop the others. Each worker checks its own file
+# for duplicate records, and passes back the keys of its rows, which the
+# parent checks against those of the files before it, for the same report
+# date, before it writes the file's output. A file with a record that an
+# earlier file already gave is turned away as a whole. The parent reads
+# the report date of every file up front, so that it can drop the keys of
+# a date once the last file with that date is done.
+#
+# The pools are shut down with close() and join() rather than
+# terminate(), which can kill a worker part way through sending its
+# result and leave the pool waiting forever for the lock it held; the pool
+# for files is only terminated when the parent gives up on an exception,
+# and wants nothing more from it. So that
+# an early stop (a fatal error in a row, say) does not have to wait for
+# the whole file to be parsed, only a few shards are handed out at a time.
+
+import sys
+import time
+import logging
+import itertools
+import threading
+import multiprocessing
+from cStringIO import StringIO
+
+import addedup
+import admetrics
+from admetrics import AdDataReader, MappedSource, OutputWriter, Quarantine
+from admetrics import quote_is_open
+
+# Size of the pieces that the mapped file is copied out in for counting
+COUNT_CHUNK = 8 * 1024 * 1024
+
+# Event types passed back from the workers
+ROW = 'row'
+LOG = 'log'
+WARNING = 'warning'
+REJECT = 'reject'
+SUMMARY = 'summary'
+FATAL = 'fatal'
+CRASH = 'crash'
+
+def count_bytes(data, char, start, end):
+    """Count occurrences of a single-byte string in data[start:end]"""
+
+    total = 0
+    while start < end:
+        stop = min(start + COUNT_CHUNK, end)
+        total += data[start:stop].count(char)
+        start = stop
+    return total
+
+def find_shards(source, count, multiline=False):
+    """
+    Split the rest of a MappedSource, from its current position to its end,
+    into about count (start, end) byte ranges that each begin on a line
+    boundary. With multiline set, a cut is only made where an even number of
+    quotes precedes it.
+    """
+
+    start = source.pos
+    end = source.end
+    step = max((end - start) // max(count, 1), 1)
+    cuts = [start]
+    quotes = 0
+    counted = start
+    while True:
+        newline = source.map.find("\n", cuts[-1] + step, end) if end > start else -1
+        if newline < 0:
+            break
+        cut = newline + 1
+        if multiline:
+            quotes += count_bytes(source.map, '"', counted, cut)
+            counted = cut
+            while quotes % 2 and cut < end:
+                newline = source.map.find("\n", cut, end)
+                cut = end if newline < 0 else newline + 1
+                quotes += count_bytes(source.map, '"', counted, cut)
+                counted = cut
+        if cut >= end:
+            break
+        cuts.append(cut)
+    cuts.append(end)
+    return zip(cuts[:-1], cuts[1:])
+
+class ShardReader(AdDataReader):
+    """
+    An AdDataReader for one shard of a file, run in a worker process. It
+    starts with the date and column names already known, and records rows,
+    summary lines and diagnostics in order in self.events instead of acting
+    on them.
+    """
+
+    def __init__(self, source, lineno, date, colnames, no_total_warning, options):
+        """
+        Set up to read source, which starts at the beginning of line number
+        lineno + 1. The date, column names and reader options are those found
+        by the parent.
+        """
+
+        super(ShardReader, self).__init__(
+            source,
+            None,
+            no_total_warning,
+            **options)
+        self.lineno = lineno
+        self.date = date
+        self.colnames = colnames
+        self._start_rows()
+        self.events = []
+        self.ended_open = False
+        # The last line used, for when the shard ends without one
+        self.last_row = None
+
+    def run(self):
+        """Process the shard, stopping at the first fatal error"""
+
+        try:
+            # Rows are read as the reader's validation mode has them read
+            for row_data in self._records(False):
+                self.events.append((ROW, row_data, self.row_offset))
+        except SystemExit:
+            self.events.append((FATAL,))
+        except Exception as e:
+            # Either a genuine problem with the data or the result of a
+            # quoted value being cut short at the end of the shard. Only the
+            # parent can tell which, so leave it to decide whether to raise it.
+            self.events.append((CRASH, e))
+        # The row we stopped on, or the last one read at the end of the shard
+        row = self.lastline or self.last_row
+        if self.multiline and row:
+            self.ended_open = quote_is_open(row.strip())
+
+    def _use_row(self, row_data):
+        """Save a summary line for the parent, or count a data line"""
+
+        self.last_row = self.lastline
+        if self._is_summary(row_data):
+            self.events.append((SUMMARY, row_data, dict(self.accumulator),
+                self._save_state()))
+            return False
+        return self._accept_row(row_data)
+
+    def _emit(self, level, text):
+        """Save diagnostics for the parent to log in order"""
+
+        self.events.append((LOG, level, text))
+
+    def _warning(self, message, category=None, args=None):
+        """
+        Save a warning for the parent, which keeps the counts. Only warnings
+        that are within the limit for this shard can be within the limit
+        overall, so only those are formatted.
+        """
+
+        category = category or message
+        text = None
+        if self.diagnostics.wanted(logging.WARNING, category):
+            if args is not None:
+                message = message % args
+            text = self._format_warning(message)
+        self.events.append((WARNING, category, text))
+
+    def _reject(self, message, exception=None):
+        """Save a rejected line for the parent to quarantine"""
+
+        if not self.quarantine:
+            super(ShardReader, self)._reject(message, exception)
+            return
+        if exception is not None:
+            message += ": " + exception
+        self.events.append((REJECT, self.lineno, message, self.lastline))
+
+    def _report_totals(self):
+        """The parent sums up for the whole file"""
+
+        pass
+
+def parse_shard(task):
+    """Worker entry point: parse one shard and return what was found"""
+
+    path, encoding, start, end = task[:4]
+    reader = ShardReader(MappedSource(path, encoding, start, end), *task[4:])
+    reader.run()
+    return reader.events, reader.accumulator, reader.ended_open
+
+def merge_totals(a, b):
+    """Return the sum of two reader accumulators"""
+
+    return dict((key, a[key] + b[key]) for key in a)
+
+def replay_events(reader, events, totals, first):
+    """
+    Act on the events recorded by a ShardReader, in the parent, as the
+    reader would have on reaching them itself. The totals are those of the
+    rows before the shard. Returns whether the next row produced will be
+    the first.
+    """
+
+    for event in events:
+        kind = event[0]
+        if kind == ROW:
+            reader.row_offset = event[2]
+            reader._produce(event[1], first)
+            first = False
+        elif kind == LOG:
+            reader._emit(event[1], event[2])
+        elif kind == WARNING:
+            if reader.diagnostics.wanted(logging.WARNING, event[1]):
+                reader._emit(logging.WARNING, event[2])
+        elif kind == REJECT:
+            reader.quarantine.reject(reader.source.name, *event[1:])
+        elif kind == SUMMARY:
+            row_data, partial, state = event[1:]
+            reader._restore_state(state)
+            reader.accumulator = merge_totals(totals, partial)
+            reader._check_summary(row_data)
+        elif kind == CRASH:
+            raise event[1]
+        else:
+            reader._flush_batch()
+            reader._report_totals()
+            exit(1)
+    return first
+
+def shard_options(reader):
+    """The options of a ShardReader that reads as reader does"""
+
+    return {'engine': reader.engine, 'multiline': reader.multiline,
+        'validation': reader.validation,
+        'validation_batch': reader.validation_batch,
+        # A sampled warning may be any one, but one beyond the limit for a
+        # shard is beyond it overall
+        'warning_limit': None if reader.diagnostics.sample else reader.diagnostics.limit,
+        # The workers only need to know whether to quarantine lines
+        'quarantine': True if reader.quarantine is not None else None}
+
+def process_sharded(reader, jobs=None, shards=None):
+    """
+    Do the work of reader.process_input() with a pool of jobs worker
+    processes (default: one per CPU). The reader must be reading from a
+    MappedSource positioned at the start of the file, and its producer is
+    called in the parent, in file order. The data is split into shards
+    pieces, by default four per worker.
+    """
+
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if shards is None:
+        shards = jobs * 4
+    source = reader.source
+    reader._read_header()
+    ranges = find_shards(source, shards, reader.multiline)
+    options = shard_options(reader)
+    tasks = []
+    lineno = reader.lineno
+    for start, end in ranges:
+        tasks.append((source.name, source.encoding, start, end, lineno,
+            reader.date, reader.colnames, reader.no_total_warning, options))
+        lineno += count_bytes(source.map, "\n", start, end)
+
+    totals = dict(reader.accumulator)
+    first = True
+    # Shards handed to the pool and not yet replayed are counted here
+    handed_out = threading.Semaphore(jobs * 2)
+    stopping = threading.Event()
+    def feed():
+        for task in tasks:
+            handed_out.acquire()
+            if stopping.is_set():
+                return
+            yield task
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for task, result in itertools.izip(tasks, pool.imap(parse_shard, feed())):
+            handed_out.release()
+            events, accumulator, ended_open = result
+            if ended_open:
+                # The next shard started inside a quoted value, so parse the
+                # rest of the file here, from the start of this shard
+                source.pos = task[2]
+                reader.lineno = task[4]
+                reader.accumulator = totals
+                for row_data in reader._records(False):
+                    reader._produce(row_data, first)
+                    first = False
+                reader._flush_batch()
+                reader._report_totals()
+                return
+            first = replay_events(reader, events, totals, first)
+            totals = merge_totals(totals, accumulator)
+        reader.lineno = lineno
+        reader.accumulator = totals
+        reader._flush_batch()
+        reader._report_totals()
+    finally:
+        stopping.set()
+        handed_out.release()
+        pool.close()
+        pool.join()
+
+class CapturingHandler(logging.Handler):
+    """A logging handler that keeps (level, message) pairs for the parent"""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append((record.levelno, record.getMessage()))
+
+def process_file(task):
+    """
+    Worker entry point: process one whole report file as the command line
+    would, given (path, args). Returns (path, ok, output, rejected, messages,
+    rows, seconds, aggregators, entries, date, keys), where output is empty
+    if the file failed, rejected holds any quarantined lines, aggregators
+    has the file's rollups, if any were asked for, entries its rows for the
+    --index file, if there is one, and keys the keys of its rows, for their
+    report date.
+    """
+
+    path, args = task
+    rows = [0]
+    def produce(ad_info, first, args):
+        rows[0] += 1
+        admetrics.default_producer(ad_info, False, args)
+
+    # The header is written by the parent, so the rows need no BOM
+    output = StringIO()
+    rejected = StringIO()
+    context = admetrics.RunContext(args,
+        OutputWriter(output, args.output_encoding, False, args.output_buffer),
+        rejects=Quarantine(rejected, header=False) if args.quarantine else None)
+    if args.index:
+        import adindex
+        context.index_entries = adindex.FileEntries(path)
+    keys = addedup.KeyRecorder(context.record_deduper())
+    context.deduper = keys
+    handler = CapturingHandler()
+    root = logging.getLogger()
+    saved_handlers = root.handlers
+    root.handlers = [handler]
+    started = time.time()
+    ok = True
+    try:
+        if args.cache_dir and path != '-':
+            import adcache
+            adcache.process_cached(path, args, lambda produce:
+                admetrics.make_reader(path, args, produce,
+                    context=context).process_input(), produce, context=context)
+        else:
+            admetrics.make_reader(path, args, produce, context=context).process_input()
+        context.writer.flush()
+    except SystemExit:
+        ok = False
+    except Exception as e:
+        logging.error("While processing %s:\n  %s" % (path, e))
+        ok = False
+    finally:
+        root.handlers = saved_handlers
+    elapsed = time.time() - started
+    return (path, ok, output.getvalue() if ok else "", rejected.getvalue(),
+        handler.messages, rows[0], elapsed, context.row_aggregators(),
+        context.index_entries, keys.date, keys.keys if ok else [])
+
+def finished_dates(paths, args):
+    """
+    Return a dict giving, for the index of each of paths, the report dates
+    that no later file has, read from the files' date headers. A file whose
+    date cannot be read might have any date, so none is finished before it.
+    """
+
+    last = {}
+    for i, path in enumerate(paths):
+        last[admetrics.read_report_date(path, args)] = i
+    unknown = last.pop(None, -1)
+    finished = {}
+    for date, i in last.items():
+        finished.setdefault(max(i, unknown), []).append(date)
+    return finished
+
+def process_files(paths, args, jobs=1):
+    """
+    Process a batch of report files as the command line would, using a pool
+    of jobs worker processes (or none, if jobs is 1). The output header is
+    written once, followed by each good file's rows in the order given.
+    Any rollups asked for cover the good files, and are written at the end;
+    the good files are also added to any --index file as they finish. A
+    file with a record already given by an earlier one is not a good file;
+    the keys of a report date are kept until its last file is done.
+    Returns True if every file was processed without errors.
+    """
+
+    context = admetrics.RunContext(args)
+    writer = context.output_writer()
+    writer.write_header()
+    rejects = context.row_quarantine()
+    tasks = [(path, args) for path in paths]
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(process_file, tasks)
+    else:
+        results = itertools.imap(process_file, tasks)
+    aggregators = context.row_aggregators()
+    deduper = context.record_deduper()
+    finished = finished_dates(paths, args)
+    index = None
+    if args.index:
+        import adindex
+        index = adindex.ReportIndex(args.index)
+    all_ok = True
+    try:
+        for i, (path, ok, output, rejected, messages, rows, elapsed, aggregates,
+                entries, date, keys) in enumerate(results):
+            for level, message in messages:
+                logging.log(level, message)
+            if ok and keys:
+                duplicate = deduper.add_all(date, keys)
+                if duplicate is not None:
+                    logging.error("Duplicate record for key: %s" % duplicate)
+                    ok = False
+            if ok:
+                writer.write(output)
+            if rejects is not None:
+                rejects.stream.write(rejected)
+            if ok:
+                for aggregator, aggregate in zip(aggregators, aggregates):
+                    aggregator.merge(aggregate)
+                if index is not None:
+                    index.store(entries)
+            else:
+                all_ok = False
+                logging.error("Skipped %s: no output produced for it" % path)
+            if args.timings:
+                sys.stderr.write("%s: %s, %d rows in %.3fs\n" % (
+                    path, "ok" if ok else "failed", rows, elapsed))
+            for date in finished.get(i, ()):
+                deduper.forget(date)
+        if aggregators:
+            import adaggregate
+            adaggregate.write_requested(aggregators, args)
+    except:
+        # Giving up: the files still being worked on are not wanted
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+            pool = None
+        raise
+    finally:
+        writer.flush()
+        if rejects is not None:
+            rejects.stream.close()
+        if index is not None:
+            index.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return all_ok
@@ -0,0 +1,385 @@
+#!/usr/bin/python
+
+# Pipelined processing for the admetrics module.
+#
+# Instead of reading, parsing and producing each row in turn, the work on
+# a report is split into three stages that run at the same time, with a
+# bounded queue between each one and the next:
+#
+# * The read stage (a thread) reads and decodes lines from the input and
+#   groups them into chunks, each ending at the end of a record.
+# * The parse stage (a thread, or a pool of worker processes) tokenizes
+#   and checks each chunk with an adparallel.ShardReader, which records
+#   the rows and diagnostics it finds.
+# * The write stage (the calling thread) replays those in order, as
+#   adparallel does for shards, calling the producer and checking summary
+#   lines against the running totals.
+#
+# So a wait for the disk or for the output no longer stalls the parsing,
+# and with a pool, chunks are parsed on several CPUs. The output,
+# warnings and errors are the same as AdDataReader.process_input gives.
+#
+# Handing chunks between stages costs more than it saves when the input is
+# a local file and the output is fast: bench_admetrics.py pipeline shows
+# pipelined runs slower than serial ones there. It pays only when the
+# stages would otherwise wait on slow input or output, such as a network
+# filesystem or a pipe from another program.
+#
+# Each stage keeps count of the time it spends working and the time it
+# spends waiting on its neighbours, and the queue lengths it sees, so that
+# the stage holding a file back can be picked out (see PipelineStats).
+
+import copy
+import time
+import Queue
+import threading
+import multiprocessing
+
+from admetrics import quote_is_open
+from adcompress import CompressedInputError
+from adparallel import ShardReader, replay_events, merge_totals, shard_options
+
+# Lines of input in a chunk
+CHUNK_LINES = 5000
+
+# What a stage puts on its queue after its last item
+END = None
+
+class ListSource(object):
+    """An input source that hands out a list of lines, for a ShardReader"""
+
+    def __init__(self, name, lines, offsets=None):
+        """
+        Read lines (with their line endings) in order, as from the file name.
+        If the byte offset of each line is given in offsets, it is kept in
+        line_offset as MappedSource does.
+        """
+
+        self.name = name
+        self.lines = lines
+        self.next = 0
+        if offsets is not None:
+            self.offsets = offsets
+            self.line_offset = None
+
+    def readline(self):
+        """Return the next line, or '' at the end"""
+
+        i = self.next
+        if i >= len(self.lines):
+            return u""
+        self.next = i + 1
+        if hasattr(self, 'line_offset'):
+            self.line_offset = self.offsets[i]
+        return self.lines[i]
+
+def parse_chunk(task):
+    """
+    Parse stage entry point, in a thread or a worker process: parse one
+    chunk, given (name, lineno, lines, offsets, date, colnames,
+    no_total_warning, options), and return the ShardReader's events and
+    totals.
+    """
+
+    name, lineno, lines, offsets = task[:4]
+    reader = ShardReader(ListSource(name, lines, offsets), lineno, *task[4:])
+    reader.run()
+    return reader.events, reader.accumulator
+
+class StageStats(object):
+    """Time and queue length counts for one stage"""
+
+    def __init__(self, name, queued=True):
+        """Count for the stage called name, which has an input queue if queued"""
+
+        self.name = name
+        self.queued = queued
+        self.items = 0
+        self.busy = 0.0
+        self.waiting_in = 0.0
+        self.waiting_out = 0.0
+        self.depths = 0
+        self.max_depth = 0
+
+    def saw_depth(self, depth):
+        """Note the length of the input queue when an item was taken"""
+
+        self.depths += depth
+        self.max_depth = max(self.max_depth, depth)
+
+    def summary(self):
+        """One line describing where the stage's time went"""
+
+        text = "%s: %d chunks, %.3fs working, %.3fs waiting for input, " \
+            "%.3fs waiting for room in output" % (self.name, self.items,
+            self.busy, self.waiting_in, self.waiting_out)
+        if self.queued:
+            text += ", input queue %.1f on average (at most %d)" % (
+                float(self.depths) / max(self.items, 1), self.max_depth)
+        return text
+
+class PipelineStats(object):
+    """The StageStats of a pipeline, and a judgement of which held it back"""
+
+    def __init__(self):
+        self.stages = [StageStats("read", False), StageStats("parse"), StageStats("write")]
+        self.elapsed = 0.0
+
+    def bottleneck(self):
+        """The name of the stage that spent the most time working"""
+
+        return max(self.stages, key=lambda stage: stage.busy).name
+
+    def report(self):
+        """A few lines summing up the run, for a person to read"""
+
+        lines = [stage.summary() for stage in self.stages]
+        lines.append("%.3fs in all; the %s stage is the bottleneck" % (
+            self.elapsed, self.bottleneck()))
+        return "\n".join(lines)
+
+class Stopped(Exception):
+    """Raised in a stage thread when the pipeline is being shut down"""
+
+class Pipeline(object):
+    """Runs the stages for one AdDataReader"""
+
+    def __init__(self, reader, jobs=1, depth=4, chunk_lines=CHUNK_LINES):
+        self.reader = reader
+        self.jobs = jobs
+        self.depth = depth
+        self.chunk_lines = chunk_lines
+        self.stats = PipelineStats()
+        self.chunks = Queue.Queue(depth)
+        self.results = Queue.Queue(depth)
+        self.stopping = threading.Event()
+
+    def _put(self, queue, item, stats):
+        """Put item on queue, waiting for room unless the pipeline stops"""
+
+        started = time.time()
+        while True:
+            if self.stopping.is_set():
+                raise Stopped()
+            try:
+                queue.put(item, timeout=0.1)
+                break
+            except Queue.Full:
+                pass
+        stats.waiting_out += time.time() - started
+
+    def _get(self, queue, stats):
+        """Take the next item from queue, waiting for one if need be"""
+
+        started = time.time()
+        depth = queue.qsize()
+        while True:
+            if self.stopping.is_set():
+                raise Stopped()
+            try:
+                item = queue.get(timeout=0.1)
+                break
+            except Queue.Empty:
+                pass
+        stats.waiting_in += time.time() - started
+        stats.saw_depth(depth)
+        return item
+
+    def _stage(self, work, output, stats):
+        """Run work in a thread, passing on any error as its last item"""
+
+        def run():
+            try:
+                work()
+            except Stopped:
+                pass
+            except BaseException as e:
+                try:
+                    self._put(output, (END, e), stats)
+                except Stopped:
+                    pass
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _read(self):
+        """
+        The read stage: pass on chunks of (lineno, lines, offsets), each
+        ending at the end of a record, then END.
+        """
+
+        feeder = self.feeder
+        stats = self.stats.stages[0]
+        tracking = feeder._track_offsets
+        multiline = feeder.multiline
+        while True:
+            started = time.time()
+            lineno = feeder.lineno
+            lines = []
+            offsets = [] if tracking else None
+            still_open = False
+            while True:
+                line = feeder.readline()
+                if len(line) == 0:
+                    break
+                lines.append(line)
+                if tracking:
+                    offsets.append(feeder.source.line_offset)
+                if multiline:
+                    # Keep the lines of a record together, as parse_line
+                    # would put them together
+                    if still_open:
+                        still_open = quote_is_open(line.rstrip(), True)
+                    else:
+                        still_open = quote_is_open(line.strip())
+                    if still_open:
+                        continue
+                if len(lines) >= self.chunk_lines:
+                    break
+            stats.busy += time.time() - started
+            if not lines:
+                self._put(self.chunks, (END, None), stats)
+                return
+            stats.items += 1
+            self._put(self.chunks, (lineno, lines, offsets), stats)
+
+    def _tasks(self):
+        """The parse tasks for the chunks, as they are read"""
+
+        reader = self.reader
+        stats = self.stats.stages[1]
+        options = shard_options(reader)
+        while True:
+            chunk = self._get(self.chunks, stats)
+            if chunk[0] is END:
+                if chunk[1] is not None:
+                    raise chunk[1]
+                return
+            lineno, lines, offsets = chunk
+            yield (reader.source.name, lineno, lines, offsets, reader.date,
+                reader.colnames, reader.no_total_warning, options)
+
+    def _parse(self):
+        """The parse stage, in this process: parse each chunk in turn"""
+
+        stats = self.stats.stages[1]
+        for task in self._tasks():
+            started = time.time()
+            result = parse_chunk(task)
+            stats.busy += time.time() - started
+            stats.items += 1
+            self._put(self.results, result, stats)
+        self._put(self.results, (END, None), stats)
+
+    def _parse_in_pool(self, pool):
+        """
+        The parse stage, with a pool of worker processes. No more than depth
+        chunks are handed to the pool ahead of the results being taken.
+        """
+
+        stats = self.stats.stages[1]
+        # A token is put here for each chunk handed out, and taken back as
+        # its result is passed on
+        handed_out = Queue.Queue(self.depth)
+        # The pool does not finish a job whose tasks raise an error, so any
+        # error from the read stage is kept here and raised afterwards
+        failed = []
+        def tasks():
+            try:
+                for task in self._tasks():
+                    self._put(handed_out, None, stats)
+                    yield task
+            except BaseException as e:
+                failed.append(e)
+        results = pool.imap(parse_chunk, tasks())
+        started = time.time()
+        while True:
+            try:
+                result = results.next(0.1)
+            except multiprocessing.TimeoutError:
+                if self.stopping.is_set():
+                    raise Stopped()
+                continue
+            except StopIteration:
+                break
+            # The time spent here is the workers' time, less any overlap
+            stats.busy += time.time() - started
+            stats.items += 1
+            self._put(self.results, result, stats)
+            handed_out.get()
+            started = time.time()
+        if failed:
+            raise failed[0]
+        self._put(self.results, (END, None), stats)
+
+    def run(self):
+        """Do the work of reader.process_input()"""
+
+        reader = self.reader
+        started = time.time()
+        try:
+            reader._read_header()
+        except CompressedInputError as e:
+            reader._fatal("While reading input", str(e))
+        # Lines are read from here on by the read stage, through a copy of
+        # the reader that takes over its place in the input
+        self.feeder = copy.copy(reader)
+        pool = None
+        if self.jobs > 1:
+            # Started before any threads, which do not survive a fork
+            pool = multiprocessing.Pool(self.jobs)
+        threads = [self._stage(self._read, self.chunks, self.stats.stages[0])]
+        if pool is not None:
+            threads.append(self._stage(lambda: self._parse_in_pool(pool),
+                self.results, self.stats.stages[1]))
+        else:
+            threads.append(self._stage(self._parse, self.results,
+                self.stats.stages[1]))
+        stats = self.stats.stages[2]
+        totals = dict(reader.accumulator)
+        first = True
+        try:
+            while True:
+                result = self._get(self.results, stats)
+                if result[0] is END:
+                    if isinstance(result[1], CompressedInputError):
+                        # Reported after the last line the read stage read
+                        reader.lineno = self.feeder.lineno
+                        reader.lastline = self.feeder.lastline
+                        reader.accumulator = totals
+                        reader._fatal("While reading input", str(result[1]))
+                    if result[1] is not None:
+                        raise result[1]
+                    break
+                events, accumulator = result
+                began = time.time()
+                first = replay_events(reader, events, totals, first)
+                totals = merge_totals(totals, accumulator)
+                stats.busy += time.time() - began
+                stats.items += 1
+            reader.lineno = self.feeder.lineno
+            reader.accumulator = totals
+            reader._flush_batch()
+            reader._report_totals()
+        finally:
+            self.stopping.set()
+            for thread in threads:
+                thread.join()
+            if pool is not None:
+                # Only the chunks already handed out are left to finish (see
+                # adparallel on why the pool is not terminated)
+                pool.close()
+                pool.join()
+            self.stats.elapsed = time.time() - started
+        return self.stats
+
+def process_pipelined(reader, jobs=1, depth=4, chunk_lines=CHUNK_LINES):
+    """
+    Do the work of reader.process_input() in pipelined stages, with a pool
+    of jobs worker processes for the parsing if jobs is more than 1, and at
+    most depth chunks of chunk_lines lines waiting between stages. Returns
+    the PipelineStats.
+    """
+
+    return Pipeline(reader, jobs, depth, chunk_lines).run()
@@ -0,0 +1,252 @@
+#!/usr/bin/python
+
+# Loading ad report data into a SQLite database.
+#
+# The SQLiteLoader is a batch consumer for AdDataReader (see the
+# produce_batch option) that writes rows into the ad_report_data table
+# described in the AdInfo docstring, with the primary key taken to be
+# (report_date, ad_group, ad_name). Values are stored as the CSV output
+# gives them: ad groups and names in lower case and costs in cents.
+#
+# Each batch is written with a single executemany call, and each input
+# file is loaded in one transaction, so a file that fails part way
+# through leaves nothing behind. Rows that are already in the table are
+# replaced, which makes it safe to load a day's report again after it
+# has been corrected. With a checkpoint, the rows are committed at each
+# save instead, so a failed load can be resumed, and the keys checked
+# for duplicate records are saved with them. The database is put in
+# WAL mode, so readers are not locked out while a load is going on.
+#
+# Records are checked for duplicates as the CSV output is: each batch is
+# run through a deduper before it is written, and a file that repeats a
+# record, or gives one that an earlier file of the same load gave, fails
+# with the same "Duplicate record" error. Rows from earlier loads are not
+# duplicates; they are replaced as above.
+#
+# Any rollups asked for (see adaggregate) are taken from the same batches
+# as they are loaded, and only count the files that were committed. Rows
+# added to an --index file (see adindex) are stored there as they are
+# loaded, and dropped again if their file is not committed.
+
+import sqlite3
+import logging
+
+import addedup
+import admetrics
+import adsymbols
+from admetrics import MappedSource
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ad_report_data (
+    report_date DATE NOT NULL,
+    ad_group VARCHAR(255) NOT NULL,
+    ad_name VARCHAR(255) NOT NULL,
+    impressions INT NOT NULL,
+    clicks INT NOT NULL,
+    total_cost_in_cents INT NOT NULL,
+    PRIMARY KEY(report_date, ad_group, ad_name))
+"""
+
+INSERT = """
+INSERT INTO ad_report_data (report_date, ad_group, ad_name, impressions,
+    clicks, total_cost_in_cents) VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+# UPSERT needs SQLite 3.24 or later. Before that, replacing the whole row
+# comes to the same thing, since every other column is updated anyway.
+if sqlite3.sqlite_version_info >= (3, 24, 0):
+    UPSERT = INSERT + """ON CONFLICT(report_date, ad_group, ad_name) DO UPDATE SET
+    impressions=excluded.impressions, clicks=excluded.clicks,
+    total_cost_in_cents=excluded.total_cost_in_cents
+"""
+else:
+    UPSERT = INSERT.replace("INSERT", "INSERT OR REPLACE", 1)
+
+class SQLiteLoader(object):
+    """
+    Write AdBatch objects into the ad_report_data table of a SQLite
+    database, creating the table if need be.
+    """
+
+    def __init__(self, path, wal=True, deduper=None):
+        """
+        Open (or create) the database at path. With wal set, the database is
+        switched to write-ahead logging. If a deduper is given (see addedup),
+        rows are checked with it for duplicate records before they are
+        written.
+        """
+
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        if wal:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            # Safe from corruption in WAL mode, at the risk of losing the
+            # last transactions on a power failure
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(SCHEMA)
+        self.connection.commit()
+        self.rows = 0
+        self.deduper = deduper
+        self.symbols = None
+
+    def load(self, batch, first=False, args=None):
+        """
+        Add the rows in batch to the current transaction. The arguments are
+        those of a produce_batch callback, so this can be given to an
+        AdDataReader directly.
+        """
+
+        rows = []
+        if self.symbols is None:
+            self.symbols = adsymbols.SymbolTable()
+        symbols = self.symbols
+        ids = symbols.ids
+        names = symbols.names
+        deduper = self.deduper
+        # The ad groups and names are stored in their interned lower-case
+        # forms, and checked for duplicate records (giving up on the input
+        # at the first, as the CSV output does) before anything is written
+        for date, ad_group, ad_name, impressions, clicks, cents in batch.rows():
+            group = ids.get(ad_group)
+            if group is None:
+                group = symbols.add(ad_group)
+            name = ids.get(ad_name)
+            if name is None:
+                name = symbols.add(ad_name)
+            if deduper is not None:
+                key = u"%s,%s,%s" % (date, symbols.csv[group], symbols.csv[name])
+                if not deduper.add(date, key, adsymbols.pair(group, name)):
+                    logging.error("Duplicate record for key: %s" % key)
+                    exit(1)
+            rows.append((date, names[group], names[name], impressions, clicks,
+                cents))
+        self.connection.executemany(UPSERT, rows)
+        self.rows += len(batch)
+
+    def commit(self):
+        """Make the rows loaded so far permanent"""
+
+        self.connection.commit()
+
+    def rollback(self):
+        """Discard the rows loaded since the last commit"""
+
+        self.connection.rollback()
+
+    def close(self):
+        """Commit any remaining rows and close the database"""
+
+        self.connection.commit()
+        self.connection.close()
+
+def load_files(paths, args):
+    """
+    Load each of the report files in paths into the database named by
+    args.sqlite, in args.sqlite_batch row batches, using the other
+    command-line options in args as main() would. A file that fails, or
+    repeats a record of an earlier file, is rolled back and skipped; the
+    keys of a report date are kept until its last file is done. Returns
+    True if every file was loaded.
+    """
+
+    import adparallel
+    loader = SQLiteLoader(args.sqlite)
+    context = admetrics.RunContext(args)
+    aggregators = context.row_aggregators()
+    deduper = context.record_deduper()
+    finished = adparallel.finished_dates(paths, args)
+    index = None
+    if getattr(args, 'index', None):
+        import adindex
+        index = adindex.ReportIndex(args.index)
+    options = {}
+    file_deduper = None
+    if getattr(args, 'checkpoint', None):
+        # Each save commits the rows before it, so only those after the last
+        # save are rolled back on failure. There is a single input file, and
+        # its duplicate checks are saved with it, so that a resumed run
+        # still knows the keys loaded before the save
+        import adcheckpoint
+        file_deduper = admetrics.RunContext(args).record_deduper()
+        options['checkpoint'] = adcheckpoint.Checkpoint(args.checkpoint,
+            args.checkpoint_every, file_deduper, flush=loader.commit)
+    all_ok = True
+    try:
+        for i, path in enumerate(paths):
+            # The file is checked on its own as it is loaded, and against the
+            # files before it once it is done
+            if file_deduper is None:
+                keys = addedup.KeyRecorder(admetrics.RunContext(args).record_deduper())
+            else:
+                keys = addedup.KeyRecorder(file_deduper)
+            loader.deduper = keys
+            produce_batch = loader.load
+            # The file's rollups, kept until it is committed, and its index
+            # entries, stored as they come
+            consumers = []
+            if aggregators:
+                import adaggregate
+                file_aggregators = adaggregate.make_aggregators(args.aggregate)
+                consumers.extend(file_aggregators)
+            if index is not None:
+                entries = index.entries(path)
+                consumers.append(entries)
+            if consumers:
+                def produce_batch(batch, first=False, args=None):
+                    loader.load(batch)
+                    for consumer in consumers:
+                        consumer.add_batch(batch)
+            mapped = args.jobs > 1 or 'checkpoint' in options
+            def parse(produce_batch):
+                reader = admetrics.make_reader(path, args, None, mapped=mapped,
+                    produce_batch=produce_batch, batch_size=args.sqlite_batch,
+                    **options)
+                if args.jobs > 1 and isinstance(reader.source, MappedSource):
+                    adparallel.process_sharded(reader, args.jobs)
+                else:
+                    reader.process_input()
+            ok = True
+            try:
+                if getattr(args, 'cache_dir', None) and path != '-':
+                    import adcache
+                    adcache.process_cached(path, args, parse,
+                        produce_batch=produce_batch, batch_size=args.sqlite_batch,
+                        mapped=mapped)
+                else:
+                    parse(produce_batch)
+            except SystemExit:
+                ok = False
+            except:
+                loader.rollback()
+                if index is not None:
+                    index.discard(entries)
+                raise
+            if ok and keys.keys:
+                duplicate = deduper.add_all(keys.date, keys.keys)
+                if duplicate is not None:
+                    logging.error("Duplicate record for key: %s" % duplicate)
+                    ok = False
+            if ok:
+                loader.commit()
+                if aggregators:
+                    adaggregate.merge_aggregators(aggregators, file_aggregators)
+                if index is not None:
+                    index.finish(entries)
+            else:
+                loader.rollback()
+                if index is not None:
+                    index.discard(entries)
+                all_ok = False
+                if 'checkpoint' in options:
+                    logging.error("Stopped %s: loaded up to its last checkpoint" % path)
+                else:
+                    logging.error("Skipped %s: nothing loaded from it" % path)
+            for date in finished.get(i, ()):
+                deduper.forget(date)
+    finally:
+        loader.close()
+        if index is not None:
+            index.close()
+    if aggregators:
+        adaggregate.write_requested(aggregators, args)
+    return all_ok
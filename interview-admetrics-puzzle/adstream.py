@@ -0,0 +1,390 @@
+#!/usr/bin/python
+
+# Reading many report streams at once, from sockets and pipes, in a single
+# event loop.
+#
+# Each stream is parsed by its own AdDataReader, just as a file would be,
+# but its input is pushed to it as it arrives rather than pulled with
+# blocking reads. A StreamSource holds the text received so far and only
+# hands the reader whole records, so the reader simply sees the end of its
+# input whenever it has caught up, and carries on from the same place when
+# more arrives. With multiline quotes, a record ends at the first line
+# that does not leave a quoted value open, by admetrics.quote_is_open, so
+# streams split records just as files do.
+#
+# The rows of every stream go into one bounded OutputStage, whose queue is
+# drained into the producer between polls. While the queue is full, no
+# stream is parsed further and no socket or pipe is read, so a slow
+# producer holds back the senders rather than letting input pile up in
+# memory.
+#
+# A stream that fails stops on its own, as a file in a batch does: the
+# rows it had produced are kept, and the other streams carry on.
+#
+# The loop is built on asyncore, the standard library's event loop for
+# this version of Python.
+
+import socket
+import codecs
+import asyncore
+import logging
+import collections
+
+from admetrics import AdDataReader, quote_is_open
+
+# Bytes to read from a socket or pipe at a time
+READ_SIZE = 64 * 1024
+
+class StreamSource(object):
+    """
+    An input source for AdDataReader that is fed text as it arrives. Lines
+    are only handed out once the record they belong to is complete; until
+    then, and at the end of the input, readline returns an empty string.
+    """
+
+    def __init__(self, name, encoding='utf-8', multiline=False):
+        """
+        Name the stream (for diagnostics), and decode what is fed to it from
+        the given encoding. With multiline set, records may span lines.
+        """
+
+        self.name = name
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.multiline = multiline
+        self.lines = collections.deque()
+        # A line still waiting for its newline, and the complete lines of
+        # a record with a quoted value that is still open
+        self.partial = u""
+        self.held = []
+        self.closed = False
+
+    def feed(self, data):
+        """Add a piece of the input, as bytes"""
+
+        self._add(self.decoder.decode(data))
+
+    def finish(self):
+        """Mark the end of the input; anything held back is released"""
+
+        self._add(self.decoder.decode("", True))
+        if self.partial:
+            self.held.append(self.partial)
+            self.partial = u""
+        self.lines.extend(self.held)
+        self.held = []
+        self.closed = True
+
+    def _add(self, text):
+        """Split text into lines, passing on those of complete records"""
+
+        if not text:
+            return
+        lines = (self.partial + text).splitlines(True)
+        self.partial = u""
+        if not lines[-1].endswith(u"\n"):
+            # An incomplete line, or a "\r" whose "\n" may be yet to come
+            self.partial = lines.pop()
+        if not self.multiline:
+            self.lines.extend(lines)
+            return
+        for line in lines:
+            if self.held:
+                still_open = quote_is_open(line.rstrip(), True)
+            else:
+                still_open = quote_is_open(line.strip())
+            self.held.append(line)
+            if not still_open:
+                self.lines.extend(self.held)
+                self.held = []
+
+    def ready(self):
+        """The number of lines that can be read without waiting"""
+
+        return len(self.lines)
+
+    def readline(self):
+        """Return the next line of a complete record, or '' if there is none"""
+
+        if self.lines:
+            return self.lines.popleft()
+        return u""
+
+class OutputStage(object):
+    """
+    A bounded queue of rows from all of the streams, passed to a producer
+    in the order they were parsed.
+    """
+
+    def __init__(self, produce, args=None, high_water=10000, drain_size=1000):
+        """
+        Rows are passed to produce as AdDataReader would, as
+
+            produce(ad_info, first=isfirsttime, args=args)
+
+        at most drain_size at a time. The queue counts as full, and input is
+        held back, once high_water rows are waiting.
+        """
+
+        self.produce = produce
+        self.args = args
+        self.high_water = high_water
+        self.drain_size = drain_size
+        self.queue = collections.deque()
+        self.first = True
+        self.produced = 0
+
+    def put(self, ad_info):
+        """Queue a row to be produced"""
+
+        self.queue.append(ad_info)
+
+    def full(self):
+        """True if no more input should be taken for now"""
+
+        return len(self.queue) >= self.high_water
+
+    def drain(self, count=None):
+        """Produce up to count (default drain_size) of the waiting rows"""
+
+        if count is None:
+            count = self.drain_size
+        queue = self.queue
+        while queue and count > 0:
+            self.produce(queue.popleft(), first=self.first, args=self.args)
+            self.first = False
+            self.produced += 1
+            count -= 1
+
+class StreamIngest(object):
+    """Parsing of one report stream, as its input arrives"""
+
+    def __init__(self, name, output, no_total_warning=False, encoding='utf-8',
+            **options):
+        """
+        Parse the stream with an AdDataReader, given the reader options, and
+        put its rows into output, an OutputStage. Rows are checked one at a
+        time, whatever the validation option.
+        """
+
+        options.pop('validation', None)
+        self.source = StreamSource(name, encoding, options.get('multiline', False))
+        self.reader = AdDataReader(self.source, None, no_total_warning, **options)
+        self.output = output
+        self.started = False
+        self.done = False
+        self.ok = True
+
+    def feed(self, data):
+        """Take a piece of the input, and parse as much as can be"""
+
+        self.source.feed(data)
+        self.advance()
+
+    def finish(self):
+        """Take the end of the input, and parse the rest"""
+
+        self.source.finish()
+        self.advance()
+
+    def advance(self):
+        """
+        Parse the complete records received so far, until the output is
+        full. Returns True if any rows were put out.
+        """
+
+        if self.done:
+            return False
+        reader = self.reader
+        source = self.source
+        try:
+            if not self.started:
+                # The header is read once there are two non-blank lines
+                # for it, or there is no more to come
+                if not source.closed and \
+                        sum(1 for line in source.lines if line.strip()) < 2:
+                    return False
+                reader._read_header()
+                self.started = True
+            added = False
+            while not self.output.full():
+                row_data = reader._next_record()
+                if row_data is None:
+                    if source.closed:
+                        reader._report_totals()
+                        self.done = True
+                    break
+                if reader._use_row(row_data):
+                    self.output.put(row_data)
+                    reader.produced += 1
+                    added = True
+            return added
+        except SystemExit:
+            # The reader has logged why; rows already put out are kept
+            logging.error("Stopped %s: no more rows taken from it" % source.name)
+            self.done = True
+            self.ok = False
+            return False
+
+    def blocked(self):
+        """True if the stream has records (or its end) waiting to be parsed"""
+
+        return not self.done and self.started and \
+            (self.source.ready() > 0 or self.source.closed)
+
+class StreamHandler(object):
+    """The event handling common to sockets and pipes being ingested"""
+
+    def readable(self):
+        if self.ingest.done:
+            # Stopped by a bad row while parsing what was held back
+            self.close()
+            return False
+        return not self.ingest.output.full()
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        data = self.recv(READ_SIZE)
+        if data:
+            self.ingest.feed(data)
+        if self.ingest.done:
+            self.close()
+
+    def handle_close(self):
+        self.ingest.finish()
+        self.close()
+
+    def handle_error(self):
+        # Anything other than a bad report is a bug, so let it be seen
+        raise
+
+class SocketStream(StreamHandler, asyncore.dispatcher):
+    """A report arriving over a connected socket"""
+
+    def __init__(self, sock, ingest, socket_map):
+        asyncore.dispatcher.__init__(self, sock, socket_map)
+        self.ingest = ingest
+
+class PipeStream(StreamHandler, asyncore.file_dispatcher):
+    """A report arriving over a pipe (or any other readable file descriptor)"""
+
+    def __init__(self, fd, ingest, socket_map):
+        asyncore.file_dispatcher.__init__(self, fd, socket_map)
+        self.ingest = ingest
+
+class ReportServer(asyncore.dispatcher):
+    """A listening socket that ingests each connection as a report stream"""
+
+    def __init__(self, loop, host, port, backlog=16):
+        asyncore.dispatcher.__init__(self, map=loop.socket_map)
+        self.loop = loop
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(backlog)
+        self.address = self.socket.getsockname()
+
+    def readable(self):
+        return not self.loop.output.full()
+
+    def writable(self):
+        return False
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            sock, address = pair
+            self.loop.add_socket(sock, "%s:%d" % address[:2])
+
+    def handle_error(self):
+        raise
+
+class IngestLoop(object):
+    """
+    An event loop that reads any number of report streams concurrently,
+    passing all of their rows through one OutputStage to a producer.
+    """
+
+    def __init__(self, produce, args=None, high_water=10000, timeout=1.0,
+            **options):
+        """
+        Produce the rows of every stream with produce, called as for an
+        AdDataReader, holding back input while high_water rows are waiting.
+        The other options are those of StreamIngest.
+        """
+
+        self.output = OutputStage(produce, args, high_water)
+        self.options = options
+        self.timeout = timeout
+        self.socket_map = {}
+        self.streams = []
+        self.servers = []
+
+    def _ingest(self, name):
+        """Start a new stream"""
+
+        ingest = StreamIngest(name, self.output, **self.options)
+        self.streams.append(ingest)
+        return ingest
+
+    def add_socket(self, sock, name):
+        """Ingest a connected socket until the other end closes it"""
+
+        return SocketStream(sock, self._ingest(name), self.socket_map)
+
+    def add_pipe(self, fd, name):
+        """Ingest a pipe, given its file descriptor, until its end"""
+
+        return PipeStream(fd, self._ingest(name), self.socket_map)
+
+    def listen(self, host='127.0.0.1', port=0):
+        """
+        Accept report streams on host and port (by default, any free port);
+        returns the server, whose address is the one actually bound.
+        """
+
+        server = ReportServer(self, host, port)
+        self.servers.append(server)
+        return server
+
+    def active(self):
+        """True while there are streams (or listeners) open, or rows waiting"""
+
+        return bool(self.socket_map) or bool(self.output.queue) or \
+            any(ingest.blocked() for ingest in self.streams)
+
+    def poll(self, timeout=None):
+        """
+        Produce some of the waiting rows, parse any records held back by a
+        full output, and then wait for input for up to timeout seconds
+        (default: the loop's timeout; none if there is work waiting).
+        """
+
+        self.output.drain()
+        for ingest in self.streams:
+            if self.output.full():
+                break
+            if ingest.blocked():
+                ingest.advance()
+        if timeout is None:
+            timeout = 0 if self.output.queue else self.timeout
+        if self.socket_map:
+            asyncore.loop(timeout, False, self.socket_map, 1)
+
+    def run(self):
+        """
+        Run until every stream has ended and its rows have been produced.
+        Listeners keep the loop going until they are closed. Returns True if
+        no stream failed.
+        """
+
+        while self.active():
+            self.poll()
+        return all(ingest.ok for ingest in self.streams)
+
+    def close(self):
+        """Stop listening and drop any streams still open"""
+
+        for dispatcher in self.socket_map.values():
+            dispatcher.close()
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+# A symbol table for the ad group and ad name strings of a run.
+#
+# The same few ad groups and names come up in row after row, and day after
+# day, but each row's AdInfo holds new strings, and the output needs them
+# in lower case and escaped for CSV. A SymbolTable gives each distinct
+# string a small integer ID, the same for every string that is the same in
+# lower case, and works out its lower-case and CSV forms once, the first
+# time it is seen. After that, a row's strings cost a dict lookup rather
+# than being folded and escaped again.
+#
+# The lower-case forms are interned: every row with the same ad group gets
+# the same string object, so keys built from them are compared and hashed
+# cheaply, and held in memory once. The IDs number the symbols in the order
+# they were first seen, so they can stand for the strings within a run (as
+# duplicate checks do, see addedup.ExactDeduper), but mean nothing outside
+# it: another run, or another worker process, numbers them its own way.
+#
+# Lookups are made often enough that callers on the hot path read the ids
+# dict directly, and only call add for a string not seen before:
+#
+#   symbol = symbols.ids.get(value)
+#   if symbol is None:
+#       symbol = symbols.add(value)
+
+from admetrics import csv_string
+
+# The most symbols a table can hold, so that a pair of IDs fits in one
+# integer (see pair)
+MAX_SYMBOLS = 1 << 32
+
+def pair(first, second):
+    """One integer standing for a pair of IDs, such as an ad group and name"""
+
+    return (first << 32) | second
+
+class SymbolTable(object):
+    """IDs, lower-case forms and CSV forms for the strings of a run"""
+
+    def __init__(self):
+        # The ID of each string seen, as given and in lower case
+        self.ids = {}
+        # The lower-case and CSV forms, by ID
+        self.names = []
+        self.csv = []
+
+    # So that callers holding a table can pair its IDs without importing
+    # this module
+    pair = staticmethod(pair)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, value):
+        """
+        Return the ID of the string value, which is not in ids: the ID of its
+        lower-case form, or a new one.
+        """
+
+        folded = value.lower()
+        symbol = self.ids.get(folded)
+        if symbol is None:
+            symbol = len(self.names)
+            if symbol >= MAX_SYMBOLS:
+                raise OverflowError("More than %d distinct strings" % MAX_SYMBOLS)
+            self.ids[folded] = symbol
+            self.names.append(folded)
+            self.csv.append(csv_string(folded))
+        if folded != value:
+            self.ids[value] = symbol
+        return symbol
+
+    def id(self, value):
+        """The ID of the string value"""
+
+        symbol = self.ids.get(value)
+        if symbol is None:
+            symbol = self.add(value)
+        return symbol
+
+    def lower(self, value):
+        """The interned lower-case form of the string value"""
+
+        return self.names[self.id(value)]
+
+    def csv_form(self, value):
+        """The lower-case form of the string value, escaped for CSV"""
+
+        return self.csv[self.id(value)]
@@ -0,0 +1,359 @@
+#!/usr/bin/python
+
+# Benchmarks for the admetrics module. Run with the name of a benchmark
+# (or several), for example:
+#
+#   ./bench_admetrics.py memory
+#
+# Each benchmark prints its results on standard output. The data is
+# synthetic but shaped like the sample input, and the same every run.
+
+import os
+import bz2
+import sys
+import gzip
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+import admetrics
+import adcache
+import adsqlite
+import addedup
+import adsymbols
+import adnumbers
+import adcompress
+import adaggregate
+import adpipeline
+from admetrics import AdInfo
+# The number parsers admetrics used before adnumbers, as the baseline
+from test_adnumbers import string_to_integer, string_to_float, money_string_to_float
+
+COLUMNS = ('ad group', 'ad name', 'impressions', 'clicks', 'ctr', 'total cost', 'date')
+
+def make_rows(count, seed=1):
+    """Return count data rows, as lists of strings like the tokenizer gives"""
+
+    rng = random.Random(seed)
+    rows = []
+    for i in range(count):
+        impressions = rng.randint(1, 1000)
+        clicks = rng.randint(0, impressions)
+        cost = rng.randint(1, 100000)
+        rows.append([
+            u"Group %d" % (i % 50),
+            u"Ad number %d" % i,
+            u"%d" % impressions,
+            u"%d" % clicks,
+            u"%.4f" % (float(clicks) / impressions),
+            u"$%d.%02d" % (cost // 100, cost % 100),
+            u"2011-01-01",
+        ])
+    return rows
+
+def deep_size(obj, seen):
+    """
+    Return the bytes used by obj and everything it refers to that has not
+    already been counted in seen (a set of ids).
+    """
+
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            size += deep_size(value, seen)
+    if hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+    for name in getattr(type(obj), '__slots__', ()):
+        size += deep_size(getattr(obj, name), seen)
+    return size
+
+class DictAdInfo(object):
+    """
+    The layout AdInfo had before it used slots: an instance __dict__ with the
+    raw field dict and the warning callback kept alongside the parsed values.
+    """
+
+    def __init__(self, warner, ordering, csv):
+        info = AdInfo(warner, ordering, csv)
+        self.warner = warner
+        self.data = dict(zip(ordering, csv))
+        for name in AdInfo.__slots__:
+            setattr(self, name, getattr(info, name))
+
+def bench_memory(count):
+    """Per-row memory of the old and current AdInfo layouts"""
+
+    def warner(message):
+        pass
+
+    rows = make_rows(count)
+    # The callback and column names are shared by every row
+    shared = set([id(warner), id(COLUMNS)] + [id(name) for name in COLUMNS])
+    for label, make in (
+            ("dict + raw data (before)", DictAdInfo),
+            ("__slots__ (after)", AdInfo)):
+        infos = [make(warner, COLUMNS, row) for row in rows]
+        total = deep_size(infos, set(shared)) - sys.getsizeof(infos)
+        print "%-26s %8.1f bytes/row" % (label, float(total) / count)
+
+def write_report(path, count):
+    """Write a report file with count synthetic data rows to path"""
+
+    with open(path, "wb") as f:
+        f.write("Report Date: 01/01/2011\n")
+        f.write("Ad Group,Ad Name,Impressions,Clicks,CTR,Total Cost\n")
+        for row in make_rows(count):
+            f.write((u",".join(row[:-1]) + u"\n").encode("utf-8"))
+
+def bench_sqlite(count):
+    """Rows per second loading into SQLite, against writing CSV output"""
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "report.csv")
+        write_report(path, count)
+        args = admetrics.parse_command_line([path, "--no-total-warning"])
+        with open(os.devnull, "w") as output:
+            context = admetrics.RunContext(args, admetrics.OutputWriter(output))
+            started = time.time()
+            admetrics.make_reader(path, args, context=context).process_input()
+            context.writer.flush()
+            csv_time = time.time() - started
+        results = [("CSV output", csv_time)]
+        for batch_size in (1000, 10000):
+            args.sqlite = os.path.join(tmpdir, "ads%d.db" % batch_size)
+            args.sqlite_batch = batch_size
+            started = time.time()
+            adsqlite.load_files([path], args)
+            results.append(("SQLite, batches of %d" % batch_size,
+                time.time() - started))
+        for label, seconds in results:
+            print "%-26s %10.0f rows/s" % (label, count / seconds)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_numbers(count):
+    """Parsing time per value of each numeric field, old helpers and new"""
+
+    rows = make_rows(count)
+    def old_ctr(s):
+        if s.endswith('%'):
+            return string_to_float(s[0:len(s)-1])/100.0
+        return string_to_float(s)
+    def old_cents(s):
+        return int(round(money_string_to_float(s) * 100))
+    fields = (
+        ("impressions", 2, string_to_integer, adnumbers.parse_int),
+        ("clicks", 3, string_to_integer, adnumbers.parse_int),
+        ("ctr", 4, old_ctr, adnumbers.parse_ctr),
+        ("total cost (cents)", 5, old_cents, adnumbers.parse_cents),
+    )
+    for label, index, old, new in fields:
+        values = [row[index] for row in rows]
+        times = []
+        for parse in (old, new):
+            started = time.time()
+            for value in values:
+                parse(value)
+            times.append((time.time() - started) / count * 1e6)
+        print "%-20s %6.2f us before, %6.2f us after (%.1fx)" % (
+            label, times[0], times[1], times[0] / times[1])
+
+def bench_compressed(count):
+    """Rows per second from plain and compressed copies of the same report"""
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        plain = os.path.join(tmpdir, "report.csv")
+        write_report(plain, count)
+        with open(plain, "rb") as f:
+            data = f.read()
+        inputs = [("plain", plain, [])]
+        path = plain + ".gz"
+        f = gzip.open(path, "wb")
+        f.write(data)
+        f.close()
+        inputs.append(("gzip", path, []))
+        inputs.append(("gzip, thread", path, ["--decompress-thread"]))
+        path = plain + ".bz2"
+        with open(path, "wb") as f:
+            f.write(bz2.compress(data))
+        inputs.append(("bz2", path, []))
+        inputs.append(("bz2, thread", path, ["--decompress-thread"]))
+        if adcompress.lzma is not None:
+            path = plain + ".xz"
+            with open(path, "wb") as f:
+                f.write(adcompress.lzma.compress(data))
+            inputs.append(("xz", path, []))
+            inputs.append(("xz, thread", path, ["--decompress-thread"]))
+        for label, path, options in inputs:
+            args = admetrics.parse_command_line([path, "--no-total-warning"] + options)
+            with open(os.devnull, "w") as output:
+                context = admetrics.RunContext(args, admetrics.OutputWriter(output))
+                started = time.time()
+                admetrics.make_reader(path, args, context=context).process_input()
+                context.writer.flush()
+                seconds = time.time() - started
+            print "%-26s %10.0f rows/s %8.1f MB/s %10d bytes" % (label,
+                count / seconds, len(data) / seconds / 1e6, os.path.getsize(path))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_pipeline(count):
+    """Rows per second read serially and in pipelined stages, with the stage timings"""
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "report.csv")
+        write_report(path, count)
+        runs = [("serial", [])]
+        for jobs in (1, 2, 4):
+            runs.append(("pipeline, %d job%s" % (jobs, "s" if jobs > 1 else ""),
+                ["--pipeline", "--jobs", str(jobs)]))
+        for label, options in runs:
+            args = admetrics.parse_command_line([path, "--no-total-warning"] + options)
+            with open(os.devnull, "w") as output:
+                context = admetrics.RunContext(args, admetrics.OutputWriter(output))
+                reader = admetrics.make_reader(path, args, context=context)
+                started = time.time()
+                if args.pipeline:
+                    stats = adpipeline.process_pipelined(reader, args.jobs,
+                        args.pipeline_depth)
+                else:
+                    stats = None
+                    reader.process_input()
+                context.writer.flush()
+                seconds = time.time() - started
+            print "%-20s %10.0f rows/s" % (label, count / seconds)
+            if stats is not None:
+                for line in stats.report().splitlines():
+                    print "    %s" % line
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_aggregate(count):
+    """Microseconds per row to total rows by group, a row or a batch at a time"""
+
+    rows = [AdInfo(None, COLUMNS, row) for row in make_rows(count)]
+    batches = []
+    for start in range(0, count, 10000):
+        batch = admetrics.AdBatch()
+        for row in rows[start:start + 10000]:
+            batch.append(row)
+        batches.append(batch)
+    for by in (('ad_group',), ('date', 'ad_group'), ('date', 'ad_name')):
+        times = []
+        for use_numpy in (None, False, True):
+            aggregator = adaggregate.Aggregator(by, bool(use_numpy))
+            started = time.time()
+            if use_numpy is None:
+                for row in rows:
+                    aggregator.add(row)
+            else:
+                for batch in batches:
+                    aggregator.add_batch(batch)
+            times.append((time.time() - started) / count * 1e6)
+        print "%-24s %6.2f us by row, %6.2f us by batch, %6.2f us with NumPy " \
+            "(%d groups)" % (",".join(by), times[0], times[1], times[2],
+            len(aggregator.groups))
+
+def bench_cache(count):
+    """Rows per second parsed, written to the cache, and read back from it"""
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "report.csv")
+        write_report(path, count)
+        args = admetrics.parse_command_line([path, "--no-total-warning",
+            "--cache-dir", os.path.join(tmpdir, "cache")])
+        def produce(ad_info, first, args):
+            pass
+        def parse(produce):
+            admetrics.make_reader(path, args, produce).process_input()
+        started = time.time()
+        parse(produce)
+        print "%-20s %10.0f rows/s" % ("parsed", count / (time.time() - started))
+        for label in ("cache miss", "cache hit"):
+            started = time.time()
+            adcache.process_cached(path, args, parse, produce)
+            print "%-20s %10.0f rows/s" % (label, count / (time.time() - started))
+        report = adcache.ReportCache(args.cache_dir).lookup(path, args)
+        started = time.time()
+        for batch in report.batches():
+            pass
+        print "%-20s %10.0f rows/s %10d bytes, %d for the CSV" % ("cache batches",
+            count / (time.time() - started), os.path.getsize(report.path),
+            os.path.getsize(path))
+        report.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_symbols(count):
+    """
+    Microseconds per row to make the output key and check it for duplicates,
+    folding and escaping each row's strings, or looking them up in a
+    SymbolTable, for names that repeat and names that do not
+    """
+
+    for label, name_of in (("repeated names", lambda i: i // 50 % 200),
+            ("unique names", lambda i: i)):
+        # Each day has 10000 rows: each of 50 groups with 200 names, or not
+        rows = [(u"%d" % (i // 10000), u"Group %d" % (i % 50),
+            u"Ad Name %d" % name_of(i)) for i in range(count)]
+        times = []
+        deduper = addedup.ExactDeduper()
+        started = time.time()
+        for date, ad_group, ad_name in rows:
+            key = u"%s,%s,%s" % (date, admetrics.csv_string(ad_group.lower()),
+                admetrics.csv_string(ad_name.lower()))
+            deduper.add(date, key)
+        times.append((time.time() - started) / count * 1e6)
+        symbols = adsymbols.SymbolTable()
+        deduper = addedup.ExactDeduper()
+        ids = symbols.ids
+        started = time.time()
+        for date, ad_group, ad_name in rows:
+            group = ids.get(ad_group)
+            if group is None:
+                group = symbols.add(ad_group)
+            name = ids.get(ad_name)
+            if name is None:
+                name = symbols.add(ad_name)
+            key = u"%s,%s,%s" % (date, symbols.csv[group], symbols.csv[name])
+            deduper.add(date, key, adsymbols.pair(group, name))
+        times.append((time.time() - started) / count * 1e6)
+        print "%-16s %6.2f us folding, %6.2f us with symbols (%d symbols)" % (
+            label, times[0], times[1], len(symbols))
+
+BENCHMARKS = {
+    'aggregate': bench_aggregate,
+    'cache': bench_cache,
+    'symbols': bench_symbols,
+    'compressed': bench_compressed,
+    'pipeline': bench_pipeline,
+    'numbers': bench_numbers,
+    'memory': bench_memory,
+    'sqlite': bench_sqlite,
+}
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="admetrics benchmarks")
+    parser.add_argument('benchmarks', nargs='+', choices=sorted(BENCHMARKS.keys()),
+        help="benchmarks to run")
+    parser.add_argument('--rows', dest='rows', action='store', type=int,
+        default=100000, help="number of rows to use (default=100000)")
+    args = parser.parse_args(argv[1:])
+    for name in args.benchmarks:
+        print "== %s" % name
+        BENCHMARKS[name](args.rows)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,216 @@
+#!/usr/bin/python
+
+# Testing functions for the adaggregate module.
+
+import os
+import sys
+import codecs
+import random
+import shutil
+import logging
+import unittest
+import tempfile
+
+from StringIO import StringIO
+
+import admetrics
+from admetrics import AdDataReader, AdInfo, AdBatch, parse_command_line, find_inputs
+from adaggregate import Aggregator, parse_fields, write_aggregates
+from adsqlite import load_files
+
+COLUMNS = ('ad group', 'ad name', 'impressions', 'clicks', 'ctr', 'total cost', 'date')
+
+def make_rows(count, seed=1):
+    """AdInfo rows with a few dates, groups and names, in mixed case"""
+
+    rng = random.Random(seed)
+    rows = []
+    for i in range(count):
+        impressions = rng.randint(0, 1000)
+        clicks = rng.randint(0, impressions)
+        cost = rng.randint(1, 100000)
+        group = rng.choice([u"Honda", u"HONDA", u"Nissan", u"Caf\u00e9", u"caf\u00c9"])
+        rows.append(AdInfo(None, COLUMNS, [group, u"Ad %d" % rng.randint(0, 30),
+            str(impressions), str(clicks),
+            "%.4f" % (float(clicks) / impressions if impressions else 0),
+            "$%d.%02d" % (cost // 100, cost % 100),
+            u"2011-01-%02d" % rng.randint(1, 3)]))
+    return rows
+
+class TestAggregator(unittest.TestCase):
+    """Grouped totals must be the same however the rows are added"""
+
+    def test_parse_fields(self):
+        """Field lists are checked"""
+
+        self.assertEqual(parse_fields("date, ad_group"), ('date', 'ad_group'))
+        self.assertRaises(ValueError, parse_fields, "cost")
+        self.assertRaises(ValueError, parse_fields, "date,date")
+
+    def test_rows_and_batches(self):
+        """Rows, small batches and NumPy batches all give the same totals"""
+
+        rows = make_rows(3000)
+        for by in ((), ('ad_group',), ('date', 'ad_name'),
+                ('date', 'ad_group', 'ad_name')):
+            expected = Aggregator(by)
+            for row in rows:
+                expected.add(row)
+            self.assertEqual(expected.totals()['clicks'],
+                sum(row.clicks for row in rows))
+            for use_numpy in (False, True):
+                for size in (1, 7, 1000, 3000):
+                    aggregator = Aggregator(by, use_numpy, numpy_threshold=5)
+                    for start in range(0, len(rows), size):
+                        batch = AdBatch()
+                        for row in rows[start:start + size]:
+                            batch.append(row)
+                        aggregator.add_batch(batch)
+                    self.assertEqual(aggregator.groups, expected.groups)
+
+    def test_case_folding(self):
+        """Ad groups and names are grouped in lower case, dates as they are"""
+
+        aggregator = Aggregator(('ad_group',))
+        for row in make_rows(200):
+            aggregator.add(row)
+        self.assertEqual(sorted(aggregator.groups),
+            [(u"caf\u00e9",), (u"honda",), (u"nissan",)])
+
+    def test_sparse_batches(self):
+        """Batches with a group for nearly every row stop using NumPy"""
+
+        rows = make_rows(40)
+        expected = Aggregator(('date', 'ad_group', 'ad_name'))
+        aggregator = Aggregator(('date', 'ad_group', 'ad_name'), numpy_threshold=10)
+        for start in (0, 20):
+            batch = AdBatch()
+            for row in rows[start:start + 20]:
+                batch.append(row)
+                expected.add(row)
+            aggregator.add_batch(batch)
+            self.assertTrue(aggregator.sparse)
+        self.assertEqual(aggregator.groups, expected.groups)
+
+    def test_reader_totals(self):
+        """The totals of all the groups are the reader's own running totals"""
+
+        aggregator = Aggregator(('ad_group',))
+        with open("sample_input.csv", "rb") as sample:
+            reader = AdDataReader(codecs.getreader("utf-8")(sample), aggregator.add, True)
+            reader.process_input()
+        self.assertEqual(aggregator.totals(), reader.accumulator)
+
+    def test_merge(self):
+        """Merged aggregators total all of their rows"""
+
+        rows = make_rows(500)
+        expected = Aggregator(('date',))
+        parts = [Aggregator(('date',)), Aggregator(('date',))]
+        for i, row in enumerate(rows):
+            expected.add(row)
+            parts[i % 2].add(row)
+        parts[0].merge(parts[1])
+        self.assertEqual(parts[0].groups, expected.groups)
+        self.assertRaises(ValueError, parts[0].merge, Aggregator(('ad_group',)))
+
+    def test_write(self):
+        """Rollups are written as CSV, with the CTR of each group"""
+
+        by_group = Aggregator(('ad_group',))
+        by_date = Aggregator(('date', 'ad_name'))
+        with open("sample_input.csv", "rb") as sample:
+            def produce(ad_info, first, args):
+                by_group.add(ad_info)
+                by_date.add(ad_info)
+            AdDataReader(codecs.getreader("utf-8")(sample), produce, True).process_input()
+        output = StringIO()
+        write_aggregates([by_group, by_date], output, bom=False)
+        lines = output.getvalue().decode("utf-8").splitlines()
+        self.assertEqual(lines[:3], [
+            u"ad_group, impressions, clicks, ctr, total_cost_in_cents",
+            u"honda,640,67,0.1047,2524",
+            u"nissan,500,100,0.2000,5000"])
+        self.assertEqual(lines[3], u"")
+        self.assertEqual(lines[4],
+            u"report_date, ad_name, impressions, clicks, ctr, total_cost_in_cents")
+        self.assertEqual(len(lines), 5 + 3)
+
+class TestCommandLine(unittest.TestCase):
+    """Rollups from the command line, for each way of processing input"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        logging.disable(logging.CRITICAL)
+        sample = open("sample_input.csv", "rb").read()
+        for name, data in (
+                ("2011-01-01.csv", sample),
+                ("2011-01-02.csv", sample.replace("01/01/2011", "01/02/2011")),
+                ("2011-01-03.csv", sample.replace("$10.22", "$-1.00"))):
+            with open(os.path.join(self.tmpdir, name), "wb") as f:
+                f.write(data)
+        self.rollup = os.path.join(self.tmpdir, "rollup.out")
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.tmpdir)
+
+    def rollup_lines(self):
+        """The lines of the rollup file"""
+
+        return codecs.open(self.rollup, "r", "utf-8-sig").read().splitlines()
+
+    def run_main(self, *argv):
+        """Run main() with the given arguments, discarding the CSV output"""
+
+        saved_stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            admetrics.main(["admetrics.py", "--no-total-warning",
+                "--aggregate-output", self.rollup] + list(argv))
+        finally:
+            sys.stdout = saved_stdout
+
+    def test_single_file(self):
+        """One file, read serially, sharded or pipelined"""
+
+        for options in ([], ["--jobs", "2"], ["--pipeline"]):
+            self.run_main("--aggregate", "ad_group", "sample_input.csv", *options)
+            self.assertEqual(self.rollup_lines()[1:], [
+                u"honda,640,67,0.1047,2524", u"nissan,500,100,0.2000,5000"])
+
+    def test_batch(self):
+        """Several files, with the one that fails left out"""
+
+        for jobs in ("1", "2"):
+            try:
+                self.run_main("--aggregate", "date", "--jobs", jobs, self.tmpdir)
+            except SystemExit:
+                pass
+            self.assertEqual(self.rollup_lines()[1:], [
+                u"2011-01-01,1140,167,0.1465,7524",
+                u"2011-01-02,1140,167,0.1465,7524"])
+
+    def test_sqlite(self):
+        """Loading into SQLite, with the rollups taken from the batches"""
+
+        args = parse_command_line(["--no-total-warning", "--aggregate", "ad_group",
+            "--aggregate-output", self.rollup, "--sqlite",
+            os.path.join(self.tmpdir, "ads.db"), self.tmpdir])
+        self.assertFalse(load_files(find_inputs(args.input, args.pattern), args))
+        self.assertEqual(self.rollup_lines()[1:], [
+            u"honda,1280,134,0.1047,5048", u"nissan,1000,200,0.2000,10000"])
+
+    def test_checkpoint(self):
+        """Rollups of a resumed run would be wrong, so are refused"""
+
+        saved_stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            self.assertRaises(SystemExit, parse_command_line, ["--aggregate",
+                "date", "--checkpoint", self.rollup, "sample_input.csv"])
+        finally:
+            sys.stderr = saved_stderr
+
+if __name__ == '__main__':
+    unittest.main()
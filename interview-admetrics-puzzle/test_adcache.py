@@ -0,0 +1,259 @@
+#!/usr/bin/python
+
+# Testing functions for the adcache module.
+
+import os
+import sys
+import shutil
+import logging
+import unittest
+import tempfile
+
+from StringIO import StringIO
+
+import admetrics
+from admetrics import parse_command_line, find_inputs
+from adcache import CacheWriter, CachedReport, process_cached
+from adparallel import CapturingHandler
+from adsqlite import load_files
+from test_adaggregate import make_rows
+
+class TestCacheFile(unittest.TestCase):
+    """Cache files give back the rows they were written with"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "report.adc")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def fields(self, ad_info):
+        """The values of an AdInfo that a cache file keeps"""
+
+        return (ad_info.date, ad_info.ad_group, ad_info.ad_name, ad_info.impressions,
+            ad_info.clicks, ad_info.total_cost_in_cents)
+
+    def test_round_trip(self):
+        """Rows, strings, messages and CTRs survive being written and read"""
+
+        rows = make_rows(500)
+        for row in rows:
+            row.date = u"2011-01-01"
+        writer = CacheWriter()
+        for row in rows:
+            writer.add(row)
+        writer.write(self.path, [(logging.WARNING, u"Caf\u00e9 warning")])
+        report = CachedReport(self.path)
+        try:
+            self.assertEqual(len(report), 500)
+            self.assertEqual(report.messages, [(logging.WARNING, u"Caf\u00e9 warning")])
+            cached = list(report.ad_infos())
+            self.assertEqual([self.fields(row) for row in cached],
+                [self.fields(row) for row in rows])
+            for row, original in zip(cached, rows):
+                self.assertAlmostEqual(row.ctr, original.ctr, 3)
+            batches = list(report.batches(64))
+            self.assertEqual([len(batch) for batch in batches], [64] * 7 + [52])
+            self.assertEqual([row for batch in batches for row in batch.rows()],
+                [self.fields(row) for row in rows])
+        finally:
+            report.close()
+
+    def test_batches_written(self):
+        """Rows added a batch at a time are kept the same as one at a time"""
+
+        rows = make_rows(100)
+        batch = admetrics.AdBatch()
+        for row in rows:
+            row.date = u"2011-01-02"
+            batch.append(row)
+        writer = CacheWriter()
+        writer.add_batch(batch)
+        writer.write(self.path)
+        report = CachedReport(self.path)
+        try:
+            self.assertEqual([self.fields(row) for row in report.ad_infos()],
+                [self.fields(row) for row in rows])
+        finally:
+            report.close()
+
+    def test_empty(self):
+        """A report with no rows can be cached"""
+
+        CacheWriter().write(self.path)
+        report = CachedReport(self.path)
+        self.assertEqual(list(report.ad_infos()), [])
+        self.assertEqual(list(report.batches()), [])
+        report.close()
+
+    def test_damaged(self):
+        """Files that are not whole cache files are refused"""
+
+        writer = CacheWriter()
+        for row in make_rows(10):
+            writer.add(row)
+        writer.write(self.path)
+        with open(self.path, "rb") as f:
+            data = f.read()
+        for damaged in ("", data[:20], "X" + data[1:], data[:-8]):
+            with open(self.path, "wb") as f:
+                f.write(damaged)
+            self.assertRaises(ValueError, CachedReport, self.path)
+
+class TestCommandLine(unittest.TestCase):
+    """Output from the cache is the same as from parsing the input"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir, "cache")
+        sample = open("sample_input.csv", "rb").read()
+        for name, data in (
+                ("2011-01-01.csv", sample),
+                ("2011-01-02.csv", sample.replace("01/01/2011", "01/02/2011")),
+                ("2011-01-03.csv", sample.replace("$10.22", "$-1.00"))):
+            with open(os.path.join(self.tmpdir, name), "wb") as f:
+                f.write(data)
+        self.handler = CapturingHandler()
+        self.saved_handlers = logging.getLogger().handlers
+        logging.getLogger().handlers = [self.handler]
+
+    def tearDown(self):
+        logging.getLogger().handlers = self.saved_handlers
+        shutil.rmtree(self.tmpdir)
+
+    def run_main(self, *argv):
+        """Run main() with the given arguments, returning (output, log, exited)"""
+
+        del self.handler.messages[:]
+        saved_stdout = sys.stdout
+        sys.stdout = StringIO()
+        exited = False
+        try:
+            admetrics.main(["admetrics.py"] + list(argv))
+        except SystemExit:
+            exited = True
+        finally:
+            output = sys.stdout.getvalue()
+            sys.stdout = saved_stdout
+        return output, list(self.handler.messages), exited
+
+    def entries(self):
+        """The names of the cache files"""
+
+        return sorted(name for name in os.listdir(self.cache_dir)
+            if name.endswith(".adc"))
+
+    def test_single_file(self):
+        """Each way of reading a file gives the same output from the cache"""
+
+        path = os.path.join(self.tmpdir, "2011-01-01.csv")
+        for options in ([], ["--jobs", "2"], ["--pipeline"]):
+            expected = self.run_main(path, *options)
+            self.assertEqual(len(expected[1]), 1)
+            for run in range(2):
+                self.assertEqual(self.run_main("--cache-dir", self.cache_dir,
+                    path, *options), expected)
+        # Sharded input is mapped, so its warnings are cached apart
+        self.assertEqual(len(self.entries()), 2)
+
+    def test_index(self):
+        """Indexed input is mapped, so it is cached apart from the rest"""
+
+        path = os.path.join(self.tmpdir, "2011-01-01.csv")
+        index = os.path.join(self.tmpdir, "ads.idx")
+        runs = [[path], ["--index", index, path]]
+        expected = [self.run_main(*argv) for argv in runs]
+        self.assertTrue("(byte " in expected[1][1][0][1])
+        self.assertFalse("(byte " in expected[0][1][0][1])
+        for run in range(2):
+            for argv, result in zip(runs, expected):
+                self.assertEqual(self.run_main("--cache-dir", self.cache_dir, *argv),
+                    result)
+        self.assertEqual(len(self.entries()), 2)
+
+    def test_changed_file(self):
+        """A file is parsed again once it changes, and not before"""
+
+        path = os.path.join(self.tmpdir, "2011-01-01.csv")
+        args = parse_command_line(["--cache-dir", self.cache_dir, path])
+        calls = []
+        def parse(produce):
+            calls.append(path)
+            admetrics.make_reader(path, args, produce).process_input()
+        rows = []
+        produce = lambda ad_info, first, args: rows.append(ad_info.impressions)
+        self.assertFalse(process_cached(path, args, parse, produce))
+        self.assertTrue(process_cached(path, args, parse, produce))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(rows[:3], rows[3:])
+        data = open(path, "rb").read().replace("Great Deals", "Big Deals")
+        with open(path, "wb") as f:
+            f.write(data)
+        mtime = os.path.getmtime(path) + 10
+        os.utime(path, (mtime, mtime))
+        self.assertFalse(process_cached(path, args, parse, produce))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(self.entries()), 2)
+
+    def test_failed_file(self):
+        """A file that fails is not cached, and fails the same way again"""
+
+        path = os.path.join(self.tmpdir, "2011-01-03.csv")
+        expected = self.run_main(path)
+        self.assertTrue(expected[2])
+        self.assertEqual(self.run_main("--cache-dir", self.cache_dir, path), expected)
+        self.assertEqual(self.entries(), [])
+
+    def test_damaged_entry(self):
+        """A damaged cache file is parsed again and replaced"""
+
+        path = os.path.join(self.tmpdir, "2011-01-01.csv")
+        expected = self.run_main("--cache-dir", self.cache_dir, path)
+        entry = os.path.join(self.cache_dir, self.entries()[0])
+        with open(entry, "r+b") as f:
+            f.truncate(40)
+        self.assertEqual(self.run_main("--cache-dir", self.cache_dir, path), expected)
+        self.assertTrue(os.path.getsize(entry) > 40)
+
+    def test_batch(self):
+        """Files in a batch are cached one by one, except the one that fails"""
+
+        for jobs in ("1", "2"):
+            expected = self.run_main("--jobs", jobs, self.tmpdir)
+            for run in range(2):
+                self.assertEqual(self.run_main("--jobs", jobs, "--cache-dir",
+                    self.cache_dir, self.tmpdir), expected)
+        self.assertEqual(len(self.entries()), 2)
+
+    def test_sqlite(self):
+        """Loading into SQLite from the cache loads the same rows"""
+
+        counts = []
+        for run in range(3):
+            options = ["--cache-dir", self.cache_dir] if run else []
+            database = os.path.join(self.tmpdir, "ads%d.db" % run)
+            args = parse_command_line(options + ["--sqlite", database, self.tmpdir])
+            self.assertFalse(load_files(find_inputs(args.input, args.pattern), args))
+            import sqlite3
+            connection = sqlite3.connect(database)
+            counts.append(connection.execute(
+                "SELECT COUNT(*), SUM(clicks) FROM ad_report_data").fetchall())
+            connection.close()
+        self.assertEqual(counts, [[(6, 334)]] * 3)
+
+    def test_refused_options(self):
+        """Options whose effects would not be cached are refused"""
+
+        saved_stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            for option in ("--checkpoint", "--quarantine"):
+                self.assertRaises(SystemExit, parse_command_line, ["--cache-dir",
+                    self.cache_dir, option, os.path.join(self.tmpdir, "x"),
+                    "sample_input.csv"])
+        finally:
+            sys.stderr = saved_stderr
+
+if __name__ == '__main__':
+    unittest.main()
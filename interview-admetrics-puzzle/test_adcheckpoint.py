@@ -0,0 +1,195 @@
+#!/usr/bin/python
+
+# Testing functions for the adcheckpoint module.
+
+import os
+import shutil
+import logging
+import unittest
+import tempfile
+
+from admetrics import AdDataReader, MappedSource, RunContext, parse_command_line
+from addedup import ExactDeduper, BloomDeduper
+from adcheckpoint import Checkpoint
+
+class TestCheckpoint(unittest.TestCase):
+    """A run that fails and is resumed must match one that does not fail"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "report.csv")
+        self.checkpoint = os.path.join(self.tmpdir, "checkpoint")
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.tmpdir)
+
+    def write_report(self, rows):
+        """Write a report with the given data rows"""
+
+        with open(self.path, "wb") as f:
+            f.write("Report Date: 01/01/2011\n"
+                "Ad Group,Ad Name,Impressions,Clicks,CTR,Total Cost\n")
+            f.write("\n".join(rows) + "\n")
+
+    def rows(self, count):
+        """Good data rows"""
+
+        return ['Group %d,"Ad ""%d""",%d,%d,%.4f,$%d.%02d' % (
+            i % 7, i, i + 10, i, float(i) / (i + 10), i + 1, i % 100)
+            for i in range(count)]
+
+    def run_reader(self, deduper=None, every=10, **options):
+        """Read the report with a checkpoint, returning (rows, exited, reader)"""
+
+        produced = []
+        def producer(ad_info, first, args):
+            if deduper is not None and not deduper.add(ad_info.date, ad_info.ad_name):
+                exit(1)
+            produced.append((first, ad_info.ad_name, ad_info.clicks))
+        checkpoint = Checkpoint(self.checkpoint, every, deduper)
+        reader = AdDataReader(MappedSource(self.path), producer, True,
+            checkpoint=checkpoint, **options)
+        try:
+            reader.process_input()
+        except SystemExit:
+            return produced, True, reader
+        return produced, False, reader
+
+    def test_resume(self):
+        """Resuming carries on from the last save with the same totals"""
+
+        for options in ({}, {'validation': 'columnar', 'validation_batch': 7}):
+            rows = self.rows(100)
+            self.write_report(rows)
+            expected, exited, reader = self.run_reader(**options)
+            self.assertFalse(exited)
+            self.assertFalse(os.path.exists(self.checkpoint))
+
+            bad = list(rows)
+            bad[55] = "Group,,1,1,1.0,$1.00"
+            self.write_report(bad)
+            first_run, exited, reader = self.run_reader(**options)
+            self.assertTrue(exited)
+            self.assertTrue(os.path.exists(self.checkpoint))
+
+            self.write_report(rows)
+            second_run, exited, resumed = self.run_reader(**options)
+            self.assertFalse(exited)
+            self.assertFalse(second_run[0][0])
+            done = len(expected) - len(second_run)
+            self.assertTrue(40 <= done <= 55)
+            self.assertEqual(first_run[:done] + second_run, expected)
+            self.assertEqual(resumed.accumulator, {'clicks': sum(range(100)),
+                'impressions': sum(range(100)) + 1000,
+                'total cost in cents': sum(i * 101 + 100 for i in range(100))})
+            self.assertEqual(resumed.lineno, 102)
+
+    def test_resume_batches(self):
+        """Batches read before a failure are not read again"""
+
+        rows = self.rows(100)
+        bad = list(rows)
+        bad[55] = "Group,,1,1,1.0,$1.00"
+        self.write_report(bad)
+        names = []
+        reader = AdDataReader(MappedSource(self.path), None, True,
+            checkpoint=Checkpoint(self.checkpoint, 10))
+        try:
+            for batch in reader.batches(15):
+                names.extend(batch.ad_names)
+        except SystemExit:
+            pass
+        self.assertEqual(len(names), 45)
+        self.write_report(rows)
+        reader = AdDataReader(MappedSource(self.path), None, True,
+            checkpoint=Checkpoint(self.checkpoint, 10))
+        for batch in reader.batches(15):
+            names.extend(batch.ad_names)
+        self.assertEqual(names, [u'Ad "%d"' % i for i in range(100)])
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_dedup_state(self):
+        """Keys seen before the save are still known after resuming"""
+
+        for make in (ExactDeduper, lambda: BloomDeduper(1000, 0.01)):
+            rows = self.rows(60)
+            bad = list(rows)
+            bad[45] = "Group,,1,1,1.0,$1.00"
+            self.write_report(bad)
+            produced, exited, reader = self.run_reader(make())
+            self.assertTrue(exited)
+            repeat = list(rows)
+            repeat[50] = rows[3]
+            self.write_report(repeat)
+            deduper = make()
+            produced, exited, reader = self.run_reader(deduper)
+            self.assertTrue(exited)
+            self.assertEqual(deduper.stats()['duplicates'], 1)
+            os.remove(self.checkpoint)
+
+    def test_quarantine(self):
+        """Rows quarantined, and warnings, before the save are kept on resuming"""
+
+        rows = self.rows(60)
+        for i in (5, 20, 42):
+            rows[i] = "Group,,1,1,1.0,$1.00"
+        for i in (8, 43):
+            rows[i] = rows[i].replace(",0.", ",0.9", 1)
+        quarantine = os.path.join(self.tmpdir, "rejects.csv")
+        args = parse_command_line(["--quarantine", quarantine,
+            "--checkpoint", self.checkpoint, self.path])
+        def run(deduper):
+            options = {'quarantine': RunContext(args).row_quarantine()}
+            produced, exited, reader = self.run_reader(deduper, **options)
+            reader.quarantine.stream.close()
+            return exited, reader
+        self.write_report(rows)
+        exited, reader = run(None)
+        self.assertFalse(exited)
+        expected = open(quarantine, "rb").read()
+        expected_counts = reader.diagnostics.counts
+
+        repeat = list(rows)
+        repeat[45] = rows[3]
+        self.write_report(repeat)
+        exited, reader = run(ExactDeduper())
+        self.assertTrue(exited)
+        self.write_report(rows)
+        exited, reader = run(ExactDeduper())
+        self.assertFalse(exited)
+        self.assertEqual(open(quarantine, "rb").read(), expected)
+        self.assertEqual(expected.count("\n"), 4)
+        self.assertEqual(reader.quarantine.count, 3)
+        self.assertEqual(reader.diagnostics.counts, expected_counts)
+        self.assertEqual(sum(expected_counts.values()), 2)
+
+    def test_changed_file(self):
+        """A file that has changed before the saved offset is not resumed"""
+
+        rows = self.rows(30)
+        bad = list(rows)
+        bad[25] = "Group,,1,1,1.0,$1.00"
+        self.write_report(bad)
+        self.run_reader()
+        rows[5] = rows[5].replace("Group", "Grope")
+        self.write_report(rows)
+        produced, exited, reader = self.run_reader()
+        self.assertTrue(exited)
+        self.assertEqual(produced, [])
+
+    def test_needs_mapped_source(self):
+        """A checkpoint can only be resumed with a memory-mapped file"""
+
+        bad = self.rows(30)
+        bad[25] = "Group,,1,1,1.0,$1.00"
+        self.write_report(bad)
+        self.run_reader()
+        with open(self.path, "r") as f:
+            reader = AdDataReader(f, None, True,
+                checkpoint=Checkpoint(self.checkpoint, 10))
+            self.assertRaises(SystemExit, reader.process_input)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,251 @@
+#!/usr/bin/python
+
+# Testing functions for the adcompress module.
+
+import os
+import bz2
+import gzip
+import logging
+import shutil
+import unittest
+import tempfile
+
+from StringIO import StringIO
+
+import admetrics
+import adcompress
+from adcompress import open_input, open_text, detect, BackgroundFile, DecompressedFile
+from adcompress import CompressedInputError
+
+def report(count):
+    """Return a report of count lines"""
+
+    return "".join("line %d,%s\n" % (i, "x" * (i % 50)) for i in range(count))
+
+class TestCompressedInput(unittest.TestCase):
+    """Compressed input must read back exactly as the plain data"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.data = report(20000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def gzipped(self, data):
+        out = StringIO()
+        f = gzip.GzipFile(fileobj=out, mode="wb")
+        f.write(data)
+        f.close()
+        return out.getvalue()
+
+    def compressed(self):
+        """(kind, compressed data) for each kind that can be read here"""
+
+        kinds = [('gzip', self.gzipped(self.data)), ('bz2', bz2.compress(self.data))]
+        if adcompress.lzma is not None:
+            kinds.append(('xz', adcompress.lzma.compress(self.data)))
+        return kinds
+
+    def read_lines(self, f):
+        lines = list(f)
+        f.close()
+        return "".join(lines)
+
+    def test_detect(self):
+        """Each kind is recognized by its first bytes, whatever the name"""
+
+        for kind, data in self.compressed():
+            self.assertEqual(detect(data), kind)
+            path = self.write("report.csv", data)
+            self.assertEqual(adcompress.compression_of(path), kind)
+        self.assertEqual(detect(self.data), None)
+        self.assertEqual(detect("BZh is not bzip2\n"), None)
+        self.assertEqual(detect("BZh"), None)
+
+    def test_round_trip(self):
+        """Read by lines or blocks, with or without a thread, the data is the same"""
+
+        for kind, data in self.compressed():
+            path = self.write("report." + kind, data)
+            for block_size in (7, 4096, adcompress.BLOCK_SIZE):
+                self.assertEqual(self.read_lines(open_input(path, False, block_size)),
+                    self.data)
+                f = open_input(path, True, block_size)
+                pieces = []
+                while True:
+                    piece = f.read(1000)
+                    if not piece:
+                        break
+                    self.assertTrue(len(piece) <= 1000)
+                    pieces.append(piece)
+                f.close()
+                self.assertEqual("".join(pieces), self.data)
+
+    def test_plain(self):
+        """Plain files are opened as they are, and plain streams pass through"""
+
+        path = self.write("report.csv", self.data)
+        f = open_input(path)
+        self.assertTrue(isinstance(f, file))
+        f.close()
+        self.assertEqual(self.read_lines(open_input(StringIO(self.data))), self.data)
+        self.assertEqual(open_input(StringIO("ab")).read(), "ab")
+
+    def test_streams_one_after_another(self):
+        """Concatenated compressed streams are all read"""
+
+        halves = (self.data[:5000], self.data[5000:])
+        for data in ("".join(self.gzipped(half) for half in halves),
+                "".join(bz2.compress(half) for half in halves)):
+            for block_size in (100, adcompress.BLOCK_SIZE):
+                f = open_input(StringIO(data), False, block_size)
+                self.assertEqual(f.read(), self.data)
+
+    def test_truncated(self):
+        """Input that ends part way through a stream is an error"""
+
+        for kind, data in self.compressed():
+            f = open_input(StringIO(data[:len(data) // 2]))
+            self.assertRaises(CompressedInputError, f.read)
+            f = open_input(StringIO(data[:len(data) // 2]), True)
+            self.assertRaises(CompressedInputError, f.read)
+            f.close()
+
+    def test_truncated_lines(self):
+        """The whole lines before the end of cut short input are read first"""
+
+        data = self.gzipped(self.data)
+        for threaded in (False, True):
+            for block_size in (100, adcompress.BLOCK_SIZE):
+                f = open_text(StringIO(data[:len(data) // 2]), "utf-8", threaded,
+                    block_size)
+                lines = []
+                self.assertRaises(CompressedInputError,
+                    lambda: lines.extend(iter(f.readline, u"")))
+                f.close()
+                self.assertTrue(len(lines) > 1000)
+                self.assertTrue(self.data.startswith("".join(lines)))
+                self.assertTrue(lines[-1].endswith(u"\n"))
+
+    def test_damaged(self):
+        """Damaged data, or xz data without lzma, is an error when it is read"""
+
+        for kind, data in self.compressed():
+            damaged = data[:len(data) // 2] + "\xff" * 64 + data[len(data) // 2:]
+            f = open_input(StringIO(damaged))
+            self.assertRaises(CompressedInputError, f.read)
+        saved_lzma = adcompress.lzma
+        adcompress.lzma = None
+        try:
+            f = open_input(StringIO("\xfd7zXZ\x00" + "\0" * 100))
+            self.assertRaises(CompressedInputError, f.read)
+        finally:
+            adcompress.lzma = saved_lzma
+
+    def test_background_close(self):
+        """Closing a background reader part way through stops its thread"""
+
+        f = BackgroundFile(DecompressedFile(StringIO(bz2.compress(self.data)),
+            'bz2', block_size=100), depth=1)
+        f.readline()
+        f.close()
+        self.assertFalse(f.thread.is_alive())
+
+class TestCompressedReports(unittest.TestCase):
+    """Compressed reports give the same rows as the plain ones"""
+
+    def test_truncated(self):
+        """A report that is cut short is logged as an error, in each mode"""
+
+        tmpdir = tempfile.mkdtemp()
+        handler = logging.Handler()
+        messages = []
+        handler.emit = lambda record: messages.append(record.getMessage())
+        saved_handlers = logging.getLogger().handlers
+        logging.getLogger().handlers = [handler]
+        try:
+            with open("sample_input.csv", "rb") as f:
+                data = f.read()
+            path = os.path.join(tmpdir, "sample_input.csv.bz2")
+            with open(path, "wb") as f:
+                f.write(bz2.compress(data)[:-20])
+            for options in ([], ["--block-size", "0"], ["--pipeline"]):
+                del messages[:]
+                args = admetrics.parse_command_line([path] + options)
+                reader = admetrics.make_reader(path, args, context=admetrics.RunContext(
+                    args, admetrics.OutputWriter(StringIO())))
+                if args.pipeline:
+                    import adpipeline
+                    run = adpipeline.Pipeline(reader).run
+                else:
+                    run = reader.process_input
+                self.assertRaises(SystemExit, run)
+                self.assertTrue(messages[0].startswith("While reading input"))
+                self.assertTrue("ends part way through" in messages[0])
+                # Nothing could be read from it
+                self.assertTrue("%s:0: :\n" % path in messages[0])
+            # gzip gives the lines before the cut, and the error comes after
+            # the last of them
+            lines = ["Report Date: 01/01/2011",
+                "Ad Group,Ad Name,Impressions,Clicks,CTR,Total Cost"]
+            lines.extend("Group,Ad %d,%d,1,%.4f,$1.00" % (i, i + 1, 1.0 / (i + 1))
+                for i in range(20000))
+            data = "\n".join(lines) + "\n"
+            out = StringIO()
+            f = gzip.GzipFile(fileobj=out, mode="wb")
+            f.write(data)
+            f.close()
+            path = os.path.join(tmpdir, "report.csv.gz")
+            with open(path, "wb") as f:
+                f.write(out.getvalue()[:len(out.getvalue()) // 2])
+            for options in ([], ["--block-size", "0"], ["--decompress-thread"],
+                    ["--pipeline"]):
+                del messages[:]
+                args = admetrics.parse_command_line([path] + options)
+                reader = admetrics.make_reader(path, args, lambda *a, **k: None)
+                if args.pipeline:
+                    import adpipeline
+                    run = adpipeline.Pipeline(reader).run
+                else:
+                    run = reader.process_input
+                self.assertRaises(SystemExit, run)
+                state = messages[0].splitlines()[1]
+                lineno = int(state.split(":")[1])
+                self.assertTrue(lineno > 1000)
+                self.assertEqual(state, "%s:%d: %s:" % (path, lineno, lines[lineno - 1]))
+        finally:
+            logging.getLogger().handlers = saved_handlers
+            shutil.rmtree(tmpdir)
+
+    def test_sample(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open("sample_input.csv", "rb") as f:
+                data = f.read()
+            path = os.path.join(tmpdir, "sample_input.csv.bz2")
+            with open(path, "wb") as f:
+                f.write(bz2.compress(data))
+            results = []
+            for name, options in (("sample_input.csv", []), (path, []),
+                    (path, ["--decompress-thread", "--mmap", "--block-size", "0"])):
+                args = admetrics.parse_command_line([name] + options)
+                rows = []
+                def producer(ad_info, first, args):
+                    rows.append((ad_info.ad_name, ad_info.total_cost_in_cents))
+                admetrics.make_reader(name, args, producer).process_input()
+                results.append(rows)
+            self.assertTrue(len(results[0]) > 0)
+            self.assertEqual(results[1], results[0])
+            self.assertEqual(results[2], results[0])
+        finally:
+            shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+
+# Testing functions for the addedup module.
+
+import random
+import unittest
+
+from addedup import ExactDeduper, BloomDeduper, make_deduper
+
+class TestDedupers(unittest.TestCase):
+    """Every deduper must find exactly the repeated keys"""
+
+    def keys(self, count, seed=1):
+        """Return (date, key) pairs with some repeated, and the expected answers"""
+
+        rng = random.Random(seed)
+        pairs = []
+        seen = set()
+        expected = []
+        for i in range(count):
+            date = u"2011-01-0%d" % rng.randint(1, 3)
+            key = u"%s,group,ad %d" % (date, rng.randint(0, count // 2))
+            pairs.append((date, key))
+            expected.append((date, key) not in seen)
+            seen.add((date, key))
+        return pairs, expected
+
+    def check(self, deduper, count=5000):
+        """Compare a deduper's answers with the expected ones"""
+
+        pairs, expected = self.keys(count)
+        self.assertEqual([deduper.add(date, key) for date, key in pairs], expected)
+        stats = deduper.stats()
+        self.assertEqual(stats['keys'], expected.count(True))
+        self.assertEqual(stats['duplicates'], expected.count(False))
+        return stats
+
+    def test_exact(self):
+        """Exact matching by digest"""
+
+        self.check(ExactDeduper())
+
+    def test_exact_forget(self):
+        """Forgetting a date lets its keys be seen again"""
+
+        deduper = ExactDeduper()
+        self.assertTrue(deduper.add(u"2011-01-01", u"2011-01-01,a,b"))
+        deduper.forget(u"2011-01-01")
+        self.assertTrue(deduper.add(u"2011-01-01", u"2011-01-01,a,b"))
+
+    def test_bloom_forget(self):
+        """Forgetting a date drops its stored keys, and the rest are kept"""
+
+        BloomDeduper.SPILL_BATCH, saved = 10, BloomDeduper.SPILL_BATCH
+        try:
+            deduper = BloomDeduper(1000, 0.01)
+            for date in (u"2011-01-01", u"2011-01-02"):
+                for i in range(25):
+                    self.assertTrue(deduper.add(date, u"%s,a,%d" % (date, i)))
+            deduper.forget(u"2011-01-01")
+            self.assertEqual(deduper.stats()['keys'], 25)
+            self.assertTrue(deduper.add(u"2011-01-01", u"2011-01-01,a,0"))
+            self.assertFalse(deduper.add(u"2011-01-02", u"2011-01-02,a,0"))
+            deduper.forget(u"2011-01-01")
+            deduper.forget(u"2011-01-02")
+            self.assertEqual(deduper.stats()['keys'], 0)
+            self.assertEqual(deduper.filter, bytearray(len(deduper.filter)))
+        finally:
+            BloomDeduper.SPILL_BATCH = saved
+
+    def test_add_all(self):
+        """A set of keys is added whole, or not at all if one was seen"""
+
+        for deduper in (ExactDeduper(), BloomDeduper(1000, 0.01)):
+            date = u"2011-01-01"
+            keys = [u"%s,group,ad %d" % (date, i) for i in range(100)]
+            self.assertEqual(deduper.add_all(date, keys[:50]), None)
+            self.assertEqual(deduper.add_all(date, keys[40:]), keys[40])
+            self.assertEqual(deduper.add_all(date, keys[50:]), None)
+            self.assertEqual(deduper.stats()['keys'], 100)
+            self.assertEqual([deduper.add(date, key) for key in keys[95:]], [False] * 5)
+            self.assertTrue(deduper.add(u"2011-01-02", keys[0]))
+
+    def test_bloom(self):
+        """A Bloom filter sized for the keys"""
+
+        stats = self.check(BloomDeduper(10000, 0.01))
+        self.assertTrue(stats['false_positives'] < 100)
+
+    def test_bloom_overloaded(self):
+        """A filter that is far too small still gives the right answers"""
+
+        BloomDeduper.SPILL_BATCH, saved = 100, BloomDeduper.SPILL_BATCH
+        try:
+            stats = self.check(BloomDeduper(50, 0.1))
+        finally:
+            BloomDeduper.SPILL_BATCH = saved
+        self.assertTrue(stats['false_positives'] > 0)
+        self.assertTrue(stats['spilled'] > 0)
+
+    def test_bloom_memory(self):
+        """The filter's memory does not grow with the keys added"""
+
+        deduper = BloomDeduper(1000, 0.01)
+        before = len(deduper.filter)
+        self.check(deduper)
+        self.assertEqual(len(deduper.filter), before)
+
+    def test_bad_settings(self):
+        """Bad modes and filter sizes are rejected"""
+
+        self.assertRaises(ValueError, make_deduper, 'fuzzy')
+        self.assertRaises(ValueError, BloomDeduper, 0)
+        self.assertRaises(ValueError, BloomDeduper, 10, 1.5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+#!/usr/bin/python
+
+# Testing functions for the adindex module.
+
+import os
+import sys
+import shutil
+import codecs
+import logging
+import unittest
+import tempfile
+
+from StringIO import StringIO
+
+import admetrics
+import adindex
+from admetrics import AdDataReader, AdBatch
+from adindex import FileEntries, ReportIndex
+
+class TestReportIndex(unittest.TestCase):
+    """Rows stored in an index are found by date, ad group and ad name"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.index = ReportIndex(os.path.join(self.tmpdir, "ads.idx"))
+        self.sample = open("sample_input.csv", "rb").read()
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmpdir)
+
+    def entries(self, day, data=None):
+        """The FileEntries of a copy of the sample for the given day of January"""
+
+        path = os.path.join(self.tmpdir, "2011-01-%02d.csv" % day)
+        with open(path, "wb") as f:
+            f.write((data or self.sample).replace("01/01/2011", "01/%02d/2011" % day))
+        entries = FileEntries(path)
+        with open(path, "rb") as f:
+            AdDataReader(codecs.getreader("utf-8")(f), entries.add, True).process_input()
+        return entries
+
+    def test_query(self):
+        """Queries by date range, ad group and ad name, in any case"""
+
+        for day in range(1, 11):
+            self.index.store(self.entries(day))
+        rows = list(self.index.query("2011-01-03", "2011-01-05", ad_group="HONDA"))
+        self.assertEqual(len(rows), 6)
+        self.assertEqual([row[0] for row in rows], [u"2011-01-03"] * 2 +
+            [u"2011-01-04"] * 2 + [u"2011-01-05"] * 2)
+        self.assertEqual(rows[0][1:], (u"honda", u"cheap used hondas", 340, 44, 1502,
+            os.path.join(self.tmpdir, "2011-01-03.csv"), 2, None))
+        rows = list(self.index.query(ad_name="Good Deals on Nissans"))
+        self.assertEqual(len(rows), 10)
+        self.assertEqual(len(list(self.index.query(end="2011-01-02"))), 6)
+        self.assertEqual(len(list(self.index.query())), 30)
+        self.assertEqual(list(self.index.query(ad_group="toyota")), [])
+
+    def test_replace(self):
+        """Storing a file again replaces the rows stored for it"""
+
+        self.index.store(self.entries(1))
+        self.index.store(self.entries(2))
+        self.index.store(self.entries(1, self.sample.replace(
+            "Nissan,Good Deals on Nissans,500,100,0.2000,$50.00\n", "").replace(
+            "Total,,1140,167,0.1465,$75.24", "Total,,640,67,0.1047,$25.24")))
+        self.assertEqual([row[1:3] for row in self.index.query(end="2011-01-01")],
+            [(u"honda", u"cheap used hondas"), (u"honda", u"great deals on new hondas")])
+        self.assertEqual([(row[1], row[2]) for row in self.index.files()],
+            [(u"2011-01-01", 2), (u"2011-01-02", 3)])
+
+    def test_batches(self):
+        """Rows collected a batch at a time are the same as one at a time"""
+
+        self.index.store(self.entries(1))
+        expected = list(self.index.query())
+        rows = []
+        path = os.path.join(self.tmpdir, "2011-01-01.csv")
+        with open(path, "rb") as f:
+            AdDataReader(codecs.getreader("utf-8")(f),
+                lambda ad_info, first, args: rows.append(ad_info), True).process_input()
+        entries = FileEntries(path)
+        for start in (0, 2):
+            batch = AdBatch()
+            for row in rows[start:start + 2]:
+                batch.append(row)
+            entries.add_batch(batch)
+        entries.add_batch(AdBatch())
+        self.assertEqual((entries.date, len(entries)), (u"2011-01-01", 3))
+        self.index.store(entries)
+        self.assertEqual(list(self.index.query()), expected)
+
+    def test_stored_as_read(self):
+        """Rows are stored a batch at a time, with their byte offsets"""
+
+        path = os.path.join(self.tmpdir, "2011-01-01.csv")
+        with open(path, "wb") as f:
+            f.write(self.sample)
+        args = admetrics.parse_command_line(["--no-total-warning", "--index",
+            self.index.path, path])
+        context = admetrics.RunContext(args)
+        context.index_entries = entries = self.index.entries(path)
+        entries.BATCH_SIZE = 2
+        stored = []
+        def produce(ad_info, first, args):
+            entries.add(ad_info)
+            stored.append(len(list(self.index.query())))
+        reader = admetrics.make_reader(path, args, produce, context=context)
+        reader.process_input()
+        reader.source.close()
+        self.assertEqual(stored, [0, 2, 2])
+        self.index.finish(entries)
+        rows = list(self.index.query())
+        self.assertEqual([row[-2] for row in rows], [2, 1, 3])
+        for row in rows:
+            line = self.sample[row[-1]:].splitlines()[0]
+            self.assertTrue(line.lower().startswith("%s,%s," % row[1:3]))
+        self.assertEqual([row[1:3] for row in self.index.files()], [(u"2011-01-01", 3)])
+        self.index.discard(entries)
+        self.assertEqual(list(self.index.query()), [])
+        self.assertEqual(list(self.index.files()), [])
+
+class TestCommandLine(unittest.TestCase):
+    """Indexes built from the command line, for each way of processing input"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        logging.disable(logging.CRITICAL)
+        sample = open("sample_input.csv", "rb").read()
+        for name, data in (
+                ("2011-01-01.csv", sample),
+                ("2011-01-02.csv", sample.replace("01/01/2011", "01/02/2011")),
+                ("2011-01-03.csv", sample.replace("$10.22", "$-1.00"))):
+            with open(os.path.join(self.tmpdir, name), "wb") as f:
+                f.write(data)
+        self.index = os.path.join(self.tmpdir, "ads.idx")
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.tmpdir)
+
+    def run_main(self, main, *argv):
+        """Run a main() with the given arguments, returning its output"""
+
+        saved_stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            main(["program"] + list(argv))
+        except SystemExit:
+            pass
+        finally:
+            output = sys.stdout.getvalue()
+            sys.stdout = saved_stdout
+        return output
+
+    def indexed(self):
+        """The query output for the whole index, with locations"""
+
+        return self.run_main(adindex.main, self.index, "--locations",
+            "--no-output-bom").decode("utf-8").splitlines()
+
+    def test_modes(self):
+        """The good files are indexed the same way in every mode"""
+
+        runs = [[self.tmpdir], ["--jobs", "2", self.tmpdir],
+            ["--sqlite", os.path.join(self.tmpdir, "ads.db"), self.tmpdir]]
+        results = []
+        for argv in runs:
+            if os.path.exists(self.index):
+                os.unlink(self.index)
+            self.run_main(admetrics.main, "--index", self.index, *argv)
+            results.append(self.indexed())
+        self.assertEqual(len(results[0]), 1 + 6)
+        offset = open("sample_input.csv", "rb").read().index("Honda,Cheap")
+        self.assertEqual(results[0][1], u"2011-01-01,honda,cheap used hondas," +
+            "340,44,1502,%s,2,%d" % (os.path.join(self.tmpdir, "2011-01-01.csv"), offset))
+        self.assertEqual(results[1], results[0])
+        self.assertEqual(results[2], results[0])
+
+    def test_single_file(self):
+        """A single file is indexed when it is read serially or pipelined"""
+
+        path = os.path.join(self.tmpdir, "2011-01-02.csv")
+        for options in ([], ["--pipeline"], ["--jobs", "2"]):
+            self.run_main(admetrics.main, "--index", self.index, path, *options)
+            self.assertEqual(len(self.indexed()), 1 + 3)
+        self.run_main(admetrics.main, "--index", self.index,
+            os.path.join(self.tmpdir, "2011-01-03.csv"))
+        self.assertEqual(len(self.indexed()), 1 + 3)
+
+    def test_query_output(self):
+        """Query results are written as admetrics writes its output"""
+
+        self.run_main(admetrics.main, "--index", self.index, self.tmpdir)
+        output = self.run_main(adindex.main, self.index, "--from", "2011-01-02",
+            "--ad-group", "Nissan")
+        self.assertEqual(output.decode("utf-8-sig").splitlines(), [
+            u"report_date, ad_group, ad_name, impressions, clicks, total_cost_in_cents",
+            u"2011-01-02,nissan,good deals on nissans,500,100,5000"])
+
+if __name__ == '__main__':
+    unittest.main()
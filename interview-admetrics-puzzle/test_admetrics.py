@@ -5,12 +5,23 @@
 import os
 import sys
 import codecs
+import pickle
+import random
+import shutil
 import logging
+import itertools
+import tempfile
 import unittest
 import subprocess
+import admetrics
 from StringIO import StringIO
 
-from admetrics import AdInfo, AdDataReader, CSVError, CSVReader
+from admetrics import AdInfo, AdDataReader, CSVError, CSVReader, RowBuilder
+from admetrics import ColumnarValidator, AdBatch
+from admetrics import split_fields_fast, split_fields_reference, quote_is_open
+from admetrics import split_record_fast, split_record_reference
+from admetrics import MappedSource, OutputWriter, Quarantine, Diagnostics
+from adparallel import CapturingHandler
 
 class TestAdInfo(unittest.TestCase):
     """Unit tests for the AdInfo class"""
@@ -78,6 +89,15 @@ class TestAdInfo(unittest.TestCase):
         self.assertEqual(info.total_cost, 100.0)
         self.assertIsNone(self.did_warning)
 
+    def test_compact(self):
+        """AdInfo keeps only its parsed values, and pickles as such"""
+
+        info = self.make_ascii_adinfo()
+        self.assertFalse(hasattr(info, '__dict__'))
+        copy = pickle.loads(pickle.dumps(info, pickle.HIGHEST_PROTOCOL))
+        for name in AdInfo.__slots__:
+            self.assertEqual(getattr(copy, name), getattr(info, name))
+
     def test_bad_impressions(self):
         """Test sanity checking for invalid impressions/cost relationship"""
 
@@ -90,6 +110,101 @@ class TestAdInfo(unittest.TestCase):
         with self.assertRaises(CSVError):
             info = self.make_ascii_adinfo(ad_group='')
 
+class TestRowBuilder(unittest.TestCase):
+    """Unit tests for building AdInfo objects by column position"""
+
+    COLNAMES = ['campaign', 'clicks', 'ad name', 'ad group', 'total cost', 'ctr',
+        'impressions', 'date']
+
+    def setUp(self):
+        self.warnings = []
+
+    def test_matches_adinfo(self):
+        """Positional building gives the same values as AdInfo itself"""
+
+        values = ['c', '2', 'name', 'group', '$1.50', '25%', '8']
+        built = RowBuilder(self.COLNAMES, '2012-01-01').build(self.warnings.append, values)
+        info = AdInfo(self.warnings.append, self.COLNAMES, values + ['2012-01-01'])
+        for name in AdInfo.__slots__:
+            self.assertEqual(getattr(built, name), getattr(info, name))
+        self.assertEqual(built.ctr, 0.25)
+        self.assertEqual(self.warnings, [])
+
+    def test_extra_fields(self):
+        """Extra trailing fields do not disturb the report date"""
+
+        values = ['c', '2', 'name', 'group', '$1.50', '0.25', '8', 'extra']
+        built = RowBuilder(self.COLNAMES, '2012-01-01').build(self.warnings.append, values)
+        self.assertEqual(built.date, '2012-01-01')
+
+    def test_short_row(self):
+        """Rows missing required fields are an error"""
+
+        with self.assertRaises(CSVError):
+            RowBuilder(self.COLNAMES, '2012-01-01').build(self.warnings.append, ['c', '2'])
+
+class TestColumnarValidator(unittest.TestCase):
+    """The columnar checks must find exactly what AdInfo's checks find"""
+
+    COLNAMES = ['ad group', 'ad name', 'impressions', 'clicks', 'ctr', 'total cost']
+
+    def random_rows(self, count):
+        """Unchecked AdInfo objects with a mix of good and bad values"""
+
+        rng = random.Random(99)
+        builder = RowBuilder(self.COLNAMES, '2012-01-01')
+        rows = []
+        for i in range(count):
+            impressions = rng.choice([0, 0, -1, 3, 7, 1000, rng.randint(1, 10000)])
+            clicks = rng.choice([0, -2, 1, 2, rng.randint(0, 10000)])
+            if impressions > 0 and rng.random() < 0.7:
+                # Near the CTR computed from the counts, give or take the tolerance
+                ctr = "%.6f" % (float(clicks) / impressions + rng.choice(
+                    [0, 0.00005, -0.00005, 0.001, 0.00095, 0.00105, 0.05]))
+            else:
+                ctr = rng.choice(["0", "0.5", "12.5%", "0.0"])
+            cost = rng.choice(["$0.00", "$-1.00", "$3.50", "$12.34"])
+            group = rng.choice(["", "group", "Total"])
+            rows.append(builder.build(None, [group, "name", str(impressions), str(clicks),
+                ctr, cost], check=False))
+        return rows
+
+    def test_against_rows(self):
+        """Array checks and row checks agree on random data"""
+
+        rows = self.random_rows(5000)
+        expected = ColumnarValidator(use_numpy=False).check(rows)
+        self.assertTrue(len(expected) > 1000)
+        self.assertEqual(ColumnarValidator().check(rows), expected)
+
+    def test_reader_columnar(self):
+        """A reader in columnar mode produces and reports the same as row mode"""
+
+        lines = ["Report Date: 01/01/2011", "Ad Group,Ad Name,Impressions,Clicks,CTR,Total Cost"]
+        for i in range(50):
+            lines.append("g,ad %d,%d,1,%s,$1.00" % (i, i + 1, "0.9" if i % 7 else "0.5"))
+        lines.append("g,bad,10,1,0.1,$-1.00")
+        lines.append("g,never,10,1,0.1,$1.00")
+        text = "\n".join(lines) + "\n"
+
+        results = []
+        for validation in ('row', 'columnar'):
+            produced = []
+            messages = []
+            source = StringIO(text)
+            source.name = "test.csv"
+            reader = AdDataReader(source,
+                lambda ad_info, first, args: produced.append((first, ad_info.ad_name)),
+                True, validation=validation, validation_batch=8)
+            reader._emit = lambda level, text: messages.append((level, text))
+            with self.assertRaises(SystemExit):
+                reader.process_input()
+            results.append((produced, messages))
+        self.assertEqual(len(results[0][0]), 50)
+        self.assertTrue(len(results[0][1]) > 40)
+        self.assertTrue("negative cost" in results[0][1][-1][1])
+        self.assertEqual(results[0], results[1])
+
 class TestAdDataReader(unittest.TestCase):
     """Unit tests for the AdDataReader class"""
 
@@ -146,6 +261,259 @@ class TestAdDataReader(unittest.TestCase):
         reader.process_input()
         self.assertEqual(self.sample_date, u'2011-01-01')
 
+class TestBatchProducer(unittest.TestCase):
+    """Tests for the column batch consumer interface"""
+
+    def read_sample(self, batch_size):
+        """Read the sample by row and by batch, returning (rows, batches)"""
+
+        rows = []
+        def producer(ad_info, first, args):
+            rows.append((ad_info.date, ad_info.ad_group, ad_info.ad_name,
+                ad_info.impressions, ad_info.clicks,
+                int(round(ad_info.total_cost * 100))))
+        batches = []
+        def batch_producer(batch, first, args):
+            batches.append((first, batch))
+        for produce, options in ((producer, {}),
+                (None, {'produce_batch': batch_producer, 'batch_size': batch_size})):
+            with open("sample_input.csv", "r") as sample:
+                AdDataReader(codecs.getreader("utf-8")(sample), produce, True,
+                    **options).process_input()
+        return rows, batches
+
+    def test_batches_match_rows(self):
+        """Batches hold the same rows as the per-row producer sees"""
+
+        for batch_size in (1, 3, 10000):
+            rows, batches = self.read_sample(batch_size)
+            self.assertEqual([first for first, batch in batches],
+                [True] + [False] * (len(batches) - 1))
+            self.assertTrue(all(len(batch) <= batch_size for first, batch in batches))
+            batched = [row for first, batch in batches for row in batch.rows()]
+            self.assertEqual(batched, rows)
+
+    def test_columns(self):
+        """Each column has an entry per row, with integer columns as arrays"""
+
+        rows, batches = self.read_sample(10000)
+        batch = batches[0][1]
+        self.assertEqual(sum(batch.clicks), 167)
+        for name in AdBatch.COLUMNS:
+            self.assertEqual(len(getattr(batch, name)), len(rows))
+        self.assertEqual(batch.impressions.typecode, 'l')
+
+    @unittest.skipIf(admetrics.numpy is None, "NumPy is not available")
+    def test_as_numpy(self):
+        """The NumPy view has the same values as the arrays"""
+
+        rows, batches = self.read_sample(10000)
+        batch = batches[0][1]
+        columns = batch.as_numpy()
+        self.assertEqual(columns['total_cost_in_cents'].tolist(),
+            list(batch.total_cost_in_cents))
+        self.assertEqual(columns['ad_names'].tolist(), batch.ad_names)
+
+    def test_flushed_before_error(self):
+        """Rows read before a fatal error are still passed on"""
+
+        batches = []
+        def batch_producer(batch, first, args):
+            batches.append(batch)
+        data = StringIO(u"Report Date: 01/01/2011\n"
+            u"Ad Group,Ad Name,Impressions,Clicks,CTR,Total Cost\n"
+            u"A,one,10,1,0.1,$1.00\n"
+            u"A,,10,1,0.1,$1.00\n")
+        data.name = "<test>"
+        reader = AdDataReader(data, None, True, produce_batch=batch_producer)
+        logging.disable(logging.CRITICAL)
+        try:
+            self.assertRaises(SystemExit, reader.process_input)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual([batch.ad_names for batch in batches], [[u'one']])
+
+class TestGenerators(unittest.TestCase):
+    """Tests for reading rows and batches as generators"""
+
+    def sample_reader(self, **options):
+        """Return a reader for the sample input file, with no producer"""
+
+        sample = codecs.getreader("utf-8")(open("sample_input.csv", "r"))
+        return AdDataReader(sample, None, True, **options)
+
+    def test_rows(self):
+        """rows() yields what produce would be given, in order"""
+
+        produced = []
+        def producer(ad_info, first, args):
+            produced.append((first, ad_info.ad_name, ad_info.total_cost_in_cents))
+        sample = codecs.getreader("utf-8")(open("sample_input.csv", "r"))
+        AdDataReader(sample, producer, True).process_input()
+        for options in ({}, {'validation': 'columnar', 'validation_batch': 2}):
+            reader = self.sample_reader(**options)
+            rows = [(row.ad_name, row.total_cost_in_cents) for row in reader.rows()]
+            self.assertEqual(rows, [info[1:] for info in produced])
+            self.assertEqual(reader.produced, len(produced))
+        self.assertTrue(produced[0][0])
+
+    def test_lazy(self):
+        """Rows are only read as they are asked for"""
+
+        reader = self.sample_reader()
+        rows = reader.rows()
+        self.assertEqual(reader.date, None)
+        clicks = sum(row.clicks for row in itertools.islice(rows, 2))
+        self.assertEqual(reader.produced, 1)
+        self.assertTrue(clicks > 0)
+
+    def test_batches(self):
+        """batches() yields the rows in AdBatch objects of the size asked for"""
+
+        names = [row.ad_name for row in self.sample_reader().rows()]
+        for size in (1, 3, 10000):
+            batches = list(self.sample_reader().batches(size))
+            self.assertTrue(all(len(batch) <= size for batch in batches))
+            self.assertTrue(all(len(batch) == size for batch in batches[:-1]))
+            self.assertEqual(sum((batch.ad_names for batch in batches), []), names)
+
+class TestQuarantine(unittest.TestCase):
+    """Tests for quarantine mode and warning limits"""
+
+    REPORT = (u"Report Date: 01/01/2011\n"
+        u"Ad Group,Ad Name,Impressions,Clicks,CTR,Total Cost\n"
+        u"A,one,10,1,0.1,$1.00\n"
+        u"A,,10,1,0.1,$1.00\n"
+        u"A,two,10,1,0.5,$1.00\n"
+        u"A,three,ten,1,0.1,$1.00\n"
+        u"A,four,10,1,0.1,$-1.00\n"
+        u"A,five,10,1,0.5,$1.00\n"
+        u"A,six,10,1,0.5,$1.00\n")
+
+    def read(self, **options):
+        """Read REPORT, returning (ad names, rejected lines, log messages)"""
+
+        names = []
+        def producer(ad_info, first, args):
+            names.append(ad_info.ad_name)
+        rejected = StringIO()
+        data = StringIO(self.REPORT)
+        data.name = "<test>"
+        handler = CapturingHandler()
+        logging.getLogger().addHandler(handler)
+        try:
+            AdDataReader(data, producer, True, quarantine=Quarantine(rejected),
+                **options).process_input()
+        finally:
+            logging.getLogger().removeHandler(handler)
+        return (names, rejected.getvalue().splitlines(),
+            [message for level, message in handler.messages])
+
+    def test_rejected_rows(self):
+        """Bad rows are written out with reasons, and the rest are produced"""
+
+        for options in ({}, {'validation': 'columnar', 'validation_batch': 3}):
+            names, rejected, messages = self.read(**options)
+            self.assertEqual(names, [u"one", u"two", u"five", u"six"])
+            self.assertEqual(rejected[0], "source,line,reason,data")
+            self.assertEqual(rejected[1],
+                '"<test>",4,"Empty ad name not allowed","A,,10,1,0.1,$1.00"')
+            self.assertTrue(rejected[2].startswith('"<test>",6,'))
+            self.assertTrue("negative cost" in rejected[3])
+            self.assertEqual(len(rejected), 4)
+            self.assertTrue("3 rows quarantined" in messages[-1])
+
+    def test_warning_limit(self):
+        """Only so many warnings of each kind are logged, and the rest counted"""
+
+        names, rejected, messages = self.read(warning_limit=1)
+        self.assertEqual(len(messages), 3)
+        self.assertTrue("Given CTR" in messages[0])
+        self.assertTrue("2 more 'CTR mismatch' warnings not shown" in messages[1])
+
+class TestSummaryTotals(unittest.TestCase):
+    """Tests for checking summary lines against the totals of the rows"""
+
+    def check(self, total):
+        """Read 1000 rows of 10 cents and the given total, returning the log"""
+
+        lines = [u"Report Date: 01/01/2011",
+            u"Ad Group,Ad Name,Impressions,Clicks,CTR,Total Cost"]
+        for i in range(1000):
+            lines.append(u"A,ad %d,10,1,0.1,$0.10" % i)
+        lines.append(u"Total,,10000,1000,0.1,%s" % total)
+        data = StringIO(u"\n".join(lines) + u"\n")
+        data.name = "<test>"
+        def producer(ad_info, first, args):
+            pass
+        handler = CapturingHandler()
+        logging.getLogger().addHandler(handler)
+        try:
+            AdDataReader(data, producer, True).process_input()
+        finally:
+            logging.getLogger().removeHandler(handler)
+        return [message for level, message in handler.messages]
+
+    def test_exact_cost(self):
+        """Costs are totalled exactly, in cents"""
+
+        self.assertEqual(self.check(u"$100.00"), [])
+        messages = self.check(u"$100.01")
+        self.assertEqual(len(messages), 1)
+        self.assertTrue("Total cost in summary (100.01) != our tally (100.00)"
+            in messages[0])
+
+class TestDiagnostics(unittest.TestCase):
+    """Tests for counting, limiting and sampling warnings"""
+
+    def test_limit_and_sample(self):
+        """The first few of each category are wanted, then a sample"""
+
+        diagnostics = Diagnostics(limit=2, sample=3)
+        wanted = [diagnostics.wanted(logging.WARNING, "a") for i in range(10)]
+        self.assertEqual(wanted, [True, True, True, False, False, True, False,
+            False, True, False])
+        self.assertTrue(diagnostics.wanted(logging.WARNING, "b"))
+        self.assertEqual(diagnostics.summary(), [("a", 10, 5)])
+
+    def test_level(self):
+        """Nothing is wanted below the logger's level, but all are counted"""
+
+        logger = logging.getLogger("test_admetrics.diagnostics")
+        logger.setLevel(logging.ERROR)
+        diagnostics = Diagnostics(logger=logger)
+        self.assertFalse(diagnostics.wanted(logging.WARNING, "a"))
+        self.assertTrue(diagnostics.wanted(logging.ERROR, "b"))
+        self.assertEqual(diagnostics.summary(), [("a", 1, 0)])
+
+    def test_lazy_formatting(self):
+        """Warnings that will not be logged are never formatted"""
+
+        formatted = []
+        class CountingReader(AdDataReader):
+            def get_reader_state(self):
+                formatted.append(self.lineno)
+                return AdDataReader.get_reader_state(self)
+        data = StringIO(TestQuarantine.REPORT.replace(u"A,,", u"A,x,").replace(
+            u"ten", u"10").replace(u"$-1", u"$1"))
+        data.name = "<test>"
+        logging.disable(logging.WARNING)
+        try:
+            CountingReader(data, lambda *args, **kwargs: None, False).process_input()
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(formatted, [])
+
+    def test_plain_warner(self):
+        """AdInfo still calls a plain warning callback with the message"""
+
+        messages = []
+        AdInfo(messages.append, ('date', 'ad group', 'ad name', 'impressions',
+            'clicks', 'ctr', 'total cost'),
+            (u'2011-01-01', u'A', u'B', u'10', u'1', u'0.5', u'$1.00'))
+        self.assertEqual(len(messages), 1)
+        self.assertTrue(messages[0].startswith("Given CTR (0.500000)"))
+
 class TestCSVReader(unittest.TestCase):
     """Tests for the CSVReader class"""
 
@@ -207,6 +575,389 @@ class TestCSVReader(unittest.TestCase):
         values = reader.parse_line()
         self.assertEqual(values[0], "1")
 
+class TestBlockReading(unittest.TestCase):
+    """Block-buffered reading must match line-at-a-time reading"""
+
+    SAMPLE_TEXT = u"Report Date: 01/01/2011\r\n\n a,b \r\n\r\n\"x\",y\nlast,line"
+
+    def read_all(self, reader):
+        """Return every (lineno, line) pair the reader produces"""
+
+        lines = []
+        while True:
+            line = reader.readline()
+            if len(line) == 0:
+                return lines
+            lines.append((reader.lineno, reader.lastline))
+
+    def test_block_sizes(self):
+        """Every block size sees the same lines and line numbers"""
+
+        expected = self.read_all(CSVReader(StringIO(self.SAMPLE_TEXT)))
+        self.assertEqual(len(expected), 6)
+        for block_size in range(1, len(self.SAMPLE_TEXT) + 2):
+            reader = CSVReader(StringIO(self.SAMPLE_TEXT), block_size=block_size)
+            self.assertEqual(self.read_all(reader), expected)
+            # Reading past the end stays at the end
+            self.assertEqual(reader.readline(), u"")
+            self.assertEqual(reader.lineno, 6)
+
+    def test_reader_state(self):
+        """Diagnostics report the right line in block mode"""
+
+        source = StringIO("a,b\nc,d\n")
+        source.name = "test.csv"
+        reader = CSVReader(source, block_size=3)
+        reader.parse_line()
+        values = reader.parse_line()
+        self.assertEqual(values, ["c", "d"])
+        self.assertEqual(reader.get_reader_state(), "test.csv:2: c,d")
+
+    def test_sample_with_blocks(self):
+        """The sample data totals come out the same in block mode"""
+
+        clicks = []
+        reader = AdDataReader(
+            codecs.getreader("utf-8")(open("sample_input.csv", "r")),
+            lambda ad_info, first, args: clicks.append(ad_info.clicks),
+            True,
+            block_size=16)
+        reader.process_input()
+        self.assertEqual(sum(clicks), 167)
+
+class TestMultilineQuotes(unittest.TestCase):
+    """Quoted values spanning lines"""
+
+    def test_multiline_value(self):
+        """A newline inside quotes continues the value when enabled"""
+
+        text = 'a,"first\n\nsecond",b\nc,d\n'
+        reader = CSVReader(StringIO(text), multiline=True)
+        self.assertEqual(reader.parse_line(), ["a", "first\n\nsecond", "b"])
+        self.assertEqual(reader.lineno, 3)
+        self.assertEqual(reader.parse_line(), ["c", "d"])
+        self.assertEqual(reader.lineno, 4)
+
+    def test_multiline_disabled(self):
+        """Without multiline, an unterminated quote ends with its line"""
+
+        reader = CSVReader(StringIO('a,"first\nsecond",b\n'))
+        self.assertEqual(reader.parse_line(), ["a", "first"])
+
+    def test_unterminated_at_end(self):
+        """An unterminated quote at end of input runs to the end"""
+
+        reader = CSVReader(StringIO('a,"first\nsecond'), multiline=True)
+        self.assertEqual(reader.parse_line(), ["a", "first\nsecond"])
+        self.assertIsNone(reader.parse_line())
+
+    def test_records_split_whole(self):
+        """Records over many lines split as if they were read all at once"""
+
+        rng = random.Random(99)
+        alphabet = ['a', ' ', ',', '"', '"', '\n']
+        for i in range(3000):
+            text = "".join(rng.choice(alphabet) for j in range(rng.randint(1, 30)))
+            for engine in sorted(admetrics.CSV_ENGINES):
+                split = admetrics.CSV_ENGINES[engine][0]
+                reader = CSVReader(StringIO(text), engine=engine, multiline=True)
+                while True:
+                    try:
+                        values = reader.parse_line()
+                    except CSVError:
+                        break
+                    if values is None:
+                        break
+                    self.assertEqual(values, split(reader.lastline.strip()),
+                        "Mismatch for %r" % text)
+
+class TestMappedSource(unittest.TestCase):
+    """Tests for memory-mapped input"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_file(self, data):
+        """Write raw bytes to a scratch file and return its path"""
+
+        path = os.path.join(self.tmpdir, "input.csv")
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_lines_and_offsets(self):
+        """Lines come back decoded, with the BOM skipped and offsets kept"""
+
+        path = self.write_file(codecs.BOM_UTF8 + "a,b\n\xc3\xa9,c\nlast")
+        source = MappedSource(path)
+        self.assertEqual(source.readline(), u"a,b\n")
+        self.assertEqual(source.line_offset, 3)
+        self.assertEqual(source.readline(), u"\xe9,c\n")
+        self.assertEqual(source.line_offset, 7)
+        self.assertEqual(source.readline(), u"last")
+        self.assertEqual(source.readline(), u"")
+        source.close()
+
+    def test_empty_file(self):
+        """An empty file is simply at end of input"""
+
+        source = MappedSource(self.write_file(""))
+        self.assertEqual(source.readline(), u"")
+        source.close()
+
+    def test_incompatible_encoding(self):
+        """Encodings that change the meaning of bytes are refused"""
+
+        with self.assertRaises(ValueError):
+            MappedSource(self.write_file(""), "utf-16")
+
+    def test_reader_state_has_offset(self):
+        """Diagnostics give the byte offset of the row, even across lines"""
+
+        path = self.write_file('x,y\n"multi\nline",z\n')
+        reader = CSVReader(MappedSource(path), multiline=True)
+        reader.parse_line()
+        self.assertEqual(reader.parse_line(), ["multi\nline", "z"])
+        self.assertEqual(reader.row_offset, 4)
+        self.assertTrue(reader.get_reader_state().startswith(path + ":3 (byte 4): "))
+
+    def test_sample_mapped(self):
+        """The sample data reads the same through a map"""
+
+        dates = []
+        reader = AdDataReader(
+            MappedSource("sample_input.csv"),
+            lambda ad_info, first, args: dates.append(ad_info.date),
+            True)
+        reader.process_input()
+        self.assertEqual(dates, [u'2011-01-01'] * 3)
+
+class TestTokenizerParity(unittest.TestCase):
+    """The fast tokenizer must agree with the reference state machine"""
+
+    TRICKY_LINES = (
+        'a,b,c',
+        ',,',
+        'a,',
+        ',a',
+        ' a , b ,c ',
+        '"a","b","c"',
+        '"a,b",c',
+        '"a ""b"" c",d',
+        '""',
+        '"""",x',
+        ' "a" , "b" ',
+        '"a" "b"',
+        '"a"  ""b""',
+        'a"b,c',
+        'a "b",c',
+        '  "b",c',
+        '"unterminated, quote',
+        '"a"x,b',
+        '"a" ,x"',
+        'x,"a"\t,y',
+        u'caf\xe9,"\xe9t\xe9"',
+        u'\ufeffReport Date: 01/01/2011',
+    )
+
+    def split_both(self, line):
+        """Run both tokenizers over a line, capturing results or errors"""
+
+        results = []
+        for split in (split_fields_reference, split_fields_fast):
+            try:
+                results.append(split(line))
+            except CSVError as e:
+                results.append(('error', e.value))
+        return results
+
+    def test_tricky_lines(self):
+        """Hand-picked corner cases of our CSV dialect"""
+
+        for line in self.TRICKY_LINES:
+            reference, fast = self.split_both(line.strip())
+            self.assertEqual(reference, fast, "Mismatch for %r" % line)
+
+    def test_error_message(self):
+        """Both engines report the same error for junk after a quote"""
+
+        reference, fast = self.split_both('"a"x,b')
+        self.assertEqual(reference, ('error', "Unexpected character 'x' after end-quote"))
+        self.assertEqual(reference, fast)
+
+    def test_random_lines(self):
+        """Fuzz both engines with lines built from CSV-significant characters"""
+
+        rng = random.Random(1234)
+        alphabet = ['a', 'b', ' ', '\t', ',', '"', '"', u'\xe9']
+        for i in range(20000):
+            line = u"".join(
+                rng.choice(alphabet) for j in range(rng.randint(1, 12))).strip()
+            if len(line) == 0:
+                continue
+            reference, fast = self.split_both(line)
+            self.assertEqual(reference, fast, "Mismatch for %r" % line)
+
+    def test_quote_is_open(self):
+        """Open-quote detection agrees with the reference state machine"""
+
+        rng = random.Random(4321)
+        alphabet = ['a', ' ', ',', '"', '"']
+        for i in range(20000):
+            line = "".join(rng.choice(alphabet) for j in range(rng.randint(1, 10))).strip()
+            if len(line) == 0:
+                continue
+            try:
+                split_fields_reference(line)
+            except CSVError:
+                continue
+            # Only a line left in the "quote" state turns '"Q' into an error
+            try:
+                split_fields_reference(line + '"Q')
+                expected = False
+            except CSVError:
+                expected = True
+            self.assertEqual(quote_is_open(line), expected, "Mismatch for %r" % line)
+
+    def test_open_records(self):
+        """Both engines agree on which lines leave a quoted value open"""
+
+        rng = random.Random(5678)
+        alphabet = ['a', ' ', ',', '"', '"']
+        for i in range(20000):
+            line = "".join(rng.choice(alphabet) for j in range(rng.randint(1, 10))).strip()
+            if len(line) == 0:
+                continue
+            try:
+                expected = split_record_reference(line)
+            except CSVError:
+                continue
+            self.assertEqual(split_record_fast(line), expected, "Mismatch for %r" % line)
+            if expected[1]:
+                # Lines that go on with an open value are checked alone
+                for more in ("a", 'a"', 'a",b', 'a","b', '""a'):
+                    self.assertEqual(quote_is_open(more, True),
+                        quote_is_open(line + "\n" + more), (line, more))
+
+    def test_engines_read_sample_identically(self):
+        """Both engines produce the same rows from the sample input"""
+
+        rows = {}
+        for engine in ('reference', 'fast'):
+            reader = CSVReader(codecs.getreader("utf-8")(open("sample_input.csv", "r")),
+                engine=engine)
+            rows[engine] = []
+            while True:
+                values = reader.parse_line()
+                if values is None:
+                    break
+                rows[engine].append(values)
+        self.assertEqual(len(rows['fast']), 6)
+        self.assertEqual(rows['reference'], rows['fast'])
+
+    def test_unknown_engine(self):
+        """Asking for an engine that does not exist is an error"""
+
+        with self.assertRaises(ValueError):
+            CSVReader(StringIO("a,b\n"), engine='bogus')
+
+class TestRunContext(unittest.TestCase):
+    """Each run keeps its own state, and none in the options"""
+
+    def run_sample(self, context):
+        """Produce the sample's rows with context, returning the output rows"""
+
+        output = StringIO()
+        context.writer = OutputWriter(output, bom=False)
+        with open("sample_input.csv", "rb") as sample:
+            AdDataReader(codecs.getreader("utf-8")(sample),
+                admetrics.default_producer, True, context).process_input()
+        context.writer.flush()
+        return output.getvalue().splitlines()[1:]
+
+    def test_separate_runs(self):
+        """The same rows in two contexts are not taken for duplicates"""
+
+        args = admetrics.parse_command_line(["--no-total-warning", "--aggregate",
+            "ad_group", "sample_input.csv"])
+        saved = dict(vars(args))
+        first = admetrics.RunContext(args)
+        second = admetrics.RunContext(args)
+        rows = self.run_sample(first)
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(self.run_sample(second), rows)
+        self.assertEqual(len(first.symbols), 5)
+        self.assertEqual(sorted(first.aggregators[0].groups),
+            sorted(second.aggregators[0].groups))
+        self.assertEqual(vars(args), saved)
+
+class CountingStream(object):
+    """A stream that keeps what is written to it, one string per write"""
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def flush(self):
+        pass
+
+class TestOutputWriter(unittest.TestCase):
+    """Tests for the buffered output writer"""
+
+    def test_buffering(self):
+        """Rows are written in blocks, and all of them by the final flush"""
+
+        stream = CountingStream()
+        writer = OutputWriter(stream, 'utf-8', False, 100)
+        rows = [u"2011-01-01,group,ad %d,1,2,3" % i for i in range(100)]
+        for row in rows:
+            writer.write_row(row)
+        writer.flush()
+        self.assertTrue(1 < len(stream.writes) < 40)
+        self.assertEqual("".join(stream.writes), "".join(
+            row.encode('utf-8') + "\n" for row in rows))
+
+    def test_bom_once(self):
+        """The utf-16 and utf-32 output starts with just the one BOM"""
+
+        for encoding in ('utf-16', 'utf-32'):
+            stream = CountingStream()
+            writer = OutputWriter(stream, encoding, True)
+            writer.write_header()
+            writer.write_row(u"2011-01-01,\u00fcber,ad,1,2,3")
+            writer.flush()
+            lines = "".join(stream.writes).decode(encoding).splitlines()
+            self.assertTrue(lines[0].startswith(u"report_date,"))
+            self.assertEqual(lines[1], u"2011-01-01,\u00fcber,ad,1,2,3")
+
+    def test_flushed_on_error(self):
+        """Rows before a duplicate record are still output"""
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "dup.csv")
+            with open(path, "wb") as f:
+                f.write("Report Date: 01/01/2011\n"
+                    "Ad Group,Ad Name,Impressions,Clicks,CTR,Total Cost\n"
+                    "A,one,10,1,0.1,$1.00\n"
+                    "A,One,10,1,0.1,$1.00\n")
+            for dedup in ("exact", "bloom"):
+                p = subprocess.Popen(["./admetrics.py", "--no-output-bom",
+                    "--dedup", dedup, path],
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                data_out, data_err = p.communicate()
+                self.assertEqual(p.returncode, 1)
+                self.assertEqual(data_out.splitlines()[1:],
+                    ["2011-01-01,a,one,10,1,100"])
+                self.assertTrue("Duplicate record" in data_err)
+        finally:
+            shutil.rmtree(tmpdir)
+
 class TestCommandLine(unittest.TestCase):
     """Test the command-line handling of the sample main() in admetrics"""
 
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+
+# Testing functions for the adnumbers module.
+
+import re
+import random
+import unittest
+
+import admetrics
+from adnumbers import parse_int, parse_float, parse_ctr, parse_cents
+from adnumbers import format_cents, exchange_rate, register_currency
+
+# The number parsers admetrics used before adnumbers, as they were: the
+# new parsers are checked against them here, and bench_admetrics times
+# the new parsers against them
+
+CURRENCY_VALUE_RE = re.compile("-?\d+(\.\d\d)$")
+
+def string_to_integer(s):
+    """Convert a string to an integer, with error checking"""
+    s = str(s).strip()
+    if len(s) == 0:
+        raise ValueError("Empty string as number")
+    try:
+        i = int(s)
+    except ValueError:
+        i = int(float(s))
+    return i
+
+def string_to_float(s):
+    """Convert a string to a floating point value, with error checking"""
+    s = str(s).strip()
+    if len(s) == 0:
+        raise ValueError("Empty string as number")
+    f = float(s)
+    return f
+
+def money_string_to_float(s):
+    """Convert a dollar value into a float"""
+    s = str(s).strip()
+    if len(s) == 0:
+        raise ValueError("Empty string a money value")
+    currency = s[0]
+    if currency.isdigit():
+        # AdWords seems to assume the currency of the account, and not
+        # output it. Ick. We'll default to USD.
+        currency = '$'
+        s = '$' + s
+    elif currency != "$":
+        raise ValueError("TBD: No currency conversions available, yet")
+    if len(s) == 1:
+        raise ValueError("$ must be followed by numeric amount")
+    value = s[1:]
+    if re.match(CURRENCY_VALUE_RE, value):
+        return string_to_float(value)
+    else:
+        raise ValueError("Currency value must be $d or $d.cc")
+
+class TestNumberParsing(unittest.TestCase):
+    """The fast parsers must agree with the helpers they replaced"""
+
+    VALUES = [u"0", u"12", u" 12 ", u"-3", u"+4", u"12.7", u"1e3", u"", u"  ",
+        u"ten", u"1,000", u"0.5", u"-0.25", u".5", u"nan", u"inf", u"1e999",
+        u"$0.00", u"$1.50", u"$-1.50", u"$-0.50", u"1.50", u"-1.50", u"$",
+        u"$1", u"$1.5", u"$1.500", u"$ 1.50", u"$1.5a",
+        u"$1,000.00", u"$.50", u"$-.50", u"$--1.50", u"$12345678901234.99",
+        u"$1.50\n", u" $2.00 ", u"1.5%"]
+
+    def outcome(self, function, value):
+        """Return ('value', result) or ('error', message) for a call"""
+
+        try:
+            # By repr, so that NaN matches NaN
+            return ('value', repr(function(value)))
+        except UnicodeError:
+            return ('error', 'unicode')
+        except (ValueError, OverflowError) as e:
+            return ('error', str(e))
+
+    def assert_parity(self, values):
+        """Check each parser against its helper for all of values"""
+
+        for value in values:
+            self.assertEqual(self.outcome(parse_int, value),
+                self.outcome(string_to_integer, value), value)
+            self.assertEqual(self.outcome(parse_float, value),
+                self.outcome(string_to_float, value), value)
+            expected = self.outcome(money_string_to_float, value)
+            if expected[0] == 'value':
+                expected = ('value', repr(int(round(float(expected[1]) * 100))))
+            self.assertEqual(self.outcome(parse_cents, value), expected, value)
+
+    def test_values(self):
+        """Awkward values parse, or fail, the same way"""
+
+        self.assert_parity(self.VALUES)
+
+    def test_old_names(self):
+        """The admetrics helpers of the old names still parse the same way"""
+
+        for value in self.VALUES:
+            self.assertEqual(self.outcome(admetrics.string_to_integer, value),
+                self.outcome(string_to_integer, value), value)
+            self.assertEqual(self.outcome(admetrics.string_to_float, value),
+                self.outcome(string_to_float, value), value)
+            self.assertEqual(
+                self.outcome(admetrics.money_string_to_float, value),
+                self.outcome(money_string_to_float, value), value)
+
+    def test_random(self):
+        """Random strings of likely characters parse the same way"""
+
+        rng = random.Random(1)
+        values = [u"".join(rng.choice(u"$-.0123456789 %e") for i in
+            range(rng.randint(0, 8))) for j in range(5000)]
+        self.assert_parity(values)
+
+    def test_ctr(self):
+        """CTRs may be ratios or percentages"""
+
+        self.assertEqual(parse_ctr(u"0.25"), 0.25)
+        self.assertEqual(parse_ctr(u"25%"), 0.25)
+        self.assertRaises(ValueError, parse_ctr, u"%")
+
+    def test_big_cents(self):
+        """Costs too big for a float to hold exactly still parse exactly"""
+
+        self.assertEqual(parse_cents(u"$90071992547409.93"), 9007199254740993)
+
+class TestCurrencies(unittest.TestCase):
+    """Tests for costs in other currencies"""
+
+    def tearDown(self):
+        register_currency(u"\u20ac", None)
+
+    def test_unregistered(self):
+        """Costs in unknown currencies are refused"""
+
+        for value in (u"\u20ac1.50", u"\u0661.00", u"R1.50"):
+            self.assertRaises(ValueError, parse_cents, value)
+
+    def test_registered(self):
+        """Costs in registered currencies are converted to US cents"""
+
+        register_currency(u"\u20ac", exchange_rate("1.0825"))
+        self.assertEqual(parse_cents(u"\u20ac10.00"), 1083)
+        self.assertEqual(parse_cents(u" \u20ac-0.02 "), -2)
+        self.assertEqual(parse_cents(u"$10.00"), 1000)
+        self.assertRaises(ValueError, parse_cents, u"\u20ac10")
+        self.assertRaises(ValueError, parse_cents, u"\u20ac")
+
+    def test_exchange_rate(self):
+        """Conversions round to the nearest cent, halves away from zero"""
+
+        convert = exchange_rate("0.5")
+        self.assertEqual([convert(c) for c in (1, 2, 3, -1, -3)], [1, 1, 2, -1, -2])
+        self.assertEqual(exchange_rate("2")(12345), 24690)
+        self.assertRaises(ValueError, exchange_rate, "-1.5")
+        self.assertRaises(ValueError, register_currency, u"$", convert)
+
+    def test_format_cents(self):
+        """Cents are shown as dollars and cents"""
+
+        self.assertEqual([format_cents(c) for c in (0, 5, -5, 123456, -100)],
+            ["0.00", "0.05", "-0.05", "1234.56", "-1.00"])
+
+if __name__ == '__main__':
+    unittest.main()
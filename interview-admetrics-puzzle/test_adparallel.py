@@ -0,0 +1,308 @@
+#!/usr/bin/python
+
+# Testing functions for the adparallel module.
+
+import os
+import sys
+import shutil
+import logging
+import unittest
+import tempfile
+
+from StringIO import StringIO
+
+import admetrics
+
+from admetrics import AdDataReader, MappedSource, Quarantine
+from admetrics import parse_command_line, find_inputs
+from adparallel import find_shards, process_sharded, process_files, CapturingHandler
+from adparallel import finished_dates, shard_options
+
+class ReportTestCase(unittest.TestCase):
+    """
+    Reports written to a scratch directory, with the log captured; shared
+    with the adpipeline tests
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.handler = CapturingHandler()
+        logging.getLogger().addHandler(self.handler)
+
+    def tearDown(self):
+        logging.getLogger().removeHandler(self.handler)
+        shutil.rmtree(self.tmpdir)
+
+    def write_report(self, rows, total=True):
+        """Write a report with the given data rows and return its path"""
+
+        lines = ["Report Date: 01/01/2011", "Ad Group,Ad Name,Impressions,Clicks,CTR,Total Cost"]
+        lines.extend(rows)
+        if total:
+            lines.append("Total,,%d,%d,0.5,$1.00" % (
+                sum(i for i in range(len(rows))) + len(rows) * 10,
+                sum(i for i in range(len(rows)))))
+        path = os.path.join(self.tmpdir, "report.csv")
+        with open(path, "wb") as f:
+            f.write("\n".join(lines) + "\n")
+        return path
+
+    def plain_rows(self, count):
+        """Data rows with the odd blank line and CTR mismatch warning"""
+
+        rows = []
+        for i in range(count):
+            ctr = "0.9" if i % 17 == 0 else "%.4f" % (float(i) / (i + 10))
+            rows.append('Group %d,"Ad ""%d""",%d,%d,%s,$%d.%02d' % (
+                i % 7, i, i + 10, i, ctr, i + 1, i % 100))
+            if i % 13 == 0:
+                rows.append("")
+        return rows
+
+class TestShardedParsing(ReportTestCase):
+    """Sharded parsing must match serial parsing exactly"""
+
+    def run_reader(self, path, jobs=None, shards=None, multiline=False, **options):
+        """Process path serially or sharded, returning (rows, log, exited)"""
+
+        produced = []
+        def producer(ad_info, first, args):
+            produced.append((first, ad_info.ad_group, ad_info.ad_name,
+                ad_info.impressions, ad_info.clicks, ad_info.total_cost))
+        del self.handler.messages[:]
+        reader = AdDataReader(MappedSource(path), producer, False, multiline=multiline,
+            **options)
+        exited = False
+        try:
+            if jobs is None:
+                reader.process_input()
+            else:
+                process_sharded(reader, jobs, shards)
+        except SystemExit:
+            exited = True
+        return produced, list(self.handler.messages), exited
+
+    def assert_same(self, path, multiline=False, **options):
+        """Check that several shardings all match the serial run"""
+
+        expected = self.run_reader(path, multiline=multiline, **options)
+        self.assertTrue(len(expected[0]) > 0)
+        for shards in (1, 3, 16, 200):
+            self.assertEqual(
+                self.run_reader(path, 2, shards, multiline=multiline, **options),
+                expected)
+        return expected
+
+    def test_plain_report(self):
+        """Rows, warnings and summary checks replay in order"""
+
+        rows, log, exited = self.assert_same(self.write_report(self.plain_rows(500)))
+        self.assertFalse(exited)
+        self.assertEqual(len(rows), 500)
+        self.assertTrue(rows[0][0])
+        self.assertFalse(rows[1][0])
+        # CTR warnings, the summary warning and the mismatched totals
+        self.assertTrue(len(log) > 30)
+
+    def test_fatal_error(self):
+        """A bad row stops the run at the same point"""
+
+        rows = self.plain_rows(300)
+        rows[200] = "Group 1,Bad,10,1,0.1,$-1.00"
+        output, log, exited = self.assert_same(self.write_report(rows))
+        self.assertTrue(exited)
+        self.assertTrue(len(output) < 200)
+        self.assertTrue("negative cost" in log[-1][1])
+
+    def test_multiline_values(self):
+        """Quoted values spanning lines are never split between shards"""
+
+        rows = []
+        for i in range(300):
+            rows.append('Group,"Line one\n""%d""\nline three",%d,1,%.4f,$1.00' % (
+                i, i + 1, 1.0 / (i + 1)))
+        self.assert_same(self.write_report(rows, False), multiline=True)
+
+    def test_misleading_quotes(self):
+        """Literal quotes that upset the quote count fall back to serial"""
+
+        rows = []
+        for i in range(300):
+            name = 'Ad 5" screen' if i % 50 == 0 else '"Two\nlines %d"' % i
+            rows.append('Group,%s,%d,1,%.4f,$1.00' % (name, i + 1, 1.0 / (i + 1)))
+        self.assert_same(self.write_report(rows, False), multiline=True)
+
+    def test_shard_boundaries(self):
+        """Shards cover the data exactly and start on lines"""
+
+        path = self.write_report(self.plain_rows(100))
+        source = MappedSource(path)
+        reader = AdDataReader(source, None, True)
+        reader._read_header()
+        start = source.pos
+        ranges = find_shards(source, 7)
+        self.assertEqual(ranges[0][0], start)
+        self.assertEqual(ranges[-1][1], source.end)
+        for (a, b), (c, d) in zip(ranges, ranges[1:]):
+            self.assertEqual(b, c)
+            self.assertEqual(source.map[c - 1], "\n")
+
+    def test_quarantine(self):
+        """Rejected lines and capped warnings replay in order"""
+
+        rows = self.plain_rows(300)
+        for i in range(0, 300, 23):
+            rows[i] = "Group 1,,1,1,1.0,$1.00" if i % 2 else "Group 1,Bad,ten,1,0.1,$1.00"
+        path = self.write_report(rows)
+        results = []
+        for jobs, shards in ((None, None), (2, 1), (2, 7), (2, 64)):
+            rejected = StringIO()
+            result = self.run_reader(path, jobs, shards,
+                quarantine=Quarantine(rejected), warning_limit=2)
+            results.append(result + (rejected.getvalue(),))
+        for result in results[1:]:
+            self.assertEqual(result, results[0])
+        produced, log, exited, rejected = results[0]
+        self.assertFalse(exited)
+        self.assertEqual(len(rejected.splitlines()), 1 + 14)
+        self.assertTrue("more 'CTR mismatch' warnings not shown" in log[-2][1])
+        self.assertTrue("14 rows quarantined" in log[-1][1])
+
+    def test_columnar_validation(self):
+        """The workers validate in batches when the reader does"""
+
+        rows = self.plain_rows(300)
+        rows[100] = "Group 1,,1,1,1.0,$1.00"
+        rows[200] = "Group 1,Bad,10,1,0.1,$-1.00"
+        path = self.write_report(rows)
+        for batch in (7, 10000):
+            options = {'validation': 'columnar', 'validation_batch': batch}
+            output, log, exited = self.assert_same(path, **options)
+            self.assertTrue(exited)
+            self.assertEqual(output, self.run_reader(path)[0])
+            rejected = StringIO()
+            self.assertEqual(self.run_reader(path, 2, 16,
+                quarantine=Quarantine(rejected), **options)[:2],
+                self.run_reader(path, quarantine=Quarantine(StringIO()))[:2])
+            self.assertEqual(len(rejected.getvalue().splitlines()), 1 + 2)
+            reader = AdDataReader(MappedSource(path), None, True, **options)
+            given = shard_options(reader)
+            self.assertEqual(dict((name, given[name]) for name in options), options)
+
+    def test_empty_data(self):
+        """A report with only a header produces nothing"""
+
+        self.assertEqual(
+            self.run_reader(self.write_report([], False), 2), ([], [], False))
+
+class TestBatchFiles(unittest.TestCase):
+    """Processing many report files in one run"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.handler = CapturingHandler()
+        logging.getLogger().addHandler(self.handler)
+        sample = open("sample_input.csv", "rb").read()
+        self.write_file("2011-01-01.csv", sample)
+        self.write_file("2011-01-02.csv", sample.replace("01/01/2011", "01/02/2011"))
+        self.write_file("2011-01-03.csv", sample.replace("$10.22", "$-1.00"))
+        self.write_file("notes.txt", "not a report")
+
+    def tearDown(self):
+        logging.getLogger().removeHandler(self.handler)
+        shutil.rmtree(self.tmpdir)
+
+    def write_file(self, name, data):
+        """Write a file into the scratch directory"""
+
+        with open(os.path.join(self.tmpdir, name), "wb") as f:
+            f.write(data)
+
+    def run_batch(self, *argv):
+        """Run a batch from command-line arguments, returning (ok, output)"""
+
+        args = parse_command_line(list(argv))
+        paths = find_inputs(args.input, args.pattern)
+        saved_stdout = sys.stdout
+        sys.stdout = output = StringIO()
+        try:
+            ok = process_files(paths, args, args.jobs)
+        finally:
+            sys.stdout = saved_stdout
+        return ok, output.getvalue()
+
+    def test_find_inputs(self):
+        """Directories expand to their matching files, in order"""
+
+        paths = find_inputs([self.tmpdir, "sample_input.csv"], "*.csv")
+        self.assertEqual([os.path.basename(path) for path in paths],
+            ["2011-01-01.csv", "2011-01-02.csv", "2011-01-03.csv", "sample_input.csv"])
+
+    def test_batch_output(self):
+        """Good files are all output under one header, bad ones skipped"""
+
+        for jobs in ("1", "3"):
+            ok, output = self.run_batch("--no-total-warning", "--jobs", jobs, self.tmpdir)
+            self.assertFalse(ok)
+            lines = output.splitlines()
+            self.assertEqual(len(lines), 7)
+            self.assertTrue(lines[0].endswith("report_date, ad_group, ad_name, " +
+                "impressions, clicks, total_cost_in_cents"))
+            self.assertEqual(lines[1].split(",")[0], "2011-01-01")
+            self.assertEqual(lines[6].split(",")[0], "2011-01-02")
+            self.assertTrue("negative cost" in self.handler.messages[0][1])
+            self.assertTrue("Skipped" in self.handler.messages[-1][1])
+            del self.handler.messages[:]
+
+    def test_missing_file(self):
+        """An unreadable file is reported like any other failure"""
+
+        ok, output = self.run_batch(os.path.join(self.tmpdir, "missing.csv"),
+            "sample_input.csv")
+        self.assertFalse(ok)
+        self.assertEqual(output, open("sample_output.csv", "rb").read())
+
+    def test_duplicate_files(self):
+        """A file repeating records of an earlier one is turned away"""
+
+        shutil.copy(os.path.join(self.tmpdir, "2011-01-01.csv"),
+            os.path.join(self.tmpdir, "2011-01-01-again.csv"))
+        for jobs in ("1", "2"):
+            ok, output = self.run_batch("--no-total-warning", "--jobs", jobs,
+                "--pattern", "2011-01-0[12]*.csv", self.tmpdir)
+            self.assertFalse(ok)
+            self.assertEqual([line.split(",")[0] for line in output.splitlines()[1:]],
+                ["2011-01-01"] * 3 + ["2011-01-02"] * 3)
+            self.assertTrue(self.handler.messages[0][1].startswith(
+                "Duplicate record for key: 2011-01-01,"))
+            self.assertTrue("Skipped" in self.handler.messages[-1][1])
+            del self.handler.messages[:]
+
+    def test_finished_dates(self):
+        """A date is finished at its last file, but not before an unknown one"""
+
+        names = ["2011-01-01.csv", "2011-01-02.csv", "2011-01-03.csv"]
+        args = parse_command_line([])
+        paths = [os.path.join(self.tmpdir, name) for name in names]
+        self.assertEqual(finished_dates(paths, args),
+            {1: ["2011-01-02"], 2: ["2011-01-01"]})
+        paths.insert(2, os.path.join(self.tmpdir, "notes.txt"))
+        self.assertEqual(finished_dates(paths, args),
+            {2: ["2011-01-02"], 3: ["2011-01-01"]})
+
+    def test_empty_directory(self):
+        """A directory with no reports in it is an error"""
+
+        empty = os.path.join(self.tmpdir, "empty")
+        os.mkdir(empty)
+        saved_stdout = sys.stdout
+        sys.stdout = output = StringIO()
+        try:
+            self.assertRaises(SystemExit, admetrics.main, ["admetrics.py", empty])
+        finally:
+            sys.stdout = saved_stdout
+        self.assertEqual(output.getvalue(), "")
+        self.assertTrue("No input files" in self.handler.messages[0][1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+
+# Testing functions for the adpipeline module.
+
+import codecs
+import unittest
+
+from StringIO import StringIO
+
+from admetrics import AdDataReader, MappedSource, Quarantine
+from adpipeline import Pipeline, ListSource, process_pipelined
+from test_adparallel import ReportTestCase
+
+class TestPipeline(ReportTestCase):
+    """Pipelined processing must match serial processing exactly"""
+
+    def run_reader(self, path, jobs=None, chunk_lines=7, mapped=True, **options):
+        """
+        Process path serially (jobs None) or pipelined, returning (rows, log,
+        exited, rejected).
+        """
+
+        produced = []
+        def producer(ad_info, first, args):
+            produced.append((first, ad_info.ad_group, ad_info.ad_name,
+                ad_info.impressions, ad_info.clicks, ad_info.total_cost_in_cents))
+        del self.handler.messages[:]
+        if mapped:
+            source = MappedSource(path)
+        else:
+            source = codecs.getreader("utf-8")(open(path, "rb"))
+        rejected = StringIO()
+        if options.pop('quarantine', False):
+            options['quarantine'] = Quarantine(rejected)
+        reader = AdDataReader(source, producer, False, **options)
+        exited = False
+        try:
+            if jobs is None:
+                reader.process_input()
+            else:
+                process_pipelined(reader, jobs, 2, chunk_lines)
+        except SystemExit:
+            exited = True
+        return produced, list(self.handler.messages), exited, rejected.getvalue()
+
+    def assert_same(self, path, **options):
+        """Check that several pipelines all match the serial run"""
+
+        expected = self.run_reader(path, **options)
+        self.assertTrue(len(expected[0]) > 0)
+        for jobs in (1, 2):
+            for chunk_lines in (1, 7, 5000):
+                self.assertEqual(
+                    self.run_reader(path, jobs, chunk_lines, **options), expected)
+        return expected
+
+    def test_plain_report(self):
+        """Rows, warnings and summary checks come out in order"""
+
+        rows, log, exited, rejected = self.assert_same(
+            self.write_report(self.plain_rows(300)))
+        self.assertFalse(exited)
+        self.assertEqual(len(rows), 300)
+        self.assertEqual([row[0] for row in rows], [True] + [False] * 299)
+        self.assertTrue(len(log) > 20)
+
+    def test_unmapped_input(self):
+        """Input read through a codec, without line offsets, matches too"""
+
+        self.assert_same(self.write_report(self.plain_rows(100)), mapped=False)
+
+    def test_fatal_error(self):
+        """A bad row stops the run at the same point"""
+
+        rows = self.plain_rows(300)
+        rows[200] = "Group 1,Bad,10,1,0.1,$-1.00"
+        output, log, exited, rejected = self.assert_same(self.write_report(rows))
+        self.assertTrue(exited)
+        self.assertTrue(len(output) < 200)
+        self.assertTrue("negative cost" in log[-1][1])
+
+    def test_multiline_values(self):
+        """Quoted values spanning lines are never split between chunks"""
+
+        rows = []
+        for i in range(100):
+            rows.append('Group,"Line one\n""%d""\nline three",%d,1,%.4f,$1.00' % (
+                i, i + 1, 1.0 / (i + 1)))
+        self.assert_same(self.write_report(rows, False), multiline=True)
+
+    def test_quarantine(self):
+        """Rejected lines and capped warnings come out in order"""
+
+        rows = self.plain_rows(200)
+        for i in range(0, 200, 23):
+            rows[i] = "Group 1,,1,1,1.0,$1.00" if i % 2 else "Group 1,Bad,ten,1,0.1,$1.00"
+        output, log, exited, rejected = self.assert_same(self.write_report(rows),
+            quarantine=True, warning_limit=2)
+        self.assertFalse(exited)
+        self.assertEqual(len(rejected.splitlines()), 1 + 9)
+
+    def test_columnar_validation(self):
+        """Chunks are validated in batches when the reader does that"""
+
+        rows = self.plain_rows(200)
+        rows[50] = "Group 1,,1,1,1.0,$1.00"
+        rows[150] = "Group 1,Bad,10,1,0.1,$-1.00"
+        path = self.write_report(rows)
+        expected = self.run_reader(path, quarantine=True)
+        self.assertEqual(self.assert_same(path, quarantine=True,
+            validation='columnar', validation_batch=7), expected)
+
+    def test_stats(self):
+        """Each stage is timed, and one of them is named the bottleneck"""
+
+        reader = AdDataReader(MappedSource(self.write_report(self.plain_rows(50))),
+            lambda ad_info, first, args: None, True)
+        pipeline = Pipeline(reader, 1, 2, 10)
+        stats = pipeline.run()
+        self.assertTrue(stats is pipeline.stats)
+        self.assertEqual([stage.items for stage in stats.stages], [6, 6, 6])
+        self.assertTrue(stats.bottleneck() in ("read", "parse", "write"))
+        self.assertEqual(len(stats.report().splitlines()), 4)
+
+    def test_list_source(self):
+        """A ListSource hands out its lines, and their offsets if given"""
+
+        source = ListSource("<test>", [u"a\n", u"b\n"], [0, 2])
+        self.assertEqual(source.readline(), u"a\n")
+        self.assertEqual(source.line_offset, 0)
+        self.assertEqual(source.readline(), u"b\n")
+        self.assertEqual(source.line_offset, 2)
+        self.assertEqual(source.readline(), u"")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+#!/usr/bin/python
+
+# Testing functions for the adsqlite module.
+
+import os
+import codecs
+import shutil
+import logging
+import sqlite3
+import unittest
+import tempfile
+import subprocess
+
+from admetrics import AdDataReader, parse_command_line
+from adsqlite import SQLiteLoader, load_files
+
+class TestSQLiteLoader(unittest.TestCase):
+    """Loading into SQLite must give the same rows as the CSV output"""
+
+    SAMPLE_IN = "sample_input.csv"
+    SAMPLE_OUT = "sample_output.csv"
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = os.path.join(self.tmpdir, "ads.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def table(self):
+        """Return the rows in the database, as lists of strings in key order"""
+
+        connection = sqlite3.connect(self.db)
+        try:
+            return [[unicode(value) for value in row] for row in connection.execute(
+                "SELECT * FROM ad_report_data ORDER BY report_date, ad_group, ad_name")]
+        finally:
+            connection.close()
+
+    def sample_rows(self):
+        """Return the sample output rows, as lists of strings in key order"""
+
+        lines = codecs.open(self.SAMPLE_OUT, "r", "utf-8-sig").read().splitlines()
+        return sorted(line.split(",") for line in lines[1:])
+
+    def load_sample(self, batch_size=10000):
+        """Load the sample input with a loader, committing at the end"""
+
+        loader = SQLiteLoader(self.db)
+        with open(self.SAMPLE_IN, "r") as sample:
+            AdDataReader(codecs.getreader("utf-8")(sample), None, True,
+                produce_batch=loader.load, batch_size=batch_size).process_input()
+        loader.close()
+        return loader
+
+    def test_sample(self):
+        """The sample input loads as the sample output"""
+
+        for batch_size in (1, 2, 10000):
+            loader = self.load_sample(batch_size)
+            self.assertEqual(loader.rows, 3)
+            self.assertEqual(self.table(), self.sample_rows())
+
+    def test_wal(self):
+        """The database is left in WAL mode"""
+
+        self.load_sample()
+        connection = sqlite3.connect(self.db)
+        self.assertEqual(connection.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        connection.close()
+
+    def test_upsert(self):
+        """Loading a corrected report replaces the rows already there"""
+
+        self.load_sample()
+        path = os.path.join(self.tmpdir, "fixed.csv")
+        with open(path, "wb") as f:
+            f.write("Report Date: 01/01/2011\n"
+                "Ad Group,Ad Name,Impressions,Clicks,CTR,Total Cost\n"
+                "Honda,Cheap Used Hondas,400,40,0.1,$20.00\n")
+        self.assertTrue(load_files([path], parse_command_line(["--sqlite", self.db])))
+        expected = self.sample_rows()
+        expected[0] = [u"2011-01-01", u"honda", u"cheap used hondas", u"400", u"40", u"2000"]
+        self.assertEqual(self.table(), expected)
+
+    def test_failed_file_rolled_back(self):
+        """A file with a fatal error loads nothing, and the rest still load"""
+
+        path = os.path.join(self.tmpdir, "bad.csv")
+        with open(path, "wb") as f:
+            f.write("Report Date: 01/02/2011\n"
+                "Ad Group,Ad Name,Impressions,Clicks,CTR,Total Cost\n"
+                "Honda,Good,400,40,0.1,$20.00\n"
+                "Honda,,400,40,0.1,$20.00\n")
+        args = parse_command_line(["--sqlite", self.db, "--sqlite-batch", "1",
+            "--no-total-warning"])
+        logging.disable(logging.CRITICAL)
+        try:
+            self.assertFalse(load_files([path, self.SAMPLE_IN], args))
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(self.table(), self.sample_rows())
+
+    def test_duplicates(self):
+        """Repeated records fail a file, as they fail the CSV output"""
+
+        path = os.path.join(self.tmpdir, "repeated.csv")
+        with open(path, "wb") as f:
+            f.write("Report Date: 01/02/2011\n"
+                "Ad Group,Ad Name,Impressions,Clicks,CTR,Total Cost\n"
+                "Honda,Good,400,40,0.1,$20.00\n"
+                "HONDA,good,400,40,0.1,$20.00\n")
+        messages = []
+        for batch_size in ("1", "10000"):
+            p = subprocess.Popen(["./admetrics.py", "--no-total-warning", "--sqlite",
+                self.db, "--sqlite-batch", batch_size, path, self.SAMPLE_IN,
+                self.SAMPLE_IN], stderr=subprocess.PIPE)
+            messages = p.stderr.read().splitlines()
+            self.assertEqual(p.wait(), 1)
+            self.assertEqual(self.table(), self.sample_rows())
+        self.assertEqual(messages[:2], [
+            "ERROR:root:Duplicate record for key: 2011-01-02,honda,good",
+            "ERROR:root:Skipped %s: nothing loaded from it" % path])
+        self.assertEqual(messages[2:], [
+            "ERROR:root:Duplicate record for key: " +
+                "2011-01-01,honda,great deals on new hondas",
+            "ERROR:root:Skipped %s: nothing loaded from it" % self.SAMPLE_IN])
+
+    def test_resumed_duplicates(self):
+        """A resumed load still knows the keys loaded before its checkpoint"""
+
+        path = os.path.join(self.tmpdir, "resumed.csv")
+        rows = ["Honda,Ad %d,400,40,0.1,$20.00" % i for i in range(8)]
+        def write(rows):
+            with open(path, "wb") as f:
+                f.write("Report Date: 01/02/2011\n"
+                    "Ad Group,Ad Name,Impressions,Clicks,CTR,Total Cost\n" +
+                    "\n".join(rows) + "\n")
+        args = parse_command_line(["--sqlite", self.db, "--sqlite-batch", "1",
+            "--checkpoint", os.path.join(self.tmpdir, "checkpoint"),
+            "--checkpoint-every", "2", "--no-total-warning", path])
+        logging.disable(logging.CRITICAL)
+        try:
+            write(rows[:5] + ["Honda,,400,40,0.1,$20.00"] + rows[6:])
+            self.assertFalse(load_files([path], args))
+            self.assertEqual(len(self.table()), 4)
+            # The row that stopped the first run now repeats one loaded by it
+            write(rows[:5] + ["HONDA,ad 0,400,40,0.1,$20.00"] + rows[6:])
+            self.assertFalse(load_files([path], args))
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual([row[2] for row in self.table()],
+            [u"ad %d" % i for i in range(4)])
+
+    def test_command_line(self):
+        """Load the sample data from the command-line"""
+
+        p = subprocess.Popen(
+            ["./admetrics.py", "--no-total-warning", "--sqlite", self.db, self.SAMPLE_IN],
+            stdout=subprocess.PIPE)
+        self.assertEqual(p.stdout.read(), "")
+        self.assertEqual(p.wait(), 0)
+        self.assertEqual(self.table(), self.sample_rows())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+#!/usr/bin/python
+
+# Testing functions for the adstream module.
+
+import os
+import socket
+import logging
+import unittest
+import threading
+
+from StringIO import StringIO
+
+from admetrics import AdDataReader
+from adstream import StreamSource, StreamIngest, OutputStage, IngestLoop
+
+def report(prefix, count, bad=None):
+    """Return the bytes of a report with count rows, the bad'th one broken"""
+
+    lines = [u"Report Date: 01/01/2011",
+        u"Ad Group,Ad Name,Impressions,Clicks,CTR,Total Cost"]
+    for i in range(count):
+        name = u'"%s \u00e9 ""%d""\nsecond line"' % (prefix, i)
+        lines.append(u"Group %d,%s,%d,%d,%.4f,$%d.%02d" % (
+            i % 3, name, i + 10, i, float(i) / (i + 10), i + 1, i % 100))
+    if bad is not None:
+        lines[bad + 2] = u"Group,,1,1,1.0,$1.00"
+    return (u"\r\n".join(lines) + u"\r\n").encode("utf-8")
+
+def send(write, data, size=7):
+    """Write data a few bytes at a time"""
+
+    for i in range(0, len(data), size):
+        write(data[i:i + size])
+
+class TestStreams(unittest.TestCase):
+    """Stream ingestion must give the rows that reading a file would"""
+
+    def setUp(self):
+        self.rows = []
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def producer(self, ad_info, first, args):
+        self.rows.append((first, ad_info.ad_name, ad_info.total_cost_in_cents))
+
+    def expected(self, data):
+        """The ad names and costs that reading data as a file gives"""
+
+        rows = []
+        def producer(ad_info, first, args):
+            rows.append((ad_info.ad_name, ad_info.total_cost_in_cents))
+        source = StringIO(data.decode("utf-8"))
+        source.name = "<test>"
+        AdDataReader(source, producer, True, multiline=True).process_input()
+        return rows
+
+    def test_pieces(self):
+        """Input split anywhere, even inside characters, parses the same"""
+
+        data = report("a", 40)
+        for size in (1, 5, 64, len(data)):
+            output = OutputStage(self.producer)
+            ingest = StreamIngest("<test>", output, True, multiline=True)
+            send(ingest.feed, data, size)
+            ingest.finish()
+            output.drain(len(output.queue))
+            self.assertTrue(ingest.done and ingest.ok)
+            self.assertEqual([row[1:] for row in self.rows], self.expected(data))
+            self.assertTrue(self.rows[0][0])
+            del self.rows[:]
+
+    def test_source_holds_open_records(self):
+        """Lines of a record with an open quote wait for the rest"""
+
+        source = StreamSource("<test>", multiline=True)
+        source.feed('a,"one\ntwo\n')
+        self.assertEqual(source.readline(), u"")
+        source.feed('three",b\nc')
+        self.assertEqual([source.readline() for i in range(3)],
+            [u'a,"one\n', u"two\n", u'three",b\n'])
+        self.assertEqual(source.readline(), u"")
+        source.finish()
+        self.assertEqual(source.readline(), u"c")
+
+    def test_quotes_inside_values(self):
+        """A quote inside an unquoted value does not hold a record back"""
+
+        source = StreamSource("<test>", multiline=True)
+        source.feed('a,5" disk,b\nc,d\n')
+        self.assertEqual([source.readline() for i in range(2)],
+            [u'a,5" disk,b\n', u"c,d\n"])
+        source.feed('e,"f\n""g""\n')
+        self.assertEqual(source.readline(), u"")
+        source.feed('",h\n')
+        self.assertEqual([source.readline() for i in range(3)],
+            [u'e,"f\n', u'""g""\n', u'",h\n'])
+
+    def test_concurrent_sockets(self):
+        """Many connections are read at once, each giving its own rows"""
+
+        loop = IngestLoop(self.producer, no_total_warning=True, multiline=True)
+        server = loop.listen()
+        reports = dict((name, report(name, 30)) for name in "abcde")
+        def client(data):
+            sock = socket.create_connection(server.address)
+            send(sock.sendall, data, 100)
+            sock.close()
+        threads = [threading.Thread(target=client, args=(data,))
+            for data in reports.values()]
+        for thread in threads:
+            thread.start()
+        while len(loop.streams) < len(reports) or \
+                not all(ingest.done for ingest in loop.streams):
+            loop.poll(0.05)
+        server.close()
+        self.assertTrue(loop.run())
+        for thread in threads:
+            thread.join()
+        for name, data in reports.items():
+            rows = [row[1:] for row in self.rows if row[1].startswith(name)]
+            self.assertEqual(rows, self.expected(data))
+        self.assertEqual([row[0] for row in self.rows],
+            [True] + [False] * (len(self.rows) - 1))
+
+    def test_pipes_and_backpressure(self):
+        """Pipes are read too, and a full output holds the input back"""
+
+        queued = []
+        def producer(ad_info, first, args):
+            queued.append(len(loop.output.queue))
+            self.producer(ad_info, first, args)
+        loop = IngestLoop(producer, high_water=5, no_total_warning=True,
+            multiline=True)
+        loop.output.drain_size = 2
+        reports = [report("p%d" % i, 50) for i in range(3)]
+        threads = []
+        for i, data in enumerate(reports):
+            read_end, write_end = os.pipe()
+            loop.add_pipe(read_end, "pipe %d" % i)
+            os.close(read_end)
+            writer = os.fdopen(write_end, "wb")
+            def write(data=data, writer=writer):
+                send(writer.write, data, 1000)
+                writer.close()
+            threads.append(threading.Thread(target=write))
+        for thread in threads:
+            thread.start()
+        self.assertTrue(loop.run())
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.rows), 150)
+        self.assertTrue(max(queued) <= 5)
+
+    def test_failed_stream(self):
+        """A stream with a bad row stops, and the others carry on"""
+
+        loop = IngestLoop(self.producer, no_total_warning=True, multiline=True)
+        threads = []
+        for name, data in (("good", report("good", 20)),
+                ("bad", report("bad", 20, 10))):
+            ours, theirs = socket.socketpair()
+            loop.add_socket(ours, name)
+            def write(data=data, sock=theirs):
+                send(sock.sendall, data, 50)
+                sock.close()
+            threads.append(threading.Thread(target=write))
+        for thread in threads:
+            thread.start()
+        self.assertFalse(loop.run())
+        for thread in threads:
+            thread.join()
+        self.assertEqual([ingest.ok for ingest in loop.streams], [True, False])
+        names = [row[1] for row in self.rows]
+        self.assertEqual(len([name for name in names if name.startswith("good")]), 20)
+        self.assertEqual(len([name for name in names if name.startswith("bad")]), 10)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+
+# Testing functions for the adsymbols module.
+
+import logging
+import unittest
+
+from StringIO import StringIO
+
+import admetrics
+from admetrics import AdDataReader, OutputWriter
+from adsymbols import SymbolTable, pair
+from addedup import ExactDeduper
+from adaggregate import Aggregator
+from test_adaggregate import make_rows
+
+class TestSymbolTable(unittest.TestCase):
+    """Strings get one ID, and one set of forms, however they are cased"""
+
+    def test_ids(self):
+        """Strings the same in lower case share an ID, numbered from 0"""
+
+        symbols = SymbolTable()
+        self.assertEqual(symbols.id(u"Honda"), 0)
+        self.assertEqual(symbols.id(u"Nissan"), 1)
+        self.assertEqual(symbols.id(u"HONDA"), 0)
+        self.assertEqual(symbols.id(u"honda"), 0)
+        self.assertEqual(symbols.id(u"Caf\u00c9"), 2)
+        self.assertEqual(symbols.id(u"caf\u00e9"), 2)
+        self.assertEqual(len(symbols), 3)
+        self.assertEqual(symbols.names, [u"honda", u"nissan", u"caf\u00e9"])
+
+    def test_forms(self):
+        """The lower-case forms are interned, and the CSV forms escaped"""
+
+        symbols = SymbolTable()
+        self.assertEqual(symbols.csv_form(u'Ad "One"'), u'"ad ""one"""')
+        self.assertEqual(symbols.csv_form(u"Ad, Two"), u"ad, two")
+        self.assertTrue(symbols.lower(u"Ad Three") is symbols.lower(u"AD THREE"))
+
+    def test_pair(self):
+        """Pairs of IDs give distinct integers"""
+
+        self.assertNotEqual(pair(1, 2), pair(2, 1))
+        self.assertEqual(pair(0, 5), 5)
+        self.assertEqual(pair(1, 0), 1 << 32)
+
+class TestUses(unittest.TestCase):
+    """Duplicate checks, rollups and output give the same answers with symbols"""
+
+    def test_deduper(self):
+        """Symbols stand in for keys, except while journalling"""
+
+        deduper = ExactDeduper()
+        self.assertTrue(deduper.add(u"2011-01-01", u"k", 7))
+        self.assertFalse(deduper.add(u"2011-01-01", u"other", 7))
+        self.assertTrue(deduper.add(u"2011-01-02", u"k", 7))
+        deduper = ExactDeduper()
+        deduper.start_journal()
+        self.assertTrue(deduper.add(u"2011-01-01", u"k", 7))
+        self.assertTrue(deduper.add(u"2011-01-01", u"other", 7))
+        self.assertEqual(len(deduper.take_journal()), 2)
+
+    def test_aggregator(self):
+        """Rows added with folded strings total as rows added plainly"""
+
+        rows = make_rows(1000)
+        symbols = SymbolTable()
+        for by in ((), ('ad_group',), ('ad_name', 'date'),
+                ('date', 'ad_group', 'ad_name')):
+            expected = Aggregator(by)
+            aggregator = Aggregator(by)
+            for row in rows:
+                expected.add(row)
+                aggregator.add_folded(row, symbols.lower(row.ad_group),
+                    symbols.lower(row.ad_name))
+            self.assertEqual(aggregator.groups, expected.groups)
+
+    def test_producer(self):
+        """Rows differing only in case are still caught as duplicates"""
+
+        handler = logging.Handler()
+        handler.emit = lambda record: None
+        data = u"Report Date: 01/01/2011\nAd Group,Ad Name,Impressions,Clicks," \
+            "CTR,Total Cost\nHonda,\"Great \"\"Deals\"\"\",300,23,0.0766,$10.22\n" \
+            "Nissan,\"Great \"\"Deals\"\"\",1,1,1.0,$1.00\n" \
+            "HONDA,\"great \"\"deals\"\"\",340,44,0.1294,$15.02\n"
+        args = admetrics.parse_command_line(["--no-total-warning", "-"])
+        output = StringIO()
+        context = admetrics.RunContext(args, OutputWriter(output, bom=False))
+        root = logging.getLogger()
+        root.addHandler(handler)
+        try:
+            reader = AdDataReader(StringIO(data), admetrics.default_producer, True,
+                context)
+            self.assertRaises(SystemExit, reader.process_input)
+        finally:
+            root.removeHandler(handler)
+        context.writer.flush()
+        self.assertEqual(output.getvalue().splitlines()[1:], [
+            '2011-01-01,honda,"great ""deals""",300,23,1022',
+            '2011-01-01,nissan,"great ""deals""",1,1,100'])
+        self.assertEqual(len(context.symbols), 3)
+
+if __name__ == '__main__':
+    unittest.main()